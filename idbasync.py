@@ -0,0 +1,100 @@
+"""
+idbasync - awaitable lookups on an ID0File, for use from asyncio code.
+
+The ID0File methods block on file I/O, so calling them from a coroutine
+stalls the event loop. `AsyncID0File` runs them in a thread pool instead.
+Since the b-tree pages are read with positional reads, and the page and
+name caches are thread safe, many lookups on one database can run concurrently.
+
+    id0 = AsyncID0File(idb.getsection(idblib.ID0File))
+    name = await id0.name(0x401000)
+    values = await id0.fetch([(node, 'S', 0), (node, 'S', 1), ...])
+
+This module requires python 3.7 or later, unlike idblib itself.
+
+Copyright (c) 2016 Willem Hengeveld <itsme@xs4all.nl>
+"""
+import asyncio
+import concurrent.futures
+import functools
+
+
+class AsyncID0File:
+    """
+    Awaitable wrapper for an ID0File.
+
+    Uses `executor` when given, otherwise creates a thread pool with `maxworkers` threads,
+    which is shut down by `close`.
+    """
+    def __init__(self, id0, executor=None, maxworkers=4):
+        self.id0 = id0
+        self.maxworkers = maxworkers
+        self.ownexecutor = executor is None
+        self.executor = executor or concurrent.futures.ThreadPoolExecutor(maxworkers)
+
+    def run(self, func, *args):
+        """ returns an awaitable for func(*args), called in the thread pool """
+        return asyncio.get_running_loop().run_in_executor(self.executor, functools.partial(func, *args))
+
+    async def bytes(self, *args):
+        return await self.run(self.id0.bytes, *args)
+
+    async def int(self, *args):
+        return await self.run(self.id0.int, *args)
+
+    async def string(self, *args):
+        return await self.run(self.id0.string, *args)
+
+    async def blob(self, nodeid, tag, start=0, end=0xFFFFFFFF):
+        return await self.run(self.id0.blob, nodeid, tag, start, end)
+
+    async def name(self, id):
+        return await self.run(self.id0.name, id)
+
+    async def nodeByName(self, name):
+        return await self.run(self.id0.nodeByName, name)
+
+    async def names(self, eas):
+        """ Returns a list of (ea, name) tuples, see ID0File.names """
+        return await self.run(lambda: list(self.id0.names(eas)))
+
+    async def range(self, nodeid, tag, lo=None, hi=None):
+        """ Returns a list of (index, value) tuples, see ID0File.range """
+        return await self.run(lambda: list(self.id0.range(nodeid, tag, lo, hi)))
+
+    async def prefix(self, keyprefix):
+        """ Returns a list of (key, value) tuples, see ID0File.prefix """
+        return await self.run(lambda: list(self.id0.prefix(keyprefix)))
+
+    def lookupmany(self, keys):
+        """ looks up `keys` in key order, so consecutive lookups mostly hit cached pages """
+        values = [None] * len(keys)
+        for i in sorted(range(len(keys)), key=lambda i: keys[i]):
+            cur = self.id0.btree.find('eq', keys[i])
+            if cur:
+                values[i] = cur.getval()
+        return values
+
+    async def fetch(self, keys):
+        """
+        Returns the values for a list of keys, in the same order, None for missing keys.
+
+        Keys are either a complete key, or a tuple of `makekey` arguments, like (nodeid, 'S', 0).
+        The lookups are split over the worker threads, instead of one job per key.
+        """
+        keys = [self.id0.makekey(*key) if isinstance(key, tuple) else key for key in keys]
+        if not keys:
+            return []
+        chunk = -(-len(keys) // self.maxworkers)
+        parts = await asyncio.gather(*[self.run(self.lookupmany, keys[i:i + chunk]) for i in range(0, len(keys), chunk)])
+        return [value for part in parts for value in part]
+
+    def close(self):
+        if self.ownexecutor:
+            self.executor.shutdown()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        self.close()
@@ -0,0 +1,262 @@
+"""
+idbcache - a persistent cache of facts derived from IDA databases.
+
+Each run of idbtool re-derives the same things from a database: the
+`Root Node`, the nodes for lists like `$ structs` or `$ enums`,
+the IDBParams, the info printed with `--info`.
+When repeatedly scanning a large, mostly unchanged, collection of databases
+this is wasted effort.
+
+The cache is a sqlite3 database in a cache directory, keyed by the absolute
+path of the database, its size and modification time, and optionally a crc
+of the file header, which contains the section checksums.
+
+Usage:
+
+    cache = IDBCache(cachedir)
+    entry = cache.lookup(filename)
+    entry.attach(id0)       # pre-seeds the ID0File with cached facts
+    ...
+    entry.save()            # stores any newly derived facts
+
+`SectionCache` keeps the decompressed sections of compressed databases,
+so these are inflated only once, and memory mapped on later opens:
+
+    idb = idblib.IDBFile(fh, sectioncache=SectionCache(cachedir, maxsize))
+
+Copyright (c) 2016 Willem Hengeveld <itsme@xs4all.nl>
+"""
+from __future__ import division, print_function, absolute_import, unicode_literals
+import os
+import errno
+import json
+import zlib
+import binascii
+import hashlib
+import sqlite3
+import threading
+import idblib
+
+
+# the ID0File cachedproperties which are stored in the cache.
+# wordsize and maxnode are not stored, ID0File determines them before the cache can be attached.
+ID0FACTS = ('root', 'idaver', 'idbparams', 'idaverstr', 'nropens', 'creationtime', 'originmd5', 'somecrc')
+
+
+def iscachedname(name):
+    """ only the nodes for internal lists and the root node are stored, not every name looked up """
+    return isinstance(name, type("")) and (name.startswith("$ ") or name == "Root Node")
+
+
+def encodefact(value):
+    """ json encoding for bytes values """
+    if isinstance(value, (bytes, bytearray)):
+        return {"__bytes__": binascii.b2a_hex(value).decode('ascii')}
+    raise TypeError("can't encode %r" % value)
+
+
+def decodefact(obj):
+    if "__bytes__" in obj:
+        return binascii.a2b_hex(obj["__bytes__"])
+    return obj
+
+
+class CacheEntry(object):
+    """
+    The cached facts for a single database file.
+
+    `hit` is True when the facts came from the cache.
+    """
+    def __init__(self, cache, identity, facts):
+        self.cache = cache
+        self.identity = identity
+        self.facts = facts
+        self.hit = bool(facts)
+        self.dirty = False
+        self.id0 = None
+
+    def get(self, name):
+        return self.facts.get(name)
+
+    def set(self, name, value):
+        if self.facts.get(name) != value:
+            self.facts[name] = value
+            self.dirty = True
+
+    def attach(self, id0):
+        """
+        Pre-seed the cachedproperties and list nodes of `id0` from the cache,
+        and remember `id0`, so `save` can collect the facts derived while processing.
+        """
+        self.id0 = id0
+        facts = self.facts.get('id0', {})
+        for attr in ID0FACTS:
+            if attr in facts:
+                setattr(id0, '_' + attr, facts[attr])
+        for name, nodeid in self.facts.get('nodes', {}).items():
+            id0.nodecache.pin(name, nodeid)
+
+    def collect(self, id0):
+        """ store the facts derived from `id0` """
+        facts = dict(self.facts.get('id0', {}))
+        for attr in ID0FACTS:
+            if hasattr(id0, '_' + attr):
+                facts[attr] = getattr(id0, '_' + attr)
+        self.set('id0', facts)
+
+        nodes = dict(self.facts.get('nodes', {}))
+        for name, nodeid in list(id0.nodecache.items.items()) + list(id0.nodecache.pinned.items()):
+            if iscachedname(name):
+                nodes[name] = nodeid
+        self.set('nodes', nodes)
+
+    def save(self):
+        """ write the facts to the cache, when anything changed """
+        if self.id0 is not None:
+            self.collect(self.id0)
+        if self.dirty:
+            self.cache.store(self.identity, self.facts)
+            self.dirty = False
+
+
+class IDBCache(object):
+    """
+    A sqlite3 database in `cachedir`, mapping file identities to facts.
+
+    When `checksum` is set, the crc of the first 256 bytes of the file is
+    part of the identity. For .idb files this covers the section checksums.
+    """
+    def __init__(self, cachedir, checksum=False):
+        if not os.path.isdir(cachedir):
+            os.makedirs(cachedir)
+        self.checksum = checksum
+        # generous timeout, since worker processes may share the cache.
+        self.db = sqlite3.connect(os.path.join(cachedir, "idbcache.sqlite"), timeout=60)
+        self.db.execute("CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, size INTEGER, mtime INTEGER, checksum INTEGER, facts TEXT)")
+
+    def identity(self, path):
+        """ Returns a tuple: (path, size, mtime, checksum) """
+        st = os.stat(path)
+        mtime = getattr(st, 'st_mtime_ns', None) or int(st.st_mtime * 1000000000)
+        crc = None
+        if self.checksum:
+            with open(path, "rb") as fh:
+                crc = zlib.crc32(fh.read(0x100)) & 0xFFFFFFFF
+        return os.path.abspath(path), st.st_size, mtime, crc
+
+    def lookup(self, path):
+        """
+        Returns a CacheEntry for `path`, containing the cached facts when
+        the file did not change since they were stored.
+        """
+        identity = self.identity(path)
+        row = self.db.execute("SELECT size, mtime, checksum, facts FROM files WHERE path=?", identity[:1]).fetchone()
+        facts = dict()
+        if row and tuple(row[:3]) == identity[1:]:
+            facts = json.loads(row[3], object_hook=decodefact)
+        return CacheEntry(self, identity, facts)
+
+    def store(self, identity, facts):
+        with self.db:
+            self.db.execute("INSERT OR REPLACE INTO files (path, size, mtime, checksum, facts) VALUES (?, ?, ?, ?, ?)",
+                            identity + (json.dumps(facts, default=encodefact, sort_keys=True),))
+
+    def close(self):
+        self.db.close()
+
+
+class SectionCache(object):
+    """
+    A directory with the decompressed sections of compressed databases.
+
+    Sections are keyed by the identity of the database file: device, inode, size and
+    modification time, plus the section index and checksum.
+    When the total size of the cached sections exceeds `maxsize` bytes,
+    the least recently used sections are removed.
+    """
+    def __init__(self, cachedir, maxsize=4 << 30):
+        if not os.path.isdir(cachedir):
+            os.makedirs(cachedir)
+        self.cachedir = cachedir
+        self.maxsize = maxsize
+
+    def filename(self, fh, ix, checksum):
+        st = os.fstat(fh.fileno())
+        mtime = getattr(st, 'st_mtime_ns', None) or int(st.st_mtime * 1000000000)
+        key = "%x:%x:%x:%x:%d:%x" % (st.st_dev, st.st_ino, st.st_size, mtime, ix, checksum)
+        return os.path.join(self.cachedir, hashlib.sha1(key.encode('utf-8')).hexdigest() + ".sec")
+
+    def getpart(self, fh, ix, checksum, compressed, wbits):
+        """
+        Returns a MappedSection with the decompressed data of section `ix` of the database `fh`,
+        decompressing `compressed` into the cache when needed.
+
+        Returns None when the section can't be cached, like when `fh` is not a real file.
+        A cached section removed by another process before it is opened is decompressed again.
+        """
+        try:
+            path = self.filename(fh, ix, checksum)
+        except Exception:
+            return None
+
+        for attempt in range(3):
+            try:
+                # the modification time is used for the lru order.
+                os.utime(path, None)
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+                self.decompress(path, compressed, wbits)
+                self.evict(path)
+            try:
+                sfh = open(path, "rb")
+            except (IOError, OSError) as e:
+                if e.errno != errno.ENOENT:
+                    raise
+                # evicted by another process, decompress it again.
+                continue
+            with sfh:
+                mm = idblib.mapfile(sfh)
+            if mm is None:
+                break
+            return idblib.MappedSection(mm, 0, len(mm))
+
+        compressed.seek(0)
+        return None
+
+    def decompress(self, path, compressed, wbits):
+        """ decompresses `compressed` into `path`, via a temporary file, so other processes never see a partial section """
+        tmppath = "%s.%d.%d.tmp" % (path, os.getpid(), threading.current_thread().ident)
+        try:
+            compressed.seek(0)
+            with open(tmppath, "w+b") as spill:
+                idblib.InflatedSection(compressed, wbits, spill).size()
+            os.rename(tmppath, path)
+        finally:
+            if os.path.exists(tmppath):
+                os.unlink(tmppath)
+
+    def evict(self, keep=None):
+        """ remove the least recently used sections, until the cache fits in `maxsize` """
+        entries = []
+        for fn in os.listdir(self.cachedir):
+            path = os.path.join(self.cachedir, fn)
+            if fn.endswith(".sec") and path != keep:
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    # removed by another process
+                    continue
+                entries.append((st.st_mtime, st.st_size, path))
+        total = sum(size for mtime, size, path in entries)
+        if keep:
+            total += os.path.getsize(keep)
+        for mtime, size, path in sorted(entries):
+            if total <= self.maxsize:
+                break
+            try:
+                # mapped sections stay valid after the file is removed.
+                os.unlink(path)
+            except OSError:
+                pass
+            total -= size
@@ -0,0 +1,73 @@
+"""
+idbdiff - list the differences between the id0 records of two IDA databases.
+
+Typically used to compare two revisions of the same database, like before and
+after an analysis session. Both databases are walked in key order simultaneously,
+so the output is produced while reading, in constant memory.
+
+Output:
+
+    - key = value              record only in the first database
+    + key = value              record only in the second database
+    ! key = value1 -> value2   record with a changed value
+
+Copyright (c) 2016 Willem Hengeveld <itsme@xs4all.nl>
+"""
+from __future__ import division, print_function, absolute_import, unicode_literals
+import sys
+import argparse
+import idblib
+from idblib import hexdump
+
+
+def openid0(fh, args):
+    """ Returns an ID0File for a .idb/.i64 file, or for a naked .id0 file """
+    class DummyIDB:
+        magic = 'IDA2' if args.i64 else 'IDA1' if args.i32 else None
+
+    magic = fh.read(64)
+    fh.seek(0)
+    if magic.find(b'B-tree v') > 0:
+        return idblib.ID0File(DummyIDB(), idblib.mapsection(fh))
+    return idblib.IDBFile(fh).getsection(idblib.ID0File)
+
+
+def diffid0(args, id0a, id0b):
+    if args.raw:
+        fmtkey = fmtval = hexdump
+    else:
+        fmtkey, fmtval = id0a.prettykey, id0a.prettyval
+
+    n = 0
+    for key, aval, bval in idblib.diffbtrees(id0a.btree, id0b.btree):
+        if bval is None:
+            print("- %s = %s" % (fmtkey(key), fmtval(aval)))
+        elif aval is None:
+            print("+ %s = %s" % (fmtkey(key), fmtval(bval)))
+        else:
+            print("! %s = %s -> %s" % (fmtkey(key), fmtval(aval), fmtval(bval)))
+        n += 1
+        if args.limit and n >= args.limit:
+            break
+    return n
+
+
+def main():
+    parser = argparse.ArgumentParser(description='idbdiff - list the differences between the records of two IDA databases')
+    parser.add_argument('--raw', action='store_true', help='print keys and values as hex, instead of decoding them')
+    parser.add_argument('--limit', '-m', type=int, help='Max nr of differences to print.')
+    parser.add_argument('--i64', '-i64', action='store_true', help='specify that `naked` files are from a 64 bit database')
+    parser.add_argument('--i32', '-i32', action='store_true', help='specify that `naked` files are from a 32 bit database')
+    parser.add_argument('FILE1', type=str, help='the first database')
+    parser.add_argument('FILE2', type=str, help='the second database')
+    args = parser.parse_args()
+
+    with open(args.FILE1, "rb") as fha, open(args.FILE2, "rb") as fhb:
+        n = diffid0(args, openid0(fha, args), openid0(fhb, args))
+
+    # like diff: exitcode 1 when the databases differ
+    sys.exit(1 if n else 0)
+
+
+if __name__ == '__main__':
+    main()
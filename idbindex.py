@@ -0,0 +1,227 @@
+"""
+idbindex - maintain a searchable index of the names in a collection of IDA databases.
+
+The index is a sqlite3 database containing:
+ * all names from the id0 'N' records, as 'symbol' when the address is listed
+   in the .nam section, or as 'node' for other named netnodes.
+ * struct and enum names, from the '$ structs' and '$ enums' lists.
+ * script names, from '$ scriptsnippets'.
+
+Files are only re-read when their size or modification time changed.
+Lookups are answered from the index alone, without opening any database.
+
+Substring searches use a sqlite FTS5 trigram index when the sqlite library supports it.
+
+Copyright (c) 2016 Willem Hengeveld <itsme@xs4all.nl>
+"""
+from __future__ import division, print_function, absolute_import, unicode_literals
+import sys
+import os
+import sqlite3
+import argparse
+import idblib
+
+
+KINDS = ('symbol', 'node', 'struct', 'enum', 'script')
+
+
+def listitems(id0, listname):
+    """ yields the item nodes for one of the '$ structs', '$ enums', '$ scriptsnippets' lists """
+    listnode = id0.nodeByName(listname)
+    if not listnode:
+        return
+    for seqnr, item in id0.range(listnode, 'A', hi=0xFFFFFFFF):
+        yield id0.decodeint(item) - 1
+
+
+def extractnames(idb):
+    """
+    Yields (kind, name, value) for all names in the database.
+    """
+    id0 = idb.getsection(idblib.ID0File)
+
+    symbols = set()
+    if idb.getsectioninfo(idblib.NAMFile.INDEX)[1]:
+        symbols = set(idb.getsection(idblib.NAMFile).allnames())
+
+    kinds = dict()
+    for node in listitems(id0, '$ structs'):
+        kinds[node] = 'struct'
+    for node in listitems(id0, '$ enums'):
+        kinds[node] = 'enum'
+
+    found = set()
+    for key, val in id0.prefix(b'N'):
+        value = id0.decodeint(val)
+        if value is None:
+            # a malformed name record
+            continue
+        if key[1:2] == b'\x00':
+            # long names are stored as blobs, with the name record pointing to the address.
+            name = id0.name(value)
+        else:
+            name = key[1:].decode('utf-8', 'ignore')
+        if not name:
+            continue
+        found.add(value)
+        yield 'symbol' if value in symbols else kinds.get(value, 'node'), name, value
+
+    # named addresses without a name record, like some long names.
+    for ea, name in id0.names(sorted(symbols - found)):
+        if name:
+            yield 'symbol', name, ea
+
+    for node in listitems(id0, '$ scriptsnippets'):
+        script = idblib.Script(id0, node)
+        if script.name:
+            yield 'script', script.name, node
+
+
+class NameIndex(object):
+    """
+    The name index, stored in the sqlite3 database `dbname`.
+    """
+    def __init__(self, dbname):
+        self.db = sqlite3.connect(dbname)
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS files (id INTEGER PRIMARY KEY, path TEXT UNIQUE, size INTEGER, mtime INTEGER, error TEXT);
+            CREATE TABLE IF NOT EXISTS names (id INTEGER PRIMARY KEY, fileid INTEGER, kind TEXT, name TEXT, value TEXT);
+            CREATE INDEX IF NOT EXISTS names_name ON names (name);
+            CREATE INDEX IF NOT EXISTS names_fileid ON names (fileid);
+        """)
+        try:
+            self.db.execute("CREATE VIRTUAL TABLE IF NOT EXISTS names_fts USING fts5(name, content='names', content_rowid='id', tokenize='trigram case_sensitive 1')")
+            self.hasfts = True
+        except sqlite3.OperationalError:
+            self.hasfts = False
+
+    def fileinfo(self, path):
+        st = os.stat(path)
+        return st.st_size, getattr(st, 'st_mtime_ns', None) or int(st.st_mtime * 1000000000)
+
+    def removefile(self, fileid):
+        if self.hasfts:
+            self.db.execute("INSERT INTO names_fts (names_fts, rowid, name) SELECT 'delete', id, name FROM names WHERE fileid=?", (fileid,))
+        self.db.execute("DELETE FROM names WHERE fileid=?", (fileid,))
+        self.db.execute("DELETE FROM files WHERE id=?", (fileid,))
+
+    def update(self, path):
+        """
+        (re)index `path` when it changed since it was last indexed.
+        Returns True when the file was indexed.
+        """
+        path = os.path.abspath(path)
+        size, mtime = self.fileinfo(path)
+        row = self.db.execute("SELECT id, size, mtime FROM files WHERE path=?", (path,)).fetchone()
+        if row and tuple(row[1:]) == (size, mtime):
+            return False
+
+        error = None
+        names = []
+        try:
+            with open(path, "rb") as fh:
+                names = [(kind, name, "%x" % value) for kind, name, value in extractnames(idblib.IDBFile(fh))]
+        except Exception as e:
+            error = str(e)
+
+        with self.db:
+            if row:
+                self.removefile(row[0])
+            fileid = self.db.execute("INSERT INTO files (path, size, mtime, error) VALUES (?, ?, ?, ?)", (path, size, mtime, error)).lastrowid
+            self.db.executemany("INSERT INTO names (fileid, kind, name, value) VALUES (?, ?, ?, ?)",
+                                ((fileid, kind, name, value) for kind, name, value in names))
+            if self.hasfts:
+                self.db.execute("INSERT INTO names_fts (rowid, name) SELECT id, name FROM names WHERE fileid=?", (fileid,))
+        if error:
+            print("ERROR indexing %s: %s" % (path, error), file=sys.stderr)
+        return True
+
+    def prune(self):
+        """ remove files which no longer exist from the index """
+        with self.db:
+            for fileid, path in self.db.execute("SELECT id, path FROM files").fetchall():
+                if not os.path.exists(path):
+                    self.removefile(fileid)
+
+    def search(self, name, mode='exact', kind=None):
+        """
+        Yields (path, kind, name, value) for names matching `name`.
+
+        `mode` is one of: 'exact', 'prefix', 'substring'.
+        """
+        if mode == 'exact':
+            where, params = "names.name = ?", [name]
+        elif mode == 'prefix':
+            # U+10FFFF sorts after any other utf-8 encoded character.
+            where, params = "names.name >= ? AND names.name < ?", [name, name + "\U0010ffff"]
+        elif mode == 'substring' and self.hasfts and len(name) >= 3:
+            where, params = "names.id IN (SELECT rowid FROM names_fts WHERE names_fts MATCH ?)", ['"' + name.replace('"', '""') + '"']
+        elif mode == 'substring':
+            where, params = "instr(names.name, ?) > 0", [name]
+        else:
+            raise Exception("unknown search mode: %s" % mode)
+        if kind:
+            where += " AND names.kind = ?"
+            params.append(kind)
+
+        query = "SELECT files.path, names.kind, names.name, names.value FROM names JOIN files ON files.id = names.fileid WHERE " + where + " ORDER BY files.path, names.name"
+        for path, kind, name, value in self.db.execute(query, params):
+            yield path, kind, name, int(value, 16)
+
+    def close(self):
+        self.db.close()
+
+
+def enumeratefiles(paths):
+    """ yields all .idb and .i64 files in `paths`, recursing into directories """
+    for path in paths:
+        if os.path.isdir(path):
+            for dirpath, dirnames, filenames in os.walk(path):
+                for fn in sorted(filenames):
+                    if os.path.splitext(fn)[1].lower() in ('.idb', '.i64'):
+                        yield os.path.join(dirpath, fn)
+        else:
+            yield path
+
+
+def main():
+    parser = argparse.ArgumentParser(description='idbindex - index and search the names in a collection of IDA databases',
+                                     formatter_class=argparse.RawDescriptionHelpFormatter,
+                                     epilog="""
+Examples:
+
+  python idbindex.py --update ~/idbs          index all .idb and .i64 files under ~/idbs
+  python idbindex.py GetProcAddress           find all databases with a name 'GetProcAddress'
+  python idbindex.py --prefix --kind struct _IMAGE
+""")
+    parser.add_argument('--index', type=str, default='idbindex.sqlite', help='The index database, default: idbindex.sqlite')
+    parser.add_argument('--update', '-u', type=str, nargs='+', help='Add or update the databases in these files or directories', metavar='PATH')
+    parser.add_argument('--prune', action='store_true', help='Remove files which no longer exist from the index')
+    parser.add_argument('--prefix', '-p', action='store_true', help='Find names starting with NAME')
+    parser.add_argument('--substring', '-s', action='store_true', help='Find names containing NAME')
+    parser.add_argument('--kind', '-k', choices=KINDS, help='Only find names of this kind')
+    parser.add_argument('NAMES', type=str, nargs='*', help='Names to search for')
+
+    args = parser.parse_args()
+
+    index = NameIndex(args.index)
+
+    if args.update:
+        n = 0
+        for fn in enumeratefiles(args.update):
+            if index.update(fn):
+                n += 1
+        print("%d files (re)indexed" % n, file=sys.stderr)
+    if args.prune:
+        index.prune()
+
+    mode = 'prefix' if args.prefix else 'substring' if args.substring else 'exact'
+    for name in args.NAMES:
+        for path, kind, name, value in index.search(name, mode, args.kind):
+            print("%s: %-6s %08x %s" % (path, kind, value, name))
+
+    index.close()
+
+
+if __name__ == '__main__':
+    main()
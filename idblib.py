@@ -51,6 +51,10 @@ import struct
 import binascii
 import re
 import os
+import bisect
+import threading
+from array import array
+from collections import OrderedDict
 
 #############################################################################
 # some code to make this library run with both python2 and python3
@@ -113,9 +117,127 @@ def hexdump(data):
     return binascii.b2a_hex(data).decode('utf-8')
 
 
+class LRUCache(object):
+    """
+    A bounded mapping, discarding the least recently used item when full.
+
+    Pinned items do not count towards `maxsize` and are never evicted.
+    A `maxsize` of 0 disables the cache.
+
+    `hits`, `misses` and `evictions` can be used to judge how effective the cache is.
+
+    The cache can be shared between threads.
+    """
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.items = OrderedDict()
+        self.pinned = dict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        """ returns the cached value for `key`, or None """
+        with self.lock:
+            if key in self.pinned:
+                self.hits += 1
+                return self.pinned[key]
+            value = self.items.pop(key, None)
+            if value is None:
+                self.misses += 1
+                return
+            # re-insert to mark as most recently used
+            self.items[key] = value
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        if self.maxsize <= 0:
+            return
+        with self.lock:
+            self.items.pop(key, None)
+            self.items[key] = value
+            while len(self.items) > self.maxsize:
+                self.items.popitem(last=False)
+                self.evictions += 1
+
+    def pin(self, key, value):
+        """ add an item which will not be evicted """
+        if self.maxsize <= 0:
+            return
+        with self.lock:
+            self.items.pop(key, None)
+            self.pinned[key] = value
+
+    def fetch(self, key, func):
+        """
+        Returns the cached value for `key`, or calls func(key), and caches the result.
+        Unlike `get`, this can cache None values.
+
+        func is called without holding the lock, so concurrent misses
+        for the same key may call func more than once.
+        """
+        with self.lock:
+            if key in self.pinned:
+                self.hits += 1
+                return self.pinned[key]
+            if key in self.items:
+                self.hits += 1
+                value = self.items[key] = self.items.pop(key)
+                return value
+            self.misses += 1
+        value = func(key)
+        self.put(key, value)
+        return value
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+            self.pinned.clear()
+
+    def stats(self):
+        return dict(size=len(self.items) + len(self.pinned), maxsize=self.maxsize,
+                    hits=self.hits, misses=self.misses, evictions=self.evictions)
+
+    def __len__(self):
+        return len(self.items) + len(self.pinned)
+
+
 #############################################################################
 
 
+# serializes seek+read on file objects which don't support positional reads.
+seeklock = threading.Lock()
+
+
+def filedescriptor(fh):
+    """
+    Returns the file descriptor of `fh` when it can be used with os.pread, or None.
+    """
+    if not hasattr(os, 'pread'):
+        return None
+    try:
+        fd = fh.fileno()
+        # fails for pipes
+        os.pread(fd, 0, 0)
+        return fd
+    except Exception:
+        return None
+
+
+def readat(fh, offset, size):
+    """
+    Read `size` bytes at `offset` from `fh`, using fh.readat when available,
+    so no shared filepointer is involved, otherwise seek+read while holding `seeklock`.
+    """
+    if hasattr(fh, 'readat'):
+        return fh.readat(offset, size)
+    with seeklock:
+        fh.seek(offset)
+        return fh.read(size)
+
+
 class FileSection(object):
     """
     Presents a file like object which is a section of a larger file.
@@ -125,14 +247,29 @@ class FileSection(object):
 
     This class is used to access a section (e.g. the .id0 file) of a larger file (e.g. the .idb file)
     and make read/seek behave as if it were a separate file.
+
+    The filepointer of `fh` is not used when `fh` supports os.pread, this makes
+    it possible to read from several sections of the same file from multiple threads.
+    `readat` reads without using the section's own position either.
     """
     def __init__(self, fh, start, end):
         self.fh = fh
         self.start = start
         self.end = end
+        self.fd = filedescriptor(fh)
 
         self.curpos = 0
-        self.fh.seek(self.start)
+
+    def readat(self, offset, size):
+        size = min(size, self.end - self.start - offset)
+        if size <= 0:
+            return b""
+        if self.fd is not None:
+            return os.pread(self.fd, size, self.start + offset)
+        # the fh object is shared with others, make sure the filepointer is at the correct position.
+        with seeklock:
+            self.fh.seek(self.start + offset)
+            return self.fh.read(size)
 
     def read(self, size=None):
         want = self.end - self.start - self.curpos
@@ -142,9 +279,7 @@ class FileSection(object):
         if want <= 0:
             return b""
 
-        # make sure filepointer is at correct position since we are sharing the fh object with others.
-        self.fh.seek(self.curpos + self.start)
-        data = self.fh.read(want)
+        data = self.readat(self.curpos, want)
         self.curpos += len(data)
         return data
 
@@ -158,7 +293,7 @@ class FileSection(object):
             whence = args[0]
         if whence == 0:
             if not isvalidpos(offset):
-                print("invalid seek: from %x to SET:%x" % (self.curpos, offset))
+                print("invalid seek: from %x to SET:%x" % (self.curpos, offset), file=sys.stderr)
                 raise Exception("illegal offset")
             self.curpos = offset
         elif whence == 1:
@@ -169,12 +304,171 @@ class FileSection(object):
             if not isvalidpos(self.end - self.start + offset):
                 raise Exception("illegal offset")
             self.curpos = self.end - self.start + offset
-        self.fh.seek(self.curpos + self.start)
 
     def tell(self):
         return self.curpos
 
 
+def mapfile(fh):
+    """
+    Returns a memoryview of a read-only memory map of the entire file `fh`,
+    or None when the file can't be mapped, like for pipes, or empty files.
+    """
+    try:
+        import mmap
+        return memoryview(mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ))
+    except Exception:
+        return None
+
+
+def mapsection(fh):
+    """
+    Returns a MappedSection for the entire file `fh`, or a FileSection when it can't be mapped,
+    or `fh` itself when it is not seekable.
+    """
+    mm = mapfile(fh)
+    if mm is not None:
+        return MappedSection(mm, 0, len(mm))
+    try:
+        fh.seek(0, 2)
+        size = fh.tell()
+        fh.seek(0)
+    except Exception:
+        return fh
+    return FileSection(fh, 0, size)
+
+
+def tobytes(data):
+    """ copy a memoryview slice into a bytes object """
+    if isinstance(data, memoryview):
+        return data.tobytes()
+    return data
+
+
+class MappedSection(object):
+    """
+    Presents a file like object which is a section of a memory mapped file.
+
+    `mm` is a memoryview of the mapped file, as returned by `mapfile`.
+
+    Besides read/seek/tell, this has a `readat` method, which returns
+    a memoryview of the requested data without copying, and without
+    any filepointer state.
+    """
+    def __init__(self, mm, start, end):
+        self.data = mm[start:end]
+        self.curpos = 0
+
+    def readat(self, offset, size):
+        return self.data[offset:offset + size]
+
+    def read(self, size=None):
+        if size is None:
+            size = len(self.data) - self.curpos
+        data = self.data[self.curpos:self.curpos + size].tobytes()
+        self.curpos += len(data)
+        return data
+
+    def seek(self, offset, whence=0):
+        if whence == 1:
+            offset += self.curpos
+        elif whence == 2:
+            offset += len(self.data)
+        if not 0 <= offset <= len(self.data):
+            raise Exception("illegal offset")
+        self.curpos = offset
+
+    def tell(self):
+        return self.curpos
+
+
+class InflatedSection(object):
+    """
+    Presents a file like object for a zlib compressed section.
+
+    `fh` is a file like object with the compressed data, `wbits` is passed to zlib.
+
+    The data is decompressed on demand, only up to the highest offset read so far,
+    into a spill file, so the decompressed section does not need to fit in memory.
+    Reads of already decompressed data use positional reads on the spill file.
+    The spill file is a temporary file, unless a writable `spill` file is passed.
+    """
+    chunksize = 0x10000
+
+    def __init__(self, fh, wbits=15, spill=None):
+        import zlib
+        import tempfile
+        self.fh = fh
+        self.decompressor = zlib.decompressobj(wbits)
+        self.spill = spill or tempfile.TemporaryFile()
+        self.fd = filedescriptor(self.spill)
+        self.lock = threading.Lock()
+
+        # nr of bytes decompressed into the spill file so far
+        self.inflated = 0
+        self.eof = False
+
+        self.curpos = 0
+
+    def inflate(self, end):
+        """ decompress until at least `end` bytes are available, or the end of the data """
+        with self.lock:
+            while self.inflated < end and not self.eof:
+                # bound the output per step, a highly compressed chunk can inflate to a lot of data
+                data = self.decompressor.unconsumed_tail
+                if not data:
+                    data = self.fh.read(self.chunksize)
+                if data:
+                    out = self.decompressor.decompress(data, self.chunksize * 16)
+                else:
+                    out = self.decompressor.flush()
+                    self.eof = True
+                if out:
+                    self.spill.seek(self.inflated)
+                    self.spill.write(out)
+                    self.spill.flush()
+                    self.inflated += len(out)
+
+    def size(self):
+        """ the decompressed size, this requires decompressing the entire section """
+        self.inflate(float('inf'))
+        return self.inflated
+
+    def readat(self, offset, size):
+        if self.inflated < offset + size:
+            self.inflate(offset + size)
+        size = min(size, self.inflated - offset)
+        if size <= 0:
+            return b""
+        if self.fd is not None:
+            return os.pread(self.fd, size, offset)
+        with self.lock:
+            self.spill.seek(offset)
+            return self.spill.read(size)
+
+    def read(self, size=None):
+        if size is None:
+            size = self.size() - self.curpos
+        data = self.readat(self.curpos, size)
+        self.curpos += len(data)
+        return data
+
+    def seek(self, offset, whence=0):
+        if whence == 1:
+            offset += self.curpos
+        elif whence == 2:
+            offset += self.size()
+        if offset < 0:
+            raise Exception("illegal offset")
+        self.curpos = offset
+
+    def tell(self):
+        return self.curpos
+
+    def close(self):
+        self.spill.close()
+
+
 class IdaUnpacker:
     """
     Decodes packed ida structures.
@@ -331,15 +625,27 @@ class IDBFile(object):
 
     ID0File is expected to have a class property 'INDEX'
 
+    Compressed sections are decompressed on demand, or, when a `sectioncache` is
+    configured, decompressed once into the cache, see idbcache.SectionCache.
+
 # v1..v5  id1 and nam files start with 'Va0' .. 'Va4'
 # v6      id1 and nam files start with 'VA*'
 # til files start with 'IDATIL'
 # id2 files start with 'IDAS\x1d\xa5\x55\x55'
 
     """
-    def __init__(self, fh):
+    # default cache for decompressed sections, None disables caching.
+    sectioncache = None
+
+    # v910 header compression byte -> section encoding, as reported by getsectioninfo.
+    # Note: 1 = zlib is an assumption, it was not verified against databases written by IDA 9.
+    V910COMPRESSION = {0: 0, 1: 2}
+
+    def __init__(self, fh, sectioncache=None):
         """ constructor takes a filehandle """
         self.fh = fh
+        if sectioncache is not None:
+            self.sectioncache = sectioncache
         self.fh.seek(0)
         hdrdata = self.fh.read(0x100)
 
@@ -378,6 +684,11 @@ class IDBFile(object):
                 +20: compression
                 +21: 6 qwords   section-size
                 +5d: md5
+
+                In compressed databases each section is stored as a separate zlib stream,
+                the section sizes are the compressed sizes.
+                This layout is inferred, not verified against a real compressed IDA 9 database,
+                see V910COMPRESSION for the supported compression values.
                 """
                 values = struct.unpack_from("<3QHB6Q", hdrdata, 6)
                 offsets = [values[1]]
@@ -385,10 +696,12 @@ class IDBFile(object):
                 
                 for s in self.sizes:
                     offsets.append(offsets[-1]+s)
+                # empty sections are absent, like sections with offset 0 in older versions
+                offsets = [ofs if size else 0 for ofs, size in zip(offsets, self.sizes)]
                 checksums = [0] * len(offsets)
                 self.compression = values[4]
-                if self.compression:
-                    raise Exception("compression not supported for v910")
+                if self.compression not in self.V910COMPRESSION:
+                    raise Exception("unsupported v910 compression %d" % self.compression)
             else:
                 raise Exception("unknown file version")
 
@@ -398,6 +711,11 @@ class IDBFile(object):
         self.checksums = checksums
         self.fileversion = fileversion
 
+    @cachedproperty
+    def mapping(self):
+        """ a memory map of the entire file, shared by all uncompressed sections """
+        return mapfile(self.fh)
+
     def getsectioninfo(self, i):
         """
         Returns a tuple with section parameters by index.
@@ -416,15 +734,15 @@ class IDBFile(object):
         if self.offsets[i] == 0:
             return 0, 0, 0, 0
 
-        self.fh.seek(self.offsets[i])
         if self.fileversion < 5:
-            comp, size = struct.unpack("<BL", self.fh.read(5))
+            comp, size = struct.unpack("<BL", readat(self.fh, self.offsets[i], 5))
             ofs = self.offsets[i] + 5
         elif self.fileversion == 6:
-            comp, size = struct.unpack("<BQ", self.fh.read(9))
+            comp, size = struct.unpack("<BQ", readat(self.fh, self.offsets[i], 9))
             ofs = self.offsets[i] + 9
         elif self.fileversion == 910:
-            comp = 0
+            # report compressed v910 sections like the zlib compressed sections of older versions
+            comp = self.V910COMPRESSION[self.compression]
             size = self.sizes[i]
             ofs = self.offsets[i]
         else:
@@ -443,13 +761,18 @@ class IDBFile(object):
 
         comp, ofs, size, checksum = self.getsectioninfo(ix)
 
+        if comp == 0 and self.mapping is not None:
+            return MappedSection(self.mapping, ofs, ofs + size)
+
         fh = FileSection(self.fh, ofs, ofs + size)
         if comp == 2:
-            import zlib
             # very old databases used a different compression scheme:
             wbits = -15 if self.magic == 'IDA0' else 15
 
-            fh = makeStringIO(zlib.decompress(fh.read(size), wbits))
+            cached = None
+            if self.sectioncache is not None:
+                cached = self.sectioncache.getpart(self.fh, ix, checksum, fh, wbits)
+            fh = cached or InflatedSection(fh, wbits)
         elif comp == 0:
             pass
         else:
@@ -493,9 +816,9 @@ class RecoverIDBFile:
             return None
         ext = self.id2ext[ix]
         if ext not in self.dbfiles:
-            print("can't find %s" % ext)
+            print("can't find %s" % ext, file=sys.stderr)
             return None
-        return open(self.dbfiles[ext], "rb")
+        return mapsection(open(self.dbfiles[ext], "rb"))
 
     def getsection(self, cls):
         part = self.getpart(cls.INDEX)
@@ -503,6 +826,67 @@ class RecoverIDBFile:
             return cls(self, part)
 
 
+def prefixend(prefix):
+    """
+    Returns the smallest key which is larger than all keys starting with `prefix`,
+    or None when no such key exists.
+    """
+    prefix = prefix.rstrip(b"\xff")
+    if not prefix:
+        return
+    return prefix[:-1] + struct.pack("B", ord(prefix[-1:]) + 1)
+
+
+def diffbtrees(a, b):
+    """
+    Compares the records of two BTrees, in key order.
+
+    Yields a (key, aval, bval) tuple for each difference, with `aval` None
+    for records only in `b`, and `bval` None for records only in `a`.
+
+    When both trees arrive at a leaf page with identical contents, that
+    page is skipped without decoding its records. The trees are walked
+    simultaneously, keeping at most one decoded leaf page per tree in memory.
+    """
+    def units(tree):
+        """ yields the records of `tree`, with leaf pages expanded only when requested through `send` """
+        for unit in tree.walkleaves():
+            if isinstance(unit, tuple):
+                yield unit
+            elif (yield unit):
+                for rec in unit.leafrecords(0, unit.count):
+                    yield rec
+
+    def advance(it, expand=False):
+        try:
+            return it.send(True) if expand else next(it)
+        except StopIteration:
+            return None
+
+    ita, itb = units(a), units(b)
+    ua, ub = advance(ita), advance(itb)
+    while ua is not None or ub is not None:
+        apage = ua is not None and not isinstance(ua, tuple)
+        bpage = ub is not None and not isinstance(ub, tuple)
+        if apage and bpage and ua.data == ub.data:
+            ua, ub = advance(ita), advance(itb)
+        elif apage or bpage:
+            if apage:
+                ua = advance(ita, True)
+            if bpage:
+                ub = advance(itb, True)
+        elif ub is None or (ua is not None and ua[0] < ub[0]):
+            yield ua[0], ua[1], None
+            ua = advance(ita)
+        elif ua is None or ub[0] < ua[0]:
+            yield ub[0], None, ub[1]
+            ub = advance(itb)
+        else:
+            if ua[1] != ub[1]:
+                yield ua[0], ua[1], ub[1]
+            ua, ub = advance(ita), advance(itb)
+
+
 def binary_search(a, k):
     """
     Do a binary search in an array of objects ordered by '.key'
@@ -549,7 +933,11 @@ class BaseIndexEntry(object):
     Index entries have a key + value, and a page containing keys larger than that key
     in this index entry.
 
+    Entries are only constructed when dumping pages, and use __slots__ to limit
+    their memory usage. Lookups use the page's getkey, getval, getpage methods.
     """
+    __slots__ = ('page', 'recofs', 'key', 'val')
+
     def __init__(self, data):
         ofs = self.recofs
         if self.recofs < 6:
@@ -558,9 +946,9 @@ class BaseIndexEntry(object):
             return
 
         keylen, = struct.unpack_from("<H", data, ofs) ; ofs += 2
-        self.key = data[ofs:ofs + keylen]  ; ofs += keylen
+        self.key = tobytes(data[ofs:ofs + keylen])  ; ofs += keylen
         vallen, = struct.unpack_from("<H", data, ofs) ; ofs += 2
-        self.val = data[ofs:ofs + vallen]  ; ofs += vallen
+        self.val = tobytes(data[ofs:ofs + vallen])  ; ofs += vallen
 
     def __repr__(self):
         return "%06x: %s = %s" % (self.page, hexdump(self.key), hexdump(self.val))
@@ -576,6 +964,8 @@ class BaseLeafEntry(BaseIndexEntry):
     usually are very similar.
     The indent specifies the offset where this key is different from the previous key
     """
+    __slots__ = ('indent', 'unknown', 'unknown1')
+
     def __init__(self, key, data):
         """ leaf entries get the previous key a an argument. """
         super(BaseLeafEntry, self).__init__(data)
@@ -599,20 +989,33 @@ class BTree(object):
 
         Leaf pages don't have a 'preceeding' page pointer.
 
+        Only the entry table is decoded when a page is constructed, into the
+        parallel `recofs` and `pages` or `indents` arrays.
+        Keys and values are decoded when requested, so a lookup only
+        decodes the entries visited by the binary search.
+
+        Subclasses specify `indexfmt` and `leaffmt`, the struct format of
+        an entry, with the record offset as the last field, and the
+        page or indent as the first field.
+        `recbias` is added to each record offset.
         """
+        __slots__ = ('data', 'entsize', 'preceeding', 'count', 'recofs', 'pages', 'indents', 'keys', 'unknown', 'freeptr')
+
         def __init__(self, data, entsize, entfmt):
+            self.data = data
+            self.entsize = entsize
             self.preceeding, self.count = struct.unpack_from(entfmt, data)
+
+            fmt = self.indexfmt if self.preceeding else self.leaffmt
+            n = len(fmt)
+            fields = struct.unpack_from("<" + fmt * self.count, data, entsize)
+            self.recofs = array('H', fields[n - 1::n])
             if self.preceeding:
-                entrytype = self.IndexEntry
+                self.pages = array('L', fields[0::n])
             else:
-                entrytype = self.LeafEntry
-
-            self.index = []
-            key = b""
-            for i in range(self.count):
-                ent = entrytype(key, data, entsize * (1 + i))
-                self.index.append(ent)
-                key = ent.key
+                self.indents = array('H', fields[0::n])
+                # leaf keys are decoded at most once
+                self.keys = [None] * self.count
             self.unknown, self.freeptr = struct.unpack_from(entfmt, data, entsize * (1 + self.count))
 
         def find(self, key):
@@ -628,28 +1031,111 @@ class BTree(object):
 
             # for an index entry: the key is 'less' than anything in the page pointed to.
             """
-            i = binary_search(self.index, key)
+            # like binary_search, but only decoding the keys visited.
+            first, last = 0, self.count
+            while first < last:
+                mid = (first + last) >> 1
+                if key < self.getkey(mid):
+                    last = mid
+                else:
+                    first = mid + 1
+            i = first - 1
+
             if i < 0:
                 if self.isindex():
                     return ('recurse', -1)
                 return ('gt', 0)
-            if self.index[i].key == key:
+            if self.getkey(i) == key:
                 return ('eq', i)
             if self.isindex():
                 return ('recurse', i)
             return ('lt', i)
 
+        def storedkey(self, ix):
+            """ returns the key as stored in the page, for leaf pages without the `indent` prefix """
+            ofs = self.recofs[ix] + self.recbias
+            if ofs < 6:
+                # reading an invalid page...
+                return
+            keylen, = struct.unpack_from("<H", self.data, ofs)
+            return tobytes(self.data[ofs + 2:ofs + 2 + keylen])
+
+        def leafprefix(self, ix, size):
+            """
+            returns the first `size` bytes of the key of leaf entry `ix`,
+            only decoding the entries which contribute to that prefix.
+            """
+            parts = []
+            while size > 0 and ix >= 0:
+                key = self.keys[ix]
+                if key is not None:
+                    parts.append(key[:size])
+                    break
+                indent = self.indents[ix]
+                if size > indent:
+                    parts.append(self.storedkey(ix)[:size - indent])
+                    size = indent
+                ix -= 1
+            return b"".join(reversed(parts))
+
+        def leafrecords(self, first, last, keysonly=False):
+            """
+            Returns a list with the keys, or (key, value) tuples, for leaf entries
+            `first` up to `last`, decoded in a single pass over the page.
+            """
+            data = tobytes(self.data)
+            bias, indents, recofs = self.recbias, self.indents, self.recofs
+            unpack = struct.Struct("<H").unpack_from
+            key = self.getkey(first - 1) if first > 0 else b""
+            result = []
+            for i in range(first, last):
+                ofs = recofs[i] + bias
+                keylen, = unpack(data, ofs)
+                ofs += 2 + keylen
+                key = key[:indents[i]] + data[ofs - keylen:ofs]
+                if keysonly:
+                    result.append(key)
+                else:
+                    vallen, = unpack(data, ofs)
+                    result.append((key, data[ofs + 2:ofs + 2 + vallen]))
+            return result
+
         def getpage(self, ix):
             """ For Indexpages, returns the page ptr for the specified entry """
-            return self.preceeding if ix < 0 else self.index[ix].page
+            return self.preceeding if ix < 0 else self.pages[ix]
 
         def getkey(self, ix):
             """ For all page types, returns the key for the specified entry """
-            return self.index[ix].key
+            if self.preceeding:
+                return self.storedkey(ix)
+            key = self.keys[ix]
+            if key is None:
+                key = self.leafprefix(ix - 1, self.indents[ix]) + self.storedkey(ix)
+                self.keys[ix] = key
+            return key
 
         def getval(self, ix):
             """ For all page types, returns the value for the specified entry """
-            return self.index[ix].val
+            ofs = self.recofs[ix] + self.recbias
+            if ofs < 6:
+                return
+            keylen, = struct.unpack_from("<H", self.data, ofs)
+            ofs += 2 + keylen
+            vallen, = struct.unpack_from("<H", self.data, ofs)
+            ofs += 2
+            return tobytes(self.data[ofs:ofs + vallen])
+
+        @property
+        def index(self):
+            """ Returns all entries as objects, used when dumping pages """
+            entrytype = self.IndexEntry if self.preceeding else self.LeafEntry
+            entries = []
+            key = b""
+            for i in range(self.count):
+                ent = entrytype(key, self.data, self.entsize * (1 + i))
+                entries.append(ent)
+                key = ent.key
+            return entries
 
         def isleaf(self):
             """ True when this is a Leaf Page """
@@ -667,53 +1153,80 @@ class BTree(object):
     ######################################################
     class Page15(BasePage):
         """ v1.5 b-tree page """
+        __slots__ = ()
+
         class IndexEntry(BaseIndexEntry):
+            __slots__ = ()
+
             def __init__(self, key, data, ofs):
                 self.page, self.recofs = struct.unpack_from("<HH", data, ofs)
                 self.recofs += 1   # skip unused zero byte in each key/value record
                 super(self.__class__, self).__init__(data)
 
         class LeafEntry(BaseLeafEntry):
+            __slots__ = ()
+
             def __init__(self, key, data, ofs):
                 self.indent, self.unknown, self.recofs = struct.unpack_from("<BBH", data, ofs)
                 self.unknown1 = 0
                 self.recofs += 1   # skip unused zero byte in each key/value record
                 super(self.__class__, self).__init__(key, data)
 
+        indexfmt, leaffmt = "HH", "BBH"
+        recbias = 1   # skip unused zero byte in each key/value record
+
         def __init__(self, data):
             super(self.__class__, self).__init__(data, 4, "<HH")
 
     class Page16(BasePage):
         """ v1.6 b-tree page """
+        __slots__ = ()
+
         class IndexEntry(BaseIndexEntry):
+            __slots__ = ()
+
             def __init__(self, key, data, ofs):
                 self.page, self.recofs = struct.unpack_from("<LH", data, ofs)
                 self.recofs += 1   # skip unused zero byte in each key/value record
                 super(self.__class__, self).__init__(data)
 
         class LeafEntry(BaseLeafEntry):
+            __slots__ = ()
+
             def __init__(self, key, data, ofs):
                 self.indent, self.unknown1, self.unknown, self.recofs = struct.unpack_from("<BBHH", data, ofs)
                 self.recofs += 1   # skip unused zero byte in each key/value record
                 super(self.__class__, self).__init__(key, data)
 
+        indexfmt, leaffmt = "LH", "BBHH"
+        recbias = 1   # skip unused zero byte in each key/value record
+
         def __init__(self, data):
             super(self.__class__, self).__init__(data, 6, "<LH")
 
     class Page20(BasePage):
         """ v2.0 b-tree page """
+        __slots__ = ()
+
         class IndexEntry(BaseIndexEntry):
+            __slots__ = ()
+
             def __init__(self, key, data, ofs):
                 self.page, self.recofs = struct.unpack_from("<LH", data, ofs)
                 # unused zero byte is no longer there in v2.0 b-tree
                 super(self.__class__, self).__init__(data)
 
         class LeafEntry(BaseLeafEntry):
+            __slots__ = ()
+
             def __init__(self, key, data, ofs):
                 self.indent, self.unknown, self.recofs = struct.unpack_from("<HHH", data, ofs)
                 self.unknown1 = 0
                 super(self.__class__, self).__init__(key, data)
 
+        indexfmt, leaffmt = "LH", "HHH"
+        recbias = 0   # unused zero byte is no longer there in v2.0 b-tree
+
         def __init__(self, data):
             super(self.__class__, self).__init__(data, 6, "<LH")
 
@@ -736,10 +1249,10 @@ class BTree(object):
             if page.isleaf():
                 # from leaf move towards root
                 ix += 1
-                while self.stack and ix == len(page.index):
+                while self.stack and ix == page.count:
                     page, ix = self.stack.pop()
                     ix += 1
-                if ix < len(page.index):
+                if ix < page.count:
                     self.stack.append((page, ix))
             else:
                 # from node move towards leaf
@@ -767,7 +1280,7 @@ class BTree(object):
                 self.stack.append((page, ix))
                 while page.isindex():
                     page = self.db.readpage(page.getpage(ix))
-                    ix = len(page.index) - 1
+                    ix = page.count - 1
                     self.stack.append((page, ix))
 
         def eof(self):
@@ -786,9 +1299,13 @@ class BTree(object):
         def __repr__(self):
             return "cursor:" + repr(self.stack)
 
-    def __init__(self, fh):
+    # default number of parsed pages kept by `readpage`, 0 disables the page cache.
+    cachesize = 1024
+
+    def __init__(self, fh, cachesize=None):
         """ BTree constructor - takes a filehandle """
         self.fh = fh
+        self.cache = LRUCache(self.cachesize if cachesize is None else cachesize)
 
         self.fh.seek(0)
         data = self.fh.read(64)
@@ -806,7 +1323,7 @@ class BTree(object):
             self.page = self.Page20
             self.version = 20
         else:
-            print("unknown btree: %s" % hexdump(data))
+            print("unknown btree: %s" % hexdump(data), file=sys.stderr)
             raise Exception("unknown b-tree")
 
     def parseheader15(self, data):
@@ -817,8 +1334,18 @@ class BTree(object):
         self.firstfree, self.pagesize, self.firstindex, self.reccount, self.pagecount = struct.unpack_from("<LHLLL", data, 0)
 
     def readpage(self, nr):
-        self.fh.seek(nr * self.pagesize)
-        return self.page(self.fh.read(self.pagesize))
+        """
+        Returns the parsed page `nr`, from the page cache when possible.
+        The root page is pinned in the cache, since every `find` starts there.
+        """
+        page = self.cache.get(nr)
+        if page is None:
+            page = self.page(readat(self.fh, nr * self.pagesize, self.pagesize))
+            if nr == self.firstindex:
+                self.cache.pin(nr, page)
+            else:
+                self.cache.put(nr, page)
+        return page
 
     def find(self, rel, key):
         """
@@ -867,25 +1394,131 @@ class BTree(object):
 
         return cursor
 
-    def dump(self):
+    def scan(self, start=None, end=None, reverse=False, keysonly=False):
+        """
+        Enumerates all records with `start` <= key < `end`, in ascending order,
+        or in descending order when `reverse` is set.
+        Omitting `start` or `end` leaves that side of the range open.
+
+        Yields (key, value) tuples, or only keys when `keysonly` is set.
+
+        Unlike repeated calls to Cursor.next, this loops over the entries of
+        each leaf page directly, and only touches the stack when moving between pages.
+        """
+        if reverse:
+            return self.scanbackward(start, end, keysonly)
+        return self.scanforward(start, end, keysonly)
+
+    def descend(self, stack, pn, last):
+        """ push the path to the first or last record below page `pn` on the stack """
+        page = self.readpage(pn)
+        while page.isindex():
+            ix = page.count - 1 if last else -1
+            stack.append((page, ix))
+            page = self.readpage(page.getpage(ix))
+        stack.append((page, page.count - 1 if last else 0))
+
+    def scanforward(self, start, end, keysonly):
+        stack = self.find('ge', start or b'').stack
+        while stack:
+            page, ix = stack.pop()
+            if page.isleaf():
+                for rec in page.leafrecords(ix, page.count, keysonly):
+                    if end is not None and (rec if keysonly else rec[0]) >= end:
+                        return
+                    yield rec
+
+                # move towards the root, to the next index entry
+                while stack:
+                    page, ix = stack.pop()
+                    if ix + 1 < page.count:
+                        stack.append((page, ix + 1))
+                        break
+            else:
+                # positioned on an index entry, after which the subtree follows
+                key = page.getkey(ix)
+                if end is not None and key >= end:
+                    return
+                yield key if keysonly else (key, page.getval(ix))
+
+                stack.append((page, ix))
+                self.descend(stack, page.getpage(ix), False)
+
+    def scanbackward(self, start, end, keysonly):
+        if end is None:
+            stack = []
+            self.descend(stack, self.firstindex, True)
+        else:
+            stack = self.find('lt', end).stack
+        while stack:
+            page, ix = stack.pop()
+            if page.isleaf():
+                for rec in reversed(page.leafrecords(0, ix + 1, keysonly)):
+                    if start is not None and (rec if keysonly else rec[0]) < start:
+                        return
+                    yield rec
+
+                # move towards the root, to the previous index entry
+                while stack:
+                    page, ix = stack.pop()
+                    if ix >= 0:
+                        stack.append((page, ix))
+                        break
+            else:
+                # positioned on an index entry, preceeded by the subtree of the previous entry
+                key = page.getkey(ix)
+                if start is not None and key < start:
+                    return
+                yield key if keysonly else (key, page.getval(ix))
+
+                stack.append((page, ix - 1))
+                self.descend(stack, page.getpage(ix - 1), True)
+
+    def walkleaves(self):
+        """
+        Enumerates the entire tree in key order, yielding each leaf page as
+        a page object, and the records stored in index pages as (key, value) tuples.
+
+        This allows comparing entire leaf pages, see `diffbtrees`.
+        """
+        stack = []
+        self.descend(stack, self.firstindex, False)
+        while stack:
+            page, ix = stack.pop()
+            if page.isleaf():
+                yield page
+
+                # move towards the root, to the next index entry
+                while stack:
+                    page, ix = stack.pop()
+                    if ix + 1 < page.count:
+                        stack.append((page, ix + 1))
+                        break
+            else:
+                yield page.getkey(ix), page.getval(ix)
+
+                stack.append((page, ix))
+                self.descend(stack, page.getpage(ix), False)
+
+    def dump(self, file=None):
         """ raw dump of all records in the b-tree """
-        print("pagesize=%08x, reccount=%08x, pagecount=%08x" % (self.pagesize, self.reccount, self.pagecount))
-        self.dumpfree()
-        self.dumptree(self.firstindex)
+        print("pagesize=%08x, reccount=%08x, pagecount=%08x" % (self.pagesize, self.reccount, self.pagecount), file=file)
+        self.dumpfree(file)
+        self.dumptree(self.firstindex, file)
 
-    def dumpfree(self):
+    def dumpfree(self, file=None):
         """ list all free pages """
         fmt = "L" if self.version > 15 else "H"
         hdrsize = 8 if self.version > 15 else 4
         pn = self.firstfree
         if pn == 0:
-            print("no free pages")
+            print("no free pages", file=file)
             return
         while pn:
             self.fh.seek(pn * self.pagesize)
             data = self.fh.read(self.pagesize)
             if len(data) == 0:
-                print("could not read FREE data at page %06x" % pn)
+                print("could not read FREE data at page %06x" % pn, file=file)
                 break
             count, nextfree = struct.unpack_from("<" + (fmt * 2), data)
             freepages = list(struct.unpack_from("<" + (fmt * count), data, hdrsize))
@@ -893,38 +1526,39 @@ class BTree(object):
             for pn in freepages:
                 self.fh.seek(pn * self.pagesize)
                 data = self.fh.read(self.pagesize)
-                print("%06x: free: %s" % (pn, hexdump(data[:64])))
+                print("%06x: free: %s" % (pn, hexdump(data[:64])), file=file)
             pn = nextfree
 
-    def dumpindented(self, pn, indent=0):
+    def dumpindented(self, pn, indent=0, file=None):
         """
         Dump all nodes of the current page with keys indented, showing how the `indent`
         feature works
         """
         page = self.readpage(pn)
-        print("  " * indent, page)
+        print("  " * indent, page, file=file)
         if page.isindex():
-            print("  " * indent, end="")
-            self.dumpindented(page.preceeding, indent + 1)
-            for p in range(len(page.index)):
-                print("  " * indent, end="")
-                self.dumpindented(page.getpage(p), indent + 1)
+            print("  " * indent, end="", file=file)
+            self.dumpindented(page.preceeding, indent + 1, file)
+            for p in range(page.count):
+                print("  " * indent, end="", file=file)
+                self.dumpindented(page.getpage(p), indent + 1, file)
 
-    def dumptree(self, pn):
+    def dumptree(self, pn, file=None):
         """
         Walks entire tree, dumping all records on each page
         in sequential order
         """
         page = self.readpage(pn)
-        print("%06x: preceeding = %06x, reccount = %04x" % (pn, page.preceeding, page.count))
-        for ent in page.index:
-            print("    %s" % ent)
+        print("%06x: preceeding = %06x, reccount = %04x" % (pn, page.preceeding, page.count), file=file)
+        entries = page.index
+        for ent in entries:
+            print("    %s" % ent, file=file)
         if page.preceeding:
-            self.dumptree(page.preceeding)
-            for ent in page.index:
-                self.dumptree(ent.page)
+            self.dumptree(page.preceeding, file)
+            for ent in entries:
+                self.dumptree(ent.page, file)
 
-    def pagedump(self):
+    def pagedump(self, file=None):
         """
         dump the contents of all pages, ignoring links between pages,
         this will enable you to view contents of pages which have become
@@ -938,21 +1572,55 @@ class BTree(object):
                 if len(pagedata) == 0:
                     break
                 elif len(pagedata) != self.pagesize:
-                    print("%06x: incomplete - %d bytes ( pagesize = %d )" % (pn, len(pagedata), self.pagesize))
+                    print("%06x: incomplete - %d bytes ( pagesize = %d )" % (pn, len(pagedata), self.pagesize), file=file)
                     break
                 elif pagedata == b'\x00' * self.pagesize:
-                    print("%06x: empty" % (pn))
+                    print("%06x: empty" % (pn), file=file)
                 else:
                     page = self.page(pagedata)
 
-                    print("%06x: preceeding = %06x, reccount = %04x" % (pn, page.preceeding, page.count))
+                    print("%06x: preceeding = %06x, reccount = %04x" % (pn, page.preceeding, page.count), file=file)
                     for ent in page.index:
-                        print("    %s" % ent)
+                        print("    %s" % ent, file=file)
             except Exception as e:
-                print("%06x: ERROR decoding as B-tree page: %s" % (pn, e))
+                print("%06x: ERROR decoding as B-tree page: %s" % (pn, e), file=file)
             pn += 1
 
 
+class NodeRecords(object):
+    """
+    All records of a single node, as returned by `ID0File.noderecords`.
+
+    Records are looked up by tag and index, like with the ID0File methods,
+    negative indices are converted to their unsigned value.
+    """
+    def __init__(self, id0, nodeid, records):
+        self.id0 = id0
+        self.nodeid = nodeid
+        # (tag, index) -> value
+        self.records = records
+
+    def bytes(self, tag, ix=None):
+        if type(ix) in (int, long):
+            ix &= (1 << (8 * self.id0.wordsize)) - 1
+        elif ix is not None and not isinstance(ix, type(b'')):
+            ix = ix.encode('utf-8')
+        return self.records.get((tag, ix))
+
+    def int(self, tag, ix=None):
+        return self.id0.decodeint(self.bytes(tag, ix))
+
+    def string(self, tag, ix=None):
+        return self.id0.decodestring(self.bytes(tag, ix))
+
+    def name(self):
+        """ decodes the name record, `ID0File.name` does the same, using the name cache """
+        return self.id0.decodename(self.nodeid, self.bytes('N'))
+
+    def __len__(self):
+        return len(self.records)
+
+
 class ID0File(object):
     """
     Reads .id0 or 0.ida  files, containing a v1.5, v1.6 or v2.0 b-tree database.
@@ -984,9 +1652,22 @@ class ID0File(object):
     """
     INDEX = 0
 
+    # default number of names kept by `nodeByName` and `name`, 0 disables these caches.
+    namecachesize = 4096
+    # nr of records `names` steps over, before looking up the next name record in the tree.
+    namescansteps = 16
+    # default number of record maps kept by `noderecords`, 0 disables the cache.
+    recordcachesize = 1024
+
     def __init__(self, idb, fh):
         self.btree = BTree(fh)
 
+        # name -> nodeid, and nodeid -> name
+        self.nodecache = LRUCache(self.namecachesize)
+        self.namecache = LRUCache(self.namecachesize)
+        # nodeid -> NodeRecords
+        self.recordcache = LRUCache(self.recordcachesize)
+
         self.wordsize = None
         self.maxnode = None
 
@@ -1003,7 +1684,7 @@ class ID0File(object):
                 self.wordsize = len(c.getval())
 
         if self.wordsize not in (4, 8):
-            print("Can not determine wordsize for database - assuming 32 bit")
+            print("Can not determine wordsize for database - assuming 32 bit", file=sys.stderr)
             self.wordsize = 4
 
         if self.wordsize == 4:
@@ -1090,6 +1771,10 @@ class ID0File(object):
 
     def nodeByName(self, name):
         """ Return a nodeid by name """
+        return self.nodecache.fetch(name, self.lookupnode)
+
+    def lookupnode(self, name):
+        """ Return a nodeid by name, bypassing the cache """
         # note: really long names are encoded differently:
         #  'N'+'\x00'+pack('Q', nameid)  => ofs
         #  and  (ofs, 'N') -> nameid
@@ -1173,7 +1858,10 @@ class ID0File(object):
         Any type of integer will be decoded: byte, short, long, long long
 
         """
-        data = self.bytes(*args)
+        return self.decodeint(self.bytes(*args))
+
+    def decodeint(self, data):
+        """ decode a byte, short, long or long long value """
         if data is not None:
             if len(data) == 1:
                 return struct.unpack("<B", data)[0]
@@ -1183,11 +1871,14 @@ class ID0File(object):
                 return struct.unpack("<L", data)[0]
             if len(data) == 8:
                 return struct.unpack("<Q", data)[0]
-            print("can't get int from %s" % hexdump(data))
+            print("can't get int from %s" % hexdump(data), file=sys.stderr)
 
     def string(self, *args):
         """ return string stored in node """
-        data = self.bytes(*args)
+        return self.decodestring(self.bytes(*args))
+
+    def decodestring(self, data):
+        """ decode a zero terminated string value """
         if data is not None:
             return data.rstrip(b"\x00").decode('utf-8')
 
@@ -1195,9 +1886,16 @@ class ID0File(object):
         """
         resolves a name, both short and long names.
         """
-        data = self.bytes(id, 'N')
+        return self.namecache.fetch(id, self.lookupname)
+
+    def lookupname(self, id):
+        """ resolves a name, bypassing the cache """
+        return self.decodename(id, self.bytes(id, 'N'))
+
+    def decodename(self, id, data):
+        """ decodes the value of a (id, 'N') record, resolving long names """
         if not data:
-            print("%x has no name" % id)
+            print("%x has no name" % id, file=sys.stderr)
             return
         if data[:1] == b'\x00':
             nameid, = struct.unpack_from(">" + self.fmt, data, 1)
@@ -1205,6 +1903,37 @@ class ID0File(object):
             return nameblob.rstrip(b"\x00").decode('utf-8')
         return data.rstrip(b"\x00").decode('utf-8')
 
+    def names(self, eas):
+        """
+        Resolves the names for a sequence of addresses, like returned by NAMFile.allnames.
+
+        Yields (ea, name) tuples.
+
+        Names are taken from the name cache when possible. Otherwise the (ea, 'N') record
+        is found by stepping a few records from the previous one, and only when the
+        next name record is further away with a new tree lookup. So this is fastest
+        when `eas` is sorted.
+        """
+        # a cursor at the record following the previous name record
+        state = dict(cursor=None, prevea=None)
+
+        def lookup(ea):
+            namekey = self.makekey(ea, 'N')
+            c = state['cursor']
+            if c is not None and ea >= state['prevea']:
+                for _ in range(self.namescansteps):
+                    if c.eof() or c.getkey() >= namekey:
+                        break
+                    c.next()
+            if c is None or ea < state['prevea'] or (not c.eof() and c.getkey() < namekey):
+                c = state['cursor'] = self.btree.find('ge', namekey)
+            state['prevea'] = ea
+
+            return self.decodename(ea, c.getval() if not c.eof() and c.getkey() == namekey else None)
+
+        for ea in eas:
+            yield ea, self.namecache.fetch(ea, lookup)
+
     def blob(self, nodeid, tag, start=0, end=0xFFFFFFFF):
         """
         Blobs are stored in sequential nodes
@@ -1217,12 +1946,83 @@ class ID0File(object):
         """
         startkey = self.makekey(nodeid, tag, start)
         endkey = self.makekey(nodeid, tag, end)
-        cur = self.btree.find('ge', startkey)
-        data = b''
-        while cur.getkey() <= endkey:
-            data += cur.getval()
-            cur.next()
-        return data
+        # the smallest key after `endkey` is endkey + NUL
+        return b''.join(val for key, val in self.btree.scan(startkey, endkey + b'\x00'))
+
+    def range(self, nodeid, tag, lo=None, hi=None):
+        """
+        Enumerates the records for `nodeid` and `tag`, with lo <= index < hi.
+        Omitting `lo` or `hi` leaves that side of the range open.
+
+        Yields (index, value) tuples, where index is an integer, the key string
+        for string indexed records, or None for the record without index.
+        """
+        prefix = self.makekey(nodeid, tag)
+        start = prefix if lo is None else self.makekey(nodeid, tag, lo)
+        end = prefixend(prefix) if hi is None else self.makekey(nodeid, tag, hi)
+
+        n = len(prefix)
+        for key, val in self.btree.scan(start, end):
+            yield self.decodeindex(key[n:]), val
+
+    def decodeindex(self, ix):
+        """ decodes the index part of a key: an integer, a string index, or None for no index """
+        if len(ix) == self.wordsize:
+            ix, = struct.unpack(">" + self.fmt, ix)
+        elif not ix:
+            ix = None
+        return ix
+
+    # the tags loaded by `noderecords`: the attributes, name and strings of a node,
+    # not the potentially large lists, like xrefs or enum members.
+    NODERECORDTAGS = ('A', 'N', 'S')
+
+    def noderecords(self, nodeid):
+        """
+        Returns a NodeRecords object with the A, N and S records of `nodeid`,
+        read with a scan per tag.
+
+        Useful when several attributes of a node are needed, like for structs and enums.
+        """
+        return self.recordcache.fetch(nodeid, self.readnoderecords)
+
+    def readnoderecords(self, nodeid):
+        """ reads the A, N and S records of `nodeid`, bypassing the cache """
+        records = dict()
+        for tag in self.NODERECORDTAGS:
+            for ix, val in self.range(nodeid, tag):
+                records[tag, ix] = val
+        return NodeRecords(self, nodeid, records)
+
+    def scannoderecords(self, nodeid):
+        """
+        Reads the A, N and S records of `nodeid` with a single scan from its first A
+        up to its last S record, skipping the other tags, bypassing the cache.
+
+        Only for small nodes, like struct members: for other nodes the scan would
+        walk large lists, like the E records of an enum.
+        """
+        records = dict()
+        n = len(self.makekey(nodeid))
+        for key, val in self.btree.scan(self.makekey(nodeid, 'A'), prefixend(self.makekey(nodeid, 'S'))):
+            tag = key[n:n + 1].decode('utf-8')
+            if tag in self.NODERECORDTAGS:
+                records[tag, self.decodeindex(key[n + 1:])] = val
+        return NodeRecords(self, nodeid, records)
+
+    def prefix(self, keyprefix):
+        """
+        Enumerates all records with a key starting with `keyprefix`.
+
+        Yields (key, value) tuples.
+        """
+        if not isinstance(keyprefix, type(b'')):
+            keyprefix = keyprefix.encode('utf-8')
+        return self.btree.scan(keyprefix, prefixend(keyprefix))
+
+
+# array typecode for 32 bit unsigned flag words
+FLAGSTYPE = 'I' if array('I').itemsize == 4 else 'L'
 
 
 class ID1File(object):
@@ -1261,9 +2061,9 @@ class ID1File(object):
         elif magic == b'VA*\x00':
             always3, nsegments, always2k, npages = struct.unpack_from("<LLLL", hdrdata, 4)
             if always3 != 3:
-                print("ID1: first dword != 3: %08x" % always3)
+                print("ID1: first dword != 3: %08x" % always3, file=sys.stderr)
             if always2k != 0x800:
-                print("ID1: third dword != 2k: %08x" % always2k)
+                print("ID1: third dword != 2k: %08x" % always2k, file=sys.stderr)
             seglistofs = 20
             seginfosize = 2
         else:
@@ -1286,61 +2086,166 @@ class ID1File(object):
                 self.seglist.append(self.SegInfo(startea, endea, id1ofs))
                 id1ofs += 4 * (endea - startea)
 
+        self.makesegindex()
+
+    def makesegindex(self):
+        """
+        Sort the segment list by address, and create the parallel start/end/offset
+        lists used for bisecting the segment containing an address.
+        """
+        self.seglist.sort(key=lambda seg: seg.startea)
+        self.segstarts = [seg.startea for seg in self.seglist]
+        self.segends = [seg.endea for seg in self.seglist]
+        self.segoffsets = [seg.offset for seg in self.seglist]
+        # index of the most recently found segment, for sequential lookups.
+        self.lastseg = 0
+
     def is32bit_heuristic(self, fh, seglistofs):
         fh.seek(seglistofs)
         # todo: verify wordsize using the following heuristic:
         #  L -> starting at: seglistofs + nsegs*seginfosize  are all zero
         #  L -> starting at seglistofs .. nsegs*seginfosize every even word must be unique
 
-    def dump(self):
+    def dump(self, file=None):
         """ print first and last bits for each segment """
+        def dumprange(a, b):
+            for ea, flags in zip(range(a, b), self.getFlagsRange(a, b)):
+                print("    %08x: %08x" % (ea, flags), file=file)
+
         for seg in self.seglist:
-            print("==== %08x-%08x" % (seg.startea, seg.endea))
+            print("==== %08x-%08x" % (seg.startea, seg.endea), file=file)
             if seg.endea - seg.startea < 30:
-                for ea in range(seg.startea, seg.endea):
-                    print("    %08x: %08x" % (ea, self.getFlags(ea)))
+                dumprange(seg.startea, seg.endea)
             else:
-                for ea in range(seg.startea, seg.startea + 10):
-                    print("    %08x: %08x" % (ea, self.getFlags(ea)))
-                print("...")
-                for ea in range(seg.endea - 10, seg.endea):
-                    print("    %08x: %08x" % (ea, self.getFlags(ea)))
+                dumprange(seg.startea, seg.startea + 10)
+                print("...", file=file)
+                dumprange(seg.endea - 10, seg.endea)
+
+    def segindex(self, ea):
+        """
+        Returns the index of the segment containing `ea`, or None.
+        The last found segment is checked first, before bisecting the segment list.
+        """
+        i = self.lastseg
+        if i < len(self.segstarts) and self.segstarts[i] <= ea < self.segends[i]:
+            return i
+        i = bisect.bisect_right(self.segstarts, ea) - 1
+        if i >= 0 and ea < self.segends[i]:
+            self.lastseg = i
+            return i
+
+    def segrange(self, start, end):
+        """ Returns the segments which could overlap start <= ea < end """
+        first = max(0, bisect.bisect_right(self.segstarts, start) - 1)
+        return self.seglist[first:bisect.bisect_left(self.segstarts, end)]
 
     def find_segment(self, ea):
-        """ do a linear search for the given address in the segment list """
-        for seg in self.seglist:
-            if seg.startea <= ea < seg.endea:
-                return seg
+        """ find the segment containing the given address """
+        i = self.segindex(ea)
+        if i is not None:
+            return self.seglist[i]
 
     def getFlags(self, ea):
-        seg = self.find_segment(ea)
-        if not seg:
+        i = self.segindex(ea)
+        if i is None:
             return 0
-        self.fh.seek(seg.offset + 4 * (ea - seg.startea))
-        return struct.unpack("<L", self.fh.read(4))[0]
+        ofs = self.segoffsets[i] + 4 * (ea - self.segstarts[i])
+        return struct.unpack_from("<L", readat(self.fh, ofs, 4))[0]
+
+    def readflags(self, ofs, count):
+        """ read the raw little endian flag words for `count` addresses starting at file offset `ofs` """
+        data = readat(self.fh, ofs, 4 * count)
+        # ignore a truncated last word
+        return data[:len(data) & ~3]
+
+    def getFlagsRange(self, start, end, usenumpy=False):
+        """
+        Returns the flags for all addresses in the range start <= ea < end,
+        reading each overlapping segment slice with a single read.
+
+        Addresses outside of any segment have flags 0.
+
+        The result is an array('I'), or a numpy uint32 array when `usenumpy`
+        is set and numpy is available.
+        """
+        count = max(0, end - start)
+        np = None
+        if usenumpy:
+            try:
+                import numpy as np
+            except ImportError:
+                pass
+        if np:
+            flags = np.zeros(count, dtype=np.uint32)
+        else:
+            flags = array(FLAGSTYPE, [0]) * count
+
+        for seg in self.segrange(start, end):
+            lo = max(start, seg.startea)
+            hi = min(end, seg.endea)
+            if lo >= hi:
+                continue
+            data = self.readflags(seg.offset + 4 * (lo - seg.startea), hi - lo)
+            if np:
+                chunk = np.frombuffer(data, dtype='<u4')
+            else:
+                chunk = array(FLAGSTYPE, tobytes(data))
+                if sys.byteorder == 'big':
+                    chunk.byteswap()
+            flags[lo - start:lo - start + len(chunk)] = chunk
+
+        return flags
+
+    def iterBytes(self, start, end, chunksize=0x100000):
+        """
+        Yields the byte values for the range start <= ea < end, as a sequence
+        of bytes objects of at most `chunksize` bytes.
+
+        The bytes are extracted from the flag words in bulk, by taking every
+        4th byte of the little endian words as read from the file.
+        Addresses outside of any segment yield zero bytes.
+        """
+        def zeros(n):
+            for ofs in range(0, n, chunksize):
+                yield b"\x00" * min(chunksize, n - ofs)
+
+        ea = start
+        for seg in self.segrange(start, end):
+            lo = max(ea, seg.startea)
+            hi = min(end, seg.endea)
+            if lo >= hi:
+                continue
+            for chunk in zeros(lo - ea):
+                yield chunk
+            for a in range(lo, hi, chunksize):
+                n = min(hi, a + chunksize) - a
+                data = self.readflags(seg.offset + 4 * (a - seg.startea), n)
+                chunk = tobytes(data)[0::4]
+                yield chunk
+                # pad a truncated segment
+                for chunk in zeros(n - len(chunk)):
+                    yield chunk
+            ea = hi
+        for chunk in zeros(end - ea):
+            yield chunk
 
     def firstSeg(self):
         return self.seglist[0].startea
 
     def nextSeg(self, ea):
-        for i, seg in enumerate(self.seglist):
-            if seg.startea <= ea < seg.endea:
-                if i + 1 < len(self.seglist):
-                    return self.seglist[i + 1].startea
-                else:
-                    return
+        i = self.segindex(ea)
+        if i is not None and i + 1 < len(self.segstarts):
+            return self.segstarts[i + 1]
 
     def segStart(self, ea):
-        seg = self.find_segment(ea)
-        if not seg:
-            return
-        return seg.startea
+        i = self.segindex(ea)
+        if i is not None:
+            return self.segstarts[i]
 
     def segEnd(self, ea):
-        seg = self.find_segment(ea)
-        if not seg:
-            return
-        return seg.endea
+        i = self.segindex(ea)
+        if i is not None:
+            return self.segends[i]
 
 
 class NAMFile(object):
@@ -1361,14 +2266,14 @@ class NAMFile(object):
         # Va1  - ida v3.6
         if magic in (b'Va4\x00', b'Va3\x00', b'Va2\x00', b'Va1\x00', b'Va0\x00'):
             always1, npages, always0, nnames, pagesize = struct.unpack_from("<HH" + fmt + fmt + "L", hdrdata, 4)
-            if always1 != 1: print("nam: first hw = %d" % always1)
-            if always0 != 0: print("nam: third dw = %d" % always0)
+            if always1 != 1: print("nam: first hw = %d" % always1, file=sys.stderr)
+            if always0 != 0: print("nam: third dw = %d" % always0, file=sys.stderr)
         elif magic == b'VA*\x00':
             always3, always1, always2k, npages, always0, nnames = struct.unpack_from("<LLLL" + fmt + "L", hdrdata, 4)
-            if always3 != 3: print("nam: 3 hw = %d" % always3)
-            if always1 != 1: print("nam: 1 hw = %d" % always1)
-            if always0 != 0: print("nam: 0 dw = %d" % always0)
-            if always2k != 0x800: print("nam: 2k dw = %d" % always2k)
+            if always3 != 3: print("nam: 3 hw = %d" % always3, file=sys.stderr)
+            if always1 != 1: print("nam: 1 hw = %d" % always1, file=sys.stderr)
+            if always0 != 0: print("nam: 0 dw = %d" % always0, file=sys.stderr)
+            if always2k != 0x800: print("nam: 2k dw = %d" % always2k, file=sys.stderr)
             pagesize = 0x2000
         else:
             raise Exception("unknown nam magic: %s" % hexdump(magic))
@@ -1379,14 +2284,15 @@ class NAMFile(object):
         self.nnames = nnames
         self.pagesize = pagesize
 
-    def dump(self):
-        print("nam: nnames=%d, npages=%d, pagesize=%08x" % (self.nnames, self.npages, self.pagesize))
+    def dump(self, file=None):
+        print("nam: nnames=%d, npages=%d, pagesize=%08x" % (self.nnames, self.npages, self.pagesize), file=file)
 
     def allnames(self):
-        self.fh.seek(self.pagesize)
         n = 0
+        ofs = self.pagesize
         while n < self.nnames:
-            data = self.fh.read(self.pagesize)
+            data = readat(self.fh, ofs, self.pagesize)
+            ofs += self.pagesize
             want = min(self.nnames - n, int(self.pagesize / self.wordsize))
             ofslist = struct.unpack_from("<%d%s" % (want, self.wordfmt), data, 0)
             for ea in ofslist:
@@ -1458,17 +2364,44 @@ class Struct:
         @cachedproperty
         def name(self): return self._id0.name(self._nodeid)
         @cachedproperty
-        def enumid(self): return self._id0.int(self._nodeid, 'A', 11)
+        def enumid(self): return self.records.int('A', 11)
         @cachedproperty
-        def stringtype(self): return self._id0.int(self._nodeid, 'A', 16)
+        def stringtype(self): return self.records.int('A', 16)
         @cachedproperty
-        def structid(self): return self._id0.int(self._nodeid, 'A', 3)
+        def structid(self): return self.records.int('A', 3)
         @cachedproperty
-        def comment(self, repeatable): return self._id0.string(self._nodeid, 'S', 1 if repeatable else 0)
+        def ptrinfo(self): return self.records.bytes('S', 9)
         @cachedproperty
-        def ptrinfo(self): return self._id0.bytes(self._nodeid, 'S', 9)
+        def typeinfo(self): return self.records.bytes('S', 0x3000)
         @cachedproperty
-        def typeinfo(self): return self._id0.bytes(self._nodeid, 'S', 0x3000)
+        def records(self): return self._id0.noderecords(self._nodeid)
+
+        def comment(self, repeatable=False):
+            """ returns the regular or the repeatable comment """
+            return self.records.string('S', 1 if repeatable else 0)
+
+        def prefetch(self):
+            """
+            Reads the records of the member node with a single scan, the attributes are
+            then decoded from these, instead of a tree lookup per attribute.
+
+            This bypasses the `noderecords` cache, which would only be churned
+            by the members of large structs. The name is added to the name cache.
+            """
+            self._records = self._id0.scannoderecords(self._nodeid)
+            self._name = self._id0.namecache.fetch(self._nodeid, lambda nodeid: self._records.name())
+
+    @classmethod
+    def load(cls, id0, nodeid, prefetch=True):
+        """
+        Returns the Struct for `nodeid`, when `prefetch` is set, the member attributes
+        are read at once for each member, see `Member.prefetch`.
+        """
+        s = cls(id0, nodeid)
+        if prefetch:
+            for m in s.members:
+                m.prefetch()
+        return s
 
     def __init__(self, id0, nodeid):
         self._id0 = id0
@@ -1497,10 +2430,14 @@ class Struct:
         while not p.eof():
             self.extra.append(p.next32())
 
-    @cachedproperty
-    def comment(self, repeatable): return self._id0.string(self._nodeid, 'S', 1 if repeatable else 0)
     @cachedproperty
     def name(self): return self._id0.name(self._nodeid)
+    @cachedproperty
+    def records(self): return self._id0.noderecords(self._nodeid)
+
+    def comment(self, repeatable=False):
+        """ returns the regular or the repeatable comment """
+        return self.records.string('S', 1 if repeatable else 0)
 
     def __iter__(self):
         for m in self.members:
@@ -1528,38 +2465,42 @@ class Enum:
             self._nodeid = nodeid
 
         @cachedproperty
-        def value(self): return self._id0.int(self._nodeid, 'A', -3)
-        @cachedproperty
-        def comment(self, repeatable): return self._id0.string(self._nodeid, 'S', 1 if repeatable else 0)
+        def value(self): return self.records.int('A', -3)
         @cachedproperty
         def name(self): return self._id0.name(self._nodeid)
+        @cachedproperty
+        def records(self): return self._id0.noderecords(self._nodeid)
+
+        def comment(self, repeatable=False):
+            """ returns the regular or the repeatable comment """
+            return self.records.string('S', 1 if repeatable else 0)
 
     def __init__(self, id0, nodeid):
         self._id0 = id0
         self._nodeid = nodeid
 
     @cachedproperty
-    def count(self): return self._id0.int(self._nodeid, 'A', -1)
+    def count(self): return self.records.int('A', -1)
     @cachedproperty
-    def representation(self): return self._id0.int(self._nodeid, 'A', -3)
+    def representation(self): return self.records.int('A', -3)
 
     # flags>>3 -> width
     # flags&1 -> bitfield
     @cachedproperty
-    def flags(self): return self._id0.int(self._nodeid, 'A', -5)
+    def flags(self): return self.records.int('A', -5)
 
-    @cachedproperty
-    def comment(self, repeatable): return self._id0.string(self._nodeid, 'S', 1 if repeatable else 0)
     @cachedproperty
     def name(self): return self._id0.name(self._nodeid)
+    @cachedproperty
+    def records(self): return self._id0.noderecords(self._nodeid)
+
+    def comment(self, repeatable=False):
+        """ returns the regular or the repeatable comment """
+        return self.records.string('S', 1 if repeatable else 0)
 
     def __iter__(self):
-        startkey = self._id0.makekey(self._nodeid, 'E')
-        endkey = self._id0.makekey(self._nodeid, 'F')
-        cur = self._id0.btree.find('ge', startkey)
-        while cur.getkey() < endkey:
-            yield Enum.Member(self._id0, self._id0.int(cur) - 1)
-            cur.next()
+        for value, member in self._id0.range(self._nodeid, 'E'):
+            yield Enum.Member(self._id0, self._id0.decodeint(member) - 1)
 
 
 class Bitfield:
@@ -1569,13 +2510,17 @@ class Bitfield:
             self._nodeid = nodeid
 
         @cachedproperty
-        def value(self): return self._id0.int(self._nodeid, 'A', -3)
-        @cachedproperty
-        def mask(self): return self._id0.int(self._nodeid, 'A', -6) - 1
+        def value(self): return self.records.int('A', -3)
         @cachedproperty
-        def comment(self, repeatable): return self._id0.string(self._nodeid, 'S', 1 if repeatable else 0)
+        def mask(self): return self.records.int('A', -6) - 1
         @cachedproperty
         def name(self): return self._id0.name(self._nodeid)
+        @cachedproperty
+        def records(self): return self._id0.noderecords(self._nodeid)
+
+        def comment(self, repeatable=False):
+            """ returns the regular or the repeatable comment """
+            return self.records.string('S', 1 if repeatable else 0)
 
     class Mask:
         def __init__(self, id0, nodeid, mask):
@@ -1583,21 +2528,21 @@ class Bitfield:
             self._nodeid = nodeid
             self.mask = mask
 
-        @cachedproperty
-        def comment(self, repeatable): return self._id0.string(self._nodeid, 'S', 1 if repeatable else 0)
         @cachedproperty
         def name(self): return self._id0.name(self._nodeid)
+        @cachedproperty
+        def records(self): return self._id0.noderecords(self._nodeid)
+
+        def comment(self, repeatable=False):
+            """ returns the regular or the repeatable comment """
+            return self.records.string('S', 1 if repeatable else 0)
 
         def __iter__(self):
             """
             Enumerates all Masks
             """
-            startkey = self._id0.makekey(self._nodeid, 'E')
-            endkey = self._id0.makekey(self._nodeid, 'F')
-            cur = self._id0.btree.find('ge', startkey)
-            while cur.getkey() < endkey:
-                yield Bitfield.Member(self._id0, self._id0.int(cur) - 1)
-                cur.next()
+            for value, member in self._id0.range(self._nodeid, 'E'):
+                yield Bitfield.Member(self._id0, self._id0.decodeint(member) - 1)
 
 
     def __init__(self, id0, nodeid):
@@ -1605,28 +2550,27 @@ class Bitfield:
         self._nodeid = nodeid
 
     @cachedproperty
-    def count(self): return self._id0.int(self._nodeid, 'A', -1)
+    def count(self): return self.records.int('A', -1)
     @cachedproperty
-    def representation(self): return self._id0.int(self._nodeid, 'A', -3)
+    def representation(self): return self.records.int('A', -3)
     @cachedproperty
-    def flags(self): return self._id0.int(self._nodeid, 'A', -5)
+    def flags(self): return self.records.int('A', -5)
 
-    @cachedproperty
-    def comment(self, repeatable): return self._id0.string(self._nodeid, 'S', 1 if repeatable else 0)
     @cachedproperty
     def name(self): return self._id0.name(self._nodeid)
+    @cachedproperty
+    def records(self): return self._id0.noderecords(self._nodeid)
+
+    def comment(self, repeatable=False):
+        """ returns the regular or the repeatable comment """
+        return self.records.string('S', 1 if repeatable else 0)
 
     def __iter__(self):
         """
         Enumerates all Masks
         """
-        startkey = self._id0.makekey(self._nodeid, 'm')
-        endkey = self._id0.makekey(self._nodeid, 'n')
-        cur = self._id0.btree.find('ge', startkey)
-        while cur.getkey() < endkey:
-            key = self._id0.decodekey(cur.getkey())
-            yield Bitfield.Mask(self._id0, self._id0.int(cur) - 1, key[-1])
-            cur.next()
+        for mask, masknode in self._id0.range(self._nodeid, 'm'):
+            yield Bitfield.Mask(self._id0, self._id0.decodeint(masknode) - 1, mask)
 
 class IDBParams:
     def __init__(self, id0, data):
@@ -0,0 +1,331 @@
+"""
+idbserver - serve lookups on a set of open IDA databases over a unix domain socket.
+
+Starting idbtool for each query means paying for interpreter startup, parsing
+the database headers, and reading the b-tree pages again every time.
+The server keeps the databases open, with warm page and name caches.
+
+The protocol is line based: each request is a single line json object,
+answered by a single line json object: {"result": ...} or {"error": "message"}.
+Several requests can be sent over one connection.
+
+Each request has an "op", and a "file", the absolute path of the database.
+
+    {"op": "query", "file": F, "query": "Root Node;V", "limit": 1, "dec": false}
+        -> {"records": [{"key": hex, "value": hex, "pkey": prettykey, "pval": prettyval}, ...]}
+        without a limit, '==' queries return 1 record, other queries DEFAULTLIMIT records,
+        the limit is at most MAXLIMIT.
+    {"op": "range", "file": F, "node": nodeid or name, "tag": "S", "lo": int, "hi": int, "limit": 100}
+        -> [[index, hexvalue], ...], at most DEFAULTLIMIT records without a limit, and at most MAXLIMIT.
+    {"op": "name", "file": F, "ea": ea or [ea, ...]}        -> name, or list of names
+    {"op": "node", "file": F, "name": name}                 -> nodeid
+    {"op": "struct", "file": F, "name": name or nodeid}     -> struct info, like `idbtool --format jsonl -u`
+    {"op": "enum", "file": F, "name": name or nodeid}       -> enum or bitfield info
+    {"op": "info", "file": F}                               -> root node, idaver, wordsize, nodebase, maxnode
+
+bytes values are returned as hex strings.
+
+Copyright (c) 2016 Willem Hengeveld <itsme@xs4all.nl>
+"""
+from __future__ import division, print_function, absolute_import, unicode_literals
+import os
+import stat
+import json
+import socket
+import signal
+import sys
+import threading
+import itertools
+import contextlib
+from collections import OrderedDict
+if sys.version_info[0] == 2:
+    import SocketServer as socketserver
+else:
+    import socketserver
+
+import idblib
+import idbtool
+
+
+# the default, and maximum nr of records returned by a query
+DEFAULTLIMIT = 100
+MAXLIMIT = 10000
+
+
+def log(msg):
+    """ diagnostics go to stderr, so they don't mix with the output of the process running the server """
+    print(msg, file=sys.stderr)
+
+
+class Database(object):
+    """
+    An opened database.
+
+    `identity` is the (size, mtime) of the file when it was opened,
+    `users` counts the requests using the database.
+    """
+    def __init__(self, path, identity):
+        self.identity = identity
+        self.users = 0
+        self.retired = False
+        self.fh = open(path, "rb")
+        try:
+            self.idb = idblib.IDBFile(self.fh)
+            self.id0 = self.idb.getsection(idblib.ID0File)
+        except Exception:
+            self.fh.close()
+            raise
+
+    def close(self):
+        # the memory map itself is unmapped when the last section referencing it is gone.
+        mapping = getattr(self.idb, '_mapping', None)
+        if mapping is not None:
+            mapping.release()
+        self.fh.close()
+
+
+class DatabasePool(object):
+    """
+    Keeps up to `maxopen` databases open, databases are reopened when their size or mtime changed.
+
+    Databases leaving the pool are closed as soon as no request is using them.
+
+        with pool.get(path) as db:
+            ...
+    """
+    def __init__(self, maxopen=16):
+        self.maxopen = maxopen
+        # path -> Database, least recently used first
+        self.databases = OrderedDict()
+        self.lock = threading.Lock()
+        # path -> [lock, nr of acquire calls using it], serializes opening the same path.
+        # entries only exist while acquire calls for the path are in progress.
+        self.pathlocks = dict()
+
+    @contextlib.contextmanager
+    def get(self, path):
+        db = self.acquire(path)
+        try:
+            yield db
+        finally:
+            self.release(db)
+
+    def acquire(self, path):
+        st = os.stat(path)
+        identity = (st.st_size, st.st_mtime)
+        with self.lock:
+            pathlock = self.pathlocks.setdefault(path, [threading.Lock(), 0])
+            pathlock[1] += 1
+        try:
+            with pathlock[0]:
+                return self.openlocked(path, identity)
+        finally:
+            with self.lock:
+                pathlock[1] -= 1
+                if not pathlock[1]:
+                    del self.pathlocks[path]
+
+    def openlocked(self, path, identity):
+        """ returns the open database for `path`, called with the lock for `path` held """
+        with self.lock:
+            db = self.databases.pop(path, None)
+            if db is not None and db.identity == identity:
+                self.databases[path] = db
+                db.users += 1
+                return db
+            if db is not None:
+                self.retire(db)
+
+        db = Database(path, identity)
+
+        with self.lock:
+            self.databases[path] = db
+            db.users += 1
+            while len(self.databases) > self.maxopen:
+                self.retire(self.databases.popitem(last=False)[1])
+        return db
+
+    def release(self, db):
+        with self.lock:
+            db.users -= 1
+            if db.retired and not db.users:
+                db.close()
+
+    def retire(self, db):
+        """ called with `lock` held, when `db` was removed from the pool """
+        db.retired = True
+        if not db.users:
+            db.close()
+
+    def close(self):
+        with self.lock:
+            while self.databases:
+                self.retire(self.databases.popitem()[1])
+
+
+def getnode(id0, node):
+    """ a node is specified either by nodeid, or by name """
+    if isinstance(node, int):
+        return node
+    nodeid = id0.nodeByName(node)
+    if nodeid is None:
+        raise Exception("Could not find '%s'" % node)
+    return nodeid
+
+
+def getlimit(req, default=None):
+    """ the maximum nr of records to return for `req`, by default DEFAULTLIMIT, at most MAXLIMIT """
+    limit = req.get('limit')
+    if limit is None:
+        limit = DEFAULTLIMIT if default is None else default
+    return min(limit, MAXLIMIT)
+
+
+def opquery(args, db, req):
+    id0 = db.id0
+    op, key = idbtool.parsequery(args, id0, req['query'], log)
+    if key is None:
+        raise Exception("Could not find '%s'" % req['query'])
+    c = id0.btree.find(op, key)
+
+    # like `idbtool --query`, '==' returns a single record by default
+    limit = getlimit(req, 1 if op == 'eq' else None)
+    records = []
+    while c and not c.eof() and len(records) < limit:
+        key, val = c.getkey(), c.getval()
+        records.append(dict(key=key, value=val, pkey=id0.prettykey(key), pval=id0.prettyval(val)))
+        if req.get('dec'):
+            c.prev()
+        else:
+            c.next()
+    return dict(records=records)
+
+
+def oprange(args, db, req):
+    id0 = db.id0
+    return list(itertools.islice(id0.range(getnode(id0, req['node']), req['tag'], req.get('lo'), req.get('hi')), getlimit(req)))
+
+
+def opname(args, db, req):
+    if isinstance(req['ea'], list):
+        return [name for ea, name in db.id0.names(req['ea'])]
+    return db.id0.name(req['ea'])
+
+
+def opnode(args, db, req):
+    return db.id0.nodeByName(req['name'])
+
+
+def opstruct(args, db, req):
+    s = idblib.Struct.load(db.id0, getnode(db.id0, req['name']))
+    return dict(name=s.name, flags=s.flags, members=[idbtool.dumpstructmember(m)[1] for m in s])
+
+
+def openum(args, db, req):
+    id0 = db.id0
+    node = getnode(id0, req['name'])
+    e = idblib.Enum(id0, node)
+    lines = []
+    if e.flags and e.flags & 1:
+        b = idblib.Bitfield(id0, node)
+        return dict(name=b.name, count=b.count, representation=b.representation, flags=b.flags, masks=[idbtool.dumpmask(m, lines) for m in b])
+    return dict(name=e.name, count=e.count, representation=e.representation, flags=e.flags, members=[idbtool.dumpenummember(m, lines) for m in e])
+
+
+def opinfo(args, db, req):
+    id0 = db.id0
+    return dict(root=id0.root, idaver=id0.idaver, idaverstr=id0.idaverstr, wordsize=id0.wordsize, nodebase=id0.nodebase, maxnode=id0.maxnode)
+
+
+OPS = dict(query=opquery, range=oprange, name=opname, node=opnode, struct=opstruct, enum=openum, info=opinfo)
+
+
+class RequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        for line in self.rfile:
+            try:
+                req = json.loads(line.decode('utf-8'))
+                func = OPS.get(req.get('op'))
+                if not func:
+                    raise Exception("unknown op: %s" % req.get('op'))
+                with self.server.pool.get(req['file']) as db:
+                    reply = dict(result=func(self.server.args, db, req))
+            except Exception as e:
+                reply = dict(error=str(e))
+            self.wfile.write(json.dumps(reply, default=idbtool.jsonvalue).encode('utf-8') + b"\n")
+            self.wfile.flush()
+
+
+class Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, sockpath, args, maxopen=16):
+        self.args = args
+        self.pool = DatabasePool(maxopen)
+        socketserver.UnixStreamServer.__init__(self, sockpath, RequestHandler)
+
+
+def serve(sockpath, args, filenames=()):
+    """
+    Serve requests on the unix socket `sockpath`, until interrupted.
+    `filenames` are opened before accepting requests.
+    """
+    if os.path.exists(sockpath):
+        if not stat.S_ISSOCK(os.stat(sockpath).st_mode):
+            raise Exception("%s exists, and is not a socket" % sockpath)
+        # remove a stale socket from a previous run
+        os.unlink(sockpath)
+    server = Server(sockpath, args)
+    for fn in filenames:
+        with server.pool.get(os.path.abspath(fn)):
+            pass
+
+    def terminate(signum, frame):
+        raise KeyboardInterrupt()
+    signal.signal(signal.SIGTERM, terminate)
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        server.pool.close()
+        os.unlink(sockpath)
+
+
+class Client(object):
+    """
+    Sends requests to an idbserver.
+
+    with Client(sockpath) as client:
+        print(client.request('name', 'test.idb', ea=0x401000))
+    """
+    def __init__(self, sockpath):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(sockpath)
+        self.rfile = self.sock.makefile('rb')
+        self.wfile = self.sock.makefile('wb')
+
+    def request(self, op, filename, **params):
+        params.update(op=op, file=os.path.abspath(filename))
+        self.wfile.write(json.dumps(params).encode('utf-8') + b"\n")
+        self.wfile.flush()
+        line = self.rfile.readline()
+        if not line:
+            raise Exception("connection closed by server")
+        reply = json.loads(line.decode('utf-8'))
+        if 'error' in reply:
+            raise Exception(reply['error'])
+        return reply['result']
+
+    def close(self):
+        self.rfile.close()
+        self.wfile.close()
+        self.sock.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -29,10 +29,13 @@ if sys.version_info[0] == 2:
 else:
     stdout = sys.stdout.buffer
 
+import io
+import json
 import struct
 import binascii
 import argparse
 import itertools
+import bisect
 from collections import defaultdict
 
 import re
@@ -57,6 +60,133 @@ def nonefmt(fmt, num):
         return "-"
     return fmt % num
 
+######### output ################
+
+
+def itemtext(text):
+    """ returns the text of an item, passed to `emit` either as a string, or as a list of lines """
+    return "\n".join(text) if isinstance(text, list) else text
+
+
+class PrintedLines(list):
+    """
+    A list of text lines, which prints each line when it is added.
+    """
+    def append(self, line):
+        print(line)
+        list.append(self, line)
+
+
+class TextOutput(object):
+    """
+    Prints each item as text.
+
+    The lines of multi-line items are printed as they are added to the list returned by `lines`.
+    """
+    filename = None
+
+    def lines(self):
+        return PrintedLines()
+
+    def emit(self, kind, text, **fields):
+        if not isinstance(text, PrintedLines):
+            print(itemtext(text))
+
+    def flush(self):
+        pass
+
+
+def jsonvalue(value):
+    """ json encoding for values json doesn't know about, bytes are output as hex """
+    if isinstance(value, (bytes, bytearray)):
+        return hexdump(value)
+    raise TypeError("can't encode %r" % value)
+
+
+class JsonOutput(object):
+    """
+    Writes each item as a single line json object, with the item type in 'type',
+    and the filename in 'file'.
+
+    Lines are collected and written to stdout in large blocks.
+    """
+    filename = None
+
+    def __init__(self, bufsize=1000):
+        self.bufsize = bufsize
+        self.buffer = []
+
+    def lines(self):
+        return []
+
+    def emit(self, kind, text, **fields):
+        fields['type'] = kind
+        if self.filename is not None:
+            fields['file'] = self.filename
+        self.buffer.append(json.dumps(fields, default=jsonvalue, sort_keys=True))
+        if len(self.buffer) >= self.bufsize:
+            self.flush()
+
+    def flush(self):
+        if self.buffer:
+            self.buffer.append("")
+            stdout.write("\n".join(self.buffer).encode('utf-8'))
+            stdout.flush()
+            self.buffer = []
+
+
+class RecordingOutput(object):
+    """
+    Passes items on to another output, keeping a copy of each item in `records`.
+    """
+    def __init__(self, output):
+        self.output = output
+        self.records = []
+
+    def lines(self):
+        return self.output.lines()
+
+    def emit(self, kind, text, **fields):
+        self.records.append([kind, itemtext(text), fields])
+        self.output.emit(kind, text, **fields)
+
+
+# set by `configure`, according to the `--format` option.
+output = TextOutput()
+
+# where text which is not an output item goes: diagnostics, and the dumps without a jsonl format.
+# None prints to stdout, `configure` sets this to stderr for the jsonl format.
+diagnostics = None
+
+# set by `configure` when `--cache` is used, and the entry for the current file, set by `processpath`.
+cache = None
+cacheentry = None
+
+
+def cachedoutput(kind, func, *args):
+    """
+    Calls func(*args), or with `--cache`, replays the items emitted by
+    this function for an unchanged file in an earlier run.
+    """
+    global output
+    if cacheentry is None:
+        return func(*args)
+    outputs = cacheentry.get('output') or dict()
+    if kind in outputs:
+        for itemkind, text, fields in outputs[kind]:
+            output.emit(itemkind, text, **fields)
+        return
+
+    recorder = output = RecordingOutput(output)
+    try:
+        func(*args)
+    finally:
+        output = recorder.output
+    outputs = dict(outputs)
+    outputs[kind] = recorder.records
+    cacheentry.set('output', outputs)
+
+
 ######### license encoding ################
 
 
@@ -82,14 +212,14 @@ def licensestring(lic):
     if not lic:
         return
     if len(lic) < 127:
-        print("too short license format: %s" % binascii.b2a_hex(lic))
+        print("too short license format: %s" % binascii.b2a_hex(lic), file=diagnostics)
         return
     elif len(lic) > 127 and sum(lic[127:]) != 0:
-        print("too long license format: %s" % binascii.b2a_hex(lic))
+        print("too long license format: %s" % binascii.b2a_hex(lic), file=diagnostics)
         return
 
     if struct.unpack_from("<L", lic, 106)[0]:
-        print("unknown license format: %s" % binascii.b2a_hex(lic))
+        print("unknown license format: %s" % binascii.b2a_hex(lic), file=diagnostics)
         return
 
     # first 2 bytes probably a checksum
@@ -152,8 +282,8 @@ def licensestring(lic):
         return "v%04d %s .. %s  %s  %s" % (licver, timestring(time1), timestring(time2), licid, licensee)
 
 
-def dumpuser(id0):
-    """ dump the original, and current database user """
+def dumpuser(id0, lines, info):
+    """ add the original, and current database user to `lines` and `info` """
     orignode = id0.nodeByName('$ original user')
     if orignode:
         user0 = id0.bytes(orignode, 'S', 0)
@@ -163,17 +293,19 @@ def dumpuser(id0):
             else:
                 user0 = user0[:127]
             # user0 has 128 bytes rsa encrypted license, followed by 32 bytes zero
-            print("orig: %s" % licensestring(user0))
+            info['origuser'] = licensestring(user0)
+            lines.append("orig: %s" % info['origuser'])
         # ida9 has S10+S11 == license json
         user10 = id0.blob(orignode, 'S', 16)
         if user10:
-            import json
             user10 = json.loads(user10)
-            print("orig: %s" % user10)
+            info['origlicense'] = user10
+            lines.append("orig: %s" % user10)
     curnode = id0.nodeByName('$ user1')
     if curnode:
         user1 = id0.bytes(curnode, 'S', 0)
-        print("user: %s" % licensestring(user1))
+        info['user'] = licensestring(user1)
+        lines.append("user: %s" % info['user'])
 
 
 ######### idb summary #########
@@ -233,48 +365,62 @@ def dumpinfo(id0):
     def appstring(fl):
         return decodebitmask(fl, ['console', 'graphics', 'exe', 'dll', 'driver', '1thread', 'mthread', '16bit', '32bit', '64bit'])
 
+    lines = output.lines()
+    info = dict()
+
     ldr = id0.nodeByName("$ loader name")
     if ldr:
-        print("loader: %s %s" % (id0.string(ldr, 'S', 0), id0.string(ldr, 'S', 1)))
+        info['loader'] = [id0.string(ldr, 'S', 0), id0.string(ldr, 'S', 1)]
+        lines.append("loader: %s %s" % tuple(info['loader']))
 
     if not id0.root:
-        print("database has no RootNode")
+        lines.append("database has no RootNode")
+        output.emit('info', lines, error="database has no RootNode", **info)
         return
 
     if id0.idbparams:
         params = idblib.IDBParams(id0, id0.idbparams)
-        print("cpu: %s, version=%d, filetype=%s, ostype=%s, apptype=%s, core:%x, size:%x" % (params.cpu, params.version, ftstring(params.filetype), osstring(params.ostype), appstring(params.apptype), params.corestart, params.coresize))
+        cpu = params.cpu.decode('utf-8', 'ignore') if isinstance(params.cpu, bytes) else params.cpu
+        info.update(cpu=cpu, version=params.version, filetype=ftstring(params.filetype), ostype=osstring(params.ostype), apptype=appstring(params.apptype), corestart=params.corestart, coresize=params.coresize)
+        lines.append("cpu: %s, version=%d, filetype=%s, ostype=%s, apptype=%s, core:%x, size:%x" % (params.cpu, params.version, ftstring(params.filetype), osstring(params.ostype), appstring(params.apptype), params.corestart, params.coresize))
 
-    print("idaver=%s: %s" % (nonefmt("%04d", id0.idaver), id0.idaverstr))
+    info.update(idaver=id0.idaver, idaverstr=id0.idaverstr)
+    lines.append("idaver=%s: %s" % (nonefmt("%04d", id0.idaver), id0.idaverstr))
 
     srcmd5 = id0.originmd5
-    print("nopens=%s, ctime=%s, crc=%s, md5=%s" % (nonefmt("%d", id0.nropens), nonefmt("%08x", id0.creationtime), nonefmt("%08x", id0.somecrc), hexdump(srcmd5) if srcmd5 else "-"))
+    info.update(nopens=id0.nropens, ctime=id0.creationtime, crc=id0.somecrc, md5=srcmd5)
+    lines.append("nopens=%s, ctime=%s, crc=%s, md5=%s" % (nonefmt("%d", id0.nropens), nonefmt("%08x", id0.creationtime), nonefmt("%08x", id0.somecrc), hexdump(srcmd5) if srcmd5 else "-"))
 
-    dumpuser(id0)
+    dumpuser(id0, lines, info)
+
+    output.emit('info', lines, **info)
 
 
 def dumpnames(args, id0, nam):
-    for ea in nam.allnames():
-        print("%08x: %s" % (ea, id0.name(ea)))
+    for ea, name in id0.names(nam.allnames()):
+        output.emit('name', "%08x: %s" % (ea, name), ea=ea, name=name)
 
 
 def dumpscript(id0, node):
     """ dump all stored scripts """
     s = idblib.Script(id0, node)
 
-    print("======= %s %s =======" % (s.language, s.name))
-    print(s.body)
+    lines = output.lines()
+    lines.append("======= %s %s =======" % (s.language, s.name))
+    lines.append(s.body)
+    output.emit('script', lines, name=s.name, language=s.language, body=s.body)
 
 
 def dumpstructmember(m):
     """
-    Dump info for a struct member.
+    Returns a text line, and a dict with the info for a struct member.
     """
-    print("     %02x %02x %08x %02x: %-40s" % (m.skip, m.size, m.flags, m.props, m.name), end="")
+    info = dict(skip=m.skip, size=m.size, flags=m.flags, props=m.props, name=m.name, enumid=m.enumid, structid=m.structid, ptrinfo=m.ptrinfo, typeinfo=m.typeinfo)
+    line = "     %02x %02x %08x %02x: %-40s" % (m.skip, m.size, m.flags, m.props, m.name)
     if m.enumid:
-        print(" enum %08x" % m.enumid, end="")
+        line += " enum %08x" % m.enumid
     if m.structid:
-        print(" struct %08x" % m.structid, end="")
+        line += " struct %08x" % m.structid
     if m.ptrinfo:
         # packed
         # note: 64bit nrs are stored low32, high32
@@ -285,40 +431,46 @@ def dumpstructmember(m):
         #   0x10 = targetaddr, 0x20 = baseaddr, 0x40 = delta, 0x80 = base is plainnum
         # flags2:
         #   1=image is off, 0x10 = subtract, 0x20 = signed operand
-        print(" ptr %s" % m.ptrinfo, end="")
+        line += " ptr %s" % m.ptrinfo
     if m.typeinfo:
-        print(" type %s" % m.typeinfo, end="")
-    print()
+        line += " type %s" % m.typeinfo
+    return line, info
 
 
 def dumpstruct(id0, node):
     """
     dump all info for the struct defined by `node`
     """
-    s = idblib.Struct(id0, node)
-
+    s = idblib.Struct.load(id0, node)
 
-    print("struct %s, 0x%x" % (s.name, s.flags))
+    lines = output.lines()
+    lines.append("struct %s, 0x%x" % (s.name, s.flags))
+    members = []
     for m in s:
-        dumpstructmember(m)
-
-def dumpbitmember(m):
-    print("        %08x %s" % (m.value or 0, m.name))
-def dumpmask(m):
-    print("    mask %08x %s" % (m.mask, m.name))
-    for m in m:
-        dumpbitmember(m)
+        line, info = dumpstructmember(m)
+        lines.append(line)
+        members.append(info)
+    output.emit('struct', lines, name=s.name, flags=s.flags, members=members)
+
+def dumpbitmember(m, lines):
+    lines.append("        %08x %s" % (m.value or 0, m.name))
+    return dict(value=m.value, name=m.name)
+def dumpmask(m, lines):
+    lines.append("    mask %08x %s" % (m.mask, m.name))
+    return dict(mask=m.mask, name=m.name, members=[dumpbitmember(bm, lines) for bm in m])
 def dumpbitfield(id0, node):
     b = idblib.Bitfield(id0, node)
-    print("bitfield %s, %s, %s, %s" % (b.name, nonefmt("0x%x", b.count), nonefmt("0x%x", b.representation), nonefmt("0x%x", b.flags)))
-    for m in b:
-        dumpmask(m)
+    lines = output.lines()
+    lines.append("bitfield %s, %s, %s, %s" % (b.name, nonefmt("0x%x", b.count), nonefmt("0x%x", b.representation), nonefmt("0x%x", b.flags)))
+    masks = [dumpmask(m, lines) for m in b]
+    output.emit('bitfield', lines, name=b.name, count=b.count, representation=b.representation, flags=b.flags, masks=masks)
 
-def dumpenummember(m):
+def dumpenummember(m, lines):
     """
-    Print information on a single enum member
+    Add information on a single enum member to `lines`, returns a dict with the member info.
     """
-    print("    %08x %s" % (m.value or 0, m.name))
+    lines.append("    %08x %s" % (m.value or 0, m.name))
+    return dict(value=m.value, name=m.name)
 
 def dumpenum(id0, node):
     """
@@ -328,10 +480,10 @@ def dumpenum(id0, node):
     if e.flags and e.flags&1:
         dumpbitfield(id0, node)
         return
-    print("enum %s, %s, %s, %s" % (e.name, nonefmt("0x%x", e.count), nonefmt("0x%x", e.representation), nonefmt("0x%x", e.flags)))
-
-    for m in e:
-        dumpenummember(m)
+    lines = output.lines()
+    lines.append("enum %s, %s, %s, %s" % (e.name, nonefmt("0x%x", e.count), nonefmt("0x%x", e.representation), nonefmt("0x%x", e.flags)))
+    members = [dumpenummember(m, lines) for m in e]
+    output.emit('enum', lines, name=e.name, count=e.count, representation=e.representation, flags=e.flags, members=members)
 
 
 def dumpimport(id0, node):
@@ -339,25 +491,15 @@ def dumpimport(id0, node):
     # are stored in the list, therefore we add '1' to the node here.
 
     # first the named imports
-    startkey = id0.makekey(node+1, 'S')
-    endkey = id0.makekey(node+1, 'T')
-    cur = id0.btree.find('ge', startkey)
-    while cur.getkey() < endkey:
-        txt = id0.string(cur)
-        key = cur.getkey()
-        ea = id0.decodekey(key)[3]
-        print("%08x: %s" % (ea, txt))
-        cur.next()
+    for ea, txt in id0.range(node+1, 'S'):
+        name = id0.decodestring(txt)
+        output.emit('import', "%08x: %s" % (ea, name), ea=ea, name=name)
 
     # then list the imports by ordinal
-    startkey = id0.makekey(node+1, 'A')
-    endkey = id0.makekey(node+1, 'B')
-    cur = id0.btree.find('ge', startkey)
-    while cur.getkey() < endkey:
-        ordinal = id0.decodekey(cur.getkey())[3]
-        ea = id0.int(cur)
-        print("%08x: (ord%04d) %s" % (ea, ordinal, id0.name(ea)))
-        cur.next()
+    for ordinal, ea in id0.range(node+1, 'A'):
+        ea = id0.decodeint(ea)
+        name = id0.name(ea)
+        output.emit('import', "%08x: (ord%04d) %s" % (ea, ordinal, name), ea=ea, ordinal=ordinal, name=name)
 
 
 def enumlist(id0, listname, callback):
@@ -380,13 +522,8 @@ def enumlist(id0, listname, callback):
     if not listnode:
         return
 
-    startkey = id0.makekey(listnode, 'A')
-    endkey = id0.makekey(listnode, 'A', 0xFFFFFFFF)
-    cur = id0.btree.find('ge', startkey)
-    while cur.getkey() < endkey:
-        item = id0.int(cur)
-        callback(id0, item - 1)
-        cur.next()
+    for seqnr, item in id0.range(listnode, 'A', hi=0xFFFFFFFF):
+        callback(id0, id0.decodeint(item) - 1)
 
 
 def listfuncdirs(id0):
@@ -467,24 +604,30 @@ def dumpfuncdir(id0, dir_index, data):
     if not p.eof():
         raise Exception('not EOF after dir parsed')
 
-    print("dir %d = %s" % (dir_index, name))
-    print("  parent = %d" % parent)
-    print("  subdirs:")
+    lines = output.lines()
+    lines.append("dir %d = %s" % (dir_index, name))
+    lines.append("  parent = %d" % parent)
+    lines.append("  subdirs:")
     for subdir in subdirs:
-        print("    %d" % subdir)
-    print("  functions:")
+        lines.append("    %d" % subdir)
+    lines.append("  functions:")
     for func in funcs:
-        print("    0x%x" % func)
+        lines.append("    0x%x" % func)
+    output.emit('funcdir', lines, index=dir_index, name=name, parent=parent, subdirs=subdirs, functions=funcs)
 
 
 def printent(args, id0, c):
+    printrecord(args, id0, c.getkey(), c.getval())
+
+
+def printrecord(args, id0, key, val):
     if args.verbose:
-        print("%s = %s" % (id0.prettykey(c.getkey()), id0.prettyval(c.getval())))
+        output.emit('record', "%s = %s" % (id0.prettykey(key), id0.prettyval(val)), key=key, value=val)
     else:
-        print("%s = %s" % (hexdump(c.getkey()), hexdump(c.getval())))
+        output.emit('record', "%s = %s" % (hexdump(key), hexdump(val)), key=key, value=val)
 
 
-def createkey(args, id0, base, tag, ix):
+def createkey(args, id0, base, tag, ix, log=print):
     """
 
     parse base node specification:
@@ -495,6 +638,7 @@ def createkey(args, id0, base, tag, ix):
 
     '<name>'  -> lookup by name.
 
+    diagnostics are passed to `log`.
     """
     if base[:1] == '?':
         return id0.namekey(base[1:])
@@ -506,9 +650,9 @@ def createkey(args, id0, base, tag, ix):
     else:
         nodeid = id0.nodeByName(base)
         if nodeid and args.verbose > 1:
-            print("found node %x for %s" % (nodeid, base))
+            log("found node %x for %s" % (nodeid, base))
     if nodeid is None:
-        print("Could not find '%s'" % base)
+        log("Could not find '%s'" % base)
         return
 
     s = [nodeid]
@@ -560,6 +704,18 @@ def id0query(args, id0, query):
 
     """
 
+    op, key = parsequery(args, id0, query)
+
+    c = id0.btree.find(op, key)
+
+    enumeratecursor(args, c, op=='eq', lambda c:printent(args, id0, c))
+
+
+def parsequery(args, id0, query, log=print):
+    """
+    Returns the b-tree relation and the key for a query, see `id0query`.
+    The key is None when the name in the query does not exist.
+    """
     xlatop = {'=': 'eq', '==': 'eq', '>': 'gt', '<': 'lt', '>=': 'ge', '<=': 'le'}
 
     SEP = r";"
@@ -569,11 +725,7 @@ def id0query(args, id0, query):
     tag = m.group(3)  # optional ;tag
     ix = m.group(4)   # optional ;ix
 
-    op = xlatop[op]
-
-    c = id0.btree.find(op, createkey(args, id0, base, tag, ix))
-
-    enumeratecursor(args, c, op=='eq', lambda c:printent(args, id0, c))
+    return xlatop[op], createkey(args, id0, base, tag, ix, log)
 
 
 def getsegs(id0):
@@ -584,13 +736,8 @@ def getsegs(id0):
     node = id0.nodeByName('$ segs')
     if not node:
         return
-    startkey = id0.makekey(node, 'S')
-    endkey = id0.makekey(node, 'T')
-    cur = id0.btree.find('ge', startkey)
-    while cur.getkey() < endkey:
-        s = idblib.Segment(id0, cur.getval())
-        seglist.append(s)
-        cur.next()
+    for startea, spec in id0.range(node, 'S'):
+        seglist.append(idblib.Segment(id0, spec))
 
     return seglist
 
@@ -601,7 +748,7 @@ def listsegments(id0):
     """
     ssnode = id0.nodeByName('$ segstrings')
     if not ssnode:
-        print("can't find '$ segstrings' node")
+        print("can't find '$ segstrings' node", file=diagnostics)
         return
     segstrings = id0.blob(ssnode, 'S')
     p = idblib.IdaUnpacker(id0.wordsize, segstrings)
@@ -619,7 +766,8 @@ def listsegments(id0):
 
     segs = getsegs(id0)
     for s in segs:
-        print("%08x - %08x  %s" % (s.startea, s.startea+s.size, slist[s.name_id-1]))
+        name = slist[s.name_id-1]
+        output.emit('segment', "%08x - %08x  %s" % (s.startea, s.startea+s.size, name), startea=s.startea, endea=s.startea+s.size, name=name)
 
 def classifynodes(args, id0):
     """
@@ -632,36 +780,39 @@ def classifynodes(args, id0):
 
     segs = getsegs(id0)
 
-    print("node: %x .. %x" % (id0.nodebase, id0.maxnode))
+    print("node: %x .. %x" % (id0.nodebase, id0.maxnode), file=diagnostics)
 
-    def addstat(nodetype, k):
+    def statkey(k):
+        """ returns the key under which the decoded key `k` is counted in the tag statistics """
         if len(k)<3:
-            print("??? strange, expected longer key - %s" % k)
+            print("??? strange, expected longer key - %s" % k, file=diagnostics)
             return
         tag = k[2].decode('utf-8')
         if len(k)==3:
-            tagstats[nodetype][(tag, )] += 1
+            return (tag, )
         elif len(k)==4:
             value = k[3]
             if type(value)==int:
                 if isaddress(value):
-                    tagstats[nodetype][(tag, 'addr')] += 1
+                    return (tag, 'addr')
                 elif isnode(value):
-                    tagstats[nodetype][(tag, 'node')] += 1
-                else:
-                    if value >= id0.maxnode:
-                        value -= pow(0x100, id0.wordsize)
-                    tagstats[nodetype][(tag, value)] += 1
-            else:
-                tagstats[nodetype][(tag, 'string')] += 1
-        else:
-            print("??? strange, expected shorter key - %s" % k)
-            return
+                    return (tag, 'node')
+                if value >= id0.maxnode:
+                    value -= pow(0x100, id0.wordsize)
+                return (tag, value)
+            return (tag, 'string')
+        print("??? strange, expected shorter key - %s" % k, file=diagnostics)
+
+    def addstats(nodetype, stats):
+        for sk, count in stats.items():
+            tagstats[nodetype][sk] += count
+
+    segstarts = [seg.startea for seg in segs or ()]
+    segends = [seg.startea + seg.size for seg in segs or ()]
 
     def isaddress(addr):
-        for s in segs:
-            if s.startea <= addr < s.startea+s.size:
-                return True
+        i = bisect.bisect_right(segstarts, addr) - 1
+        return i >= 0 and addr < segends[i]
 
     def isnode(addr):
         return id0.nodebase <= addr <= id0.maxnode
@@ -710,12 +861,14 @@ def classifynodes(args, id0):
     def processscripts(id0, node):
         nodetype[node] = 'script'
 
-    def processaddr(id0, cur):
-        k = id0.decodekey(cur.getkey())
+    def processaddr(id0, key, val, stats):
+        k = id0.decodekey(key)
         if len(k)==4 and k[2:4] == (b'A', 2):
-            nodetype[id0.int(cur)-1] = 'hexrays'
+            nodetype[id0.decodeint(val)-1] = 'hexrays'
 
-        addstat('addr', k)
+        sk = statkey(k)
+        if sk:
+            stats[sk] += 1
 
     def processfunc(id0, funcspec):
         p = idblib.IdaUnpacker(id0.wordsize, funcspec)
@@ -734,14 +887,9 @@ def classifynodes(args, id0):
             processstructs(id0, node + id0.nodebase, "frame")
 
     def processimport(id0, node):
-        print("imp %08x" % node)
-        startkey = id0.makekey(node+1, 'A')
-        endkey = id0.makekey(node+1, 'B')
-        cur = id0.btree.find('ge', startkey)
-        while cur.getkey() < endkey:
-            dllnode = id0.int(cur)
-            nodetype[dllnode] = 'import'
-            cur.next()
+        print("imp %08x" % node, file=diagnostics)
+        for ordinal, dllnode in id0.range(node+1, 'A'):
+            nodetype[id0.decodeint(dllnode)] = 'import'
 
 
     # mark enums, structs, scripts.
@@ -752,39 +900,23 @@ def classifynodes(args, id0):
 
     # enum functions, scan for stackframes
     funcsnode = id0.nodeByName('$ funcs')
-    startkey = id0.makekey(funcsnode, 'S')
-    endkey = id0.makekey(funcsnode, 'T')
-    cur = id0.btree.find('ge', startkey)
-    while cur.getkey() < endkey:
-        processfunc(id0, cur.getval())
-        cur.next()
+    if funcsnode:
+        for startea, funcspec in id0.range(funcsnode, 'S'):
+            processfunc(id0, funcspec)
 
     clinode = id0.nodeByName('$ cli')
     if clinode:
         for letter in "ABCDEFGHIJKMcio":
-            startkey = id0.makekey(clinode, letter)
-            endkey = id0.makekey(clinode, chr(ord(letter)+1))
-            cur = id0.btree.find('ge', startkey)
-            while cur.getkey() < endkey:
-                nodetype[id0.int(cur)] = 'cli.'+letter
-                cur.next()
-
-
-    # enum addresses, scan for hex-rays nodes
-    startkey = b'.'
-    endkey = id0.makekey(id0.nodebase)
-    cur = id0.btree.find('ge', startkey)
-    while cur.getkey() < endkey:
-        processaddr(id0, cur)
-        cur.next()
-
-    # addresses above node list
-    startkey = id0.makekey(id0.maxnode+1)
-    endkey = b'/'
-    cur = id0.btree.find('ge', startkey)
-    while cur.getkey() < endkey:
-        processaddr(id0, cur)
-        cur.next()
+            for ix, val in id0.range(clinode, letter):
+                nodetype[id0.decodeint(val)] = 'cli.'+letter
+
+
+    # The records are read in one ordered pass over the database, with two scans:
+    # first the addresses above the node list, then everything up to the end of the node list.
+    # This way all hex-rays nodes are known before the node list is reached.
+    addrstats = defaultdict(int)
+    for key, val in id0.btree.scan(id0.makekey(id0.maxnode+1), b'/'):
+        processaddr(id0, key, val, addrstats)
 
     # scan for unmarked nodes
     #  $ fr[0-9a-f]+\.\w+
@@ -794,123 +926,162 @@ def classifynodes(args, id0):
     #  Stack[0000007C]
     #  xrefs to \w+
 
-    startkey = id0.makekey(id0.nodebase)
-    endkey = id0.makekey(id0.maxnode+1)
-    cur = id0.btree.find('ge', startkey)
-    while cur.getkey() < endkey:
-        k = id0.decodekey(cur.getkey())
-        node = k[1]
-        if node not in nodetype:
-            nodetype[node] = "unknown"
-        if nodetype[node] == "unknown" and k[2] == b'N':
-            name = cur.getval().rstrip(b'\x00')
-            if re.match(br'\$ fr[0-9a-f]+\.\w+$', name):
-                name = 'fr-type-functionframe'
-            elif re.match(br'\$ fr[0-9a-f]+\. [rs]$', name):
-                name = 'fr-type-functionframe'
-            elif re.match(br'\$ F[0-9A-F]+\.\w+$', name):
-                name = 'F-type-functionframe'
-            elif name.startswith(b'Stack of '):
-                name = 'stack-type-functionframe'
-            elif name.startswith(b'Stack['):
-                name = 'old-stack-type-functionframe'
-            elif name.startswith(b'xrefs to '):
-                name = 'old-xrefs'
-            else:
-                name = name.decode('utf-8', 'ignore')
-            nodetype[node] = name
-
-        cur.next()
+    def classifyname(name):
+        if re.match(br'\$ fr[0-9a-f]+\.\w+$', name):
+            return 'fr-type-functionframe'
+        elif re.match(br'\$ fr[0-9a-f]+\. [rs]$', name):
+            return 'fr-type-functionframe'
+        elif re.match(br'\$ F[0-9A-F]+\.\w+$', name):
+            return 'F-type-functionframe'
+        elif name.startswith(b'Stack of '):
+            return 'stack-type-functionframe'
+        elif name.startswith(b'Stack['):
+            return 'old-stack-type-functionframe'
+        elif name.startswith(b'xrefs to '):
+            return 'old-xrefs'
+        return name.decode('utf-8', 'ignore')
+
+    # the statistics for a node are collected until the node is complete, since
+    # the name record which determines the nodetype may be preceeded by other records.
+    nodestart = id0.makekey(id0.nodebase)
+    node = None
+    nodestats = defaultdict(int)
+    for key, val in id0.btree.scan(b'.', id0.makekey(id0.maxnode+1)):
+        if key < nodestart:
+            # addresses below the node list, scan for hex-rays nodes
+            processaddr(id0, key, val, tagstats['addr'])
+            continue
+        k = id0.decodekey(key)
+        if k[1] != node:
+            if node is not None:
+                addstats(nodetype[node], nodestats)
+            node = k[1]
+            nodestats = defaultdict(int)
+            if node not in nodetype:
+                nodetype[node] = "unknown"
+        if nodetype[node] == "unknown" and k[2:3] == (b'N',):
+            nodetype[node] = classifyname(val.rstrip(b'\x00'))
+
+        sk = statkey(k)
+        if sk:
+            nodestats[sk] += 1
+    if node is not None:
+        addstats(nodetype[node], nodestats)
+    addstats('addr', addrstats)
 
     # output node classification
     if args.verbose:
         for k, v in sorted(nodetype.items(), key=lambda kv:kv[0]):
-            print("%08x: %s" % (k, v))
-
-    # summarize tags per nodetype
-    startkey = id0.makekey(id0.nodebase)
-    endkey = id0.makekey(id0.maxnode+1)
-    cur = id0.btree.find('ge', startkey)
-    while cur.getkey() < endkey:
-        k = id0.decodekey(cur.getkey())
-        node = k[1]
-        nt = nodetype[node]
-
-        addstat(nt, k)
-
-        cur.next()
+            print("%08x: %s" % (k, v), file=diagnostics)
 
     # output tag statistics
     for nt, ntstats in sorted(tagstats.items(), key=lambda kv:kv[0]):
-        print("====== %s =====" % nt)
+        print("====== %s =====" % nt, file=diagnostics)
         for k, v in ntstats.items():
             if len(k)==1:
-                print("%5d - %s" % (v, k[0]))
+                print("%5d - %s" % (v, k[0]), file=diagnostics)
             elif len(k)==2 and type(k[1])==type(1):
-                print("%5d - %s %8x" % (v, k[0], k[1]))
+                print("%5d - %s %8x" % (v, k[0], k[1]), file=diagnostics)
             elif type(k[1])==type(1):
-                print("%5d - %s %8x %s" % (v, k[0], k[1], k[2:]))
+                print("%5d - %s %8x %s" % (v, k[0], k[1], k[2:]), file=diagnostics)
             else:
-                print("%5d - %s %s %s" % (v, k[0], k[1], k[2:]))
+                print("%5d - %s %s %s" % (v, k[0], k[1], k[2:]), file=diagnostics)
 
 
 def processid0(args, id0):
+    if cacheentry:
+        cacheentry.attach(id0)
+
     if args.info:
-        dumpinfo(id0)
+        cachedoutput('info', dumpinfo, id0)
 
     if args.pagedump:
-        id0.btree.pagedump()
+        id0.btree.pagedump(diagnostics)
 
     if args.query:
         for query in args.query:
             id0query(args, id0, query)
     elif args.id0:
-        id0.btree.dump()
-    elif args.inc:
-        c = id0.btree.find('ge', b'')
-        enumeratecursor(args, c, False, lambda c:printent(args, id0, c))
-    elif args.dec:
-        c = id0.btree.find('le', b'\x80')
-        enumeratecursor(args, c, False, lambda c:printent(args, id0, c))
+        id0.btree.dump(diagnostics)
+    elif args.inc or args.dec:
+        for key, val in itertools.islice(id0.btree.scan(reverse=args.dec), args.limit):
+            printrecord(args, id0, key, val)
+
+
+def flagchunks(id1, a, b, chunksize=0x10000):
+    """ yield (ea, flags) for the range a..b, reading the flags in chunks of `chunksize` addresses """
+    for chunkstart in range(a, b, chunksize):
+        chunkend = min(b, chunkstart + chunksize)
+        for ea, flags in zip(range(chunkstart, chunkend), id1.getFlagsRange(chunkstart, chunkend)):
+            yield ea, flags
 
 
 def hexascdumprange(id1, a, b):
     line = asc = ""
-    for ea in range(a, b):
+    for ea, flags in flagchunks(id1, a, b):
         if len(line)==0:
             line = "%08x:" % ea
-        byte = id1.getFlags(ea)&0xFF
+        byte = flags&0xFF
         line += " %02x" % byte
         asc += chr(byte) if 32<byte<127 else '.'
 
         if len(line) == 9 + 3*16:
             line += " " + asc
-            print(line)
+            print(line, file=diagnostics)
             line = asc = ""
     if len(line):
         while len(line) < 9 + 3*16:
             line += "   "
         line += " " + asc
-        print(line)
+        print(line, file=diagnostics)
 
 
 def saverange(id1, a, b, fh):
-    buf = bytes()
-    for ea in range(a, b):
-        byte = id1.getFlags(ea)&0xFF
-        buf += struct.pack("B", byte)
+    for chunk in id1.iterBytes(a, b):
+        fh.write(chunk)
+
+
+def savesparse(id1, a, b, fh):
+    """
+    Save the bytes for a..b to fh, seeking over all-zero chunks, leaving holes in the file.
+    The caller is responsible for extending the file over a trailing hole.
+    """
+    for chunk in id1.iterBytes(a, b, 0x10000):
+        if chunk.count(b"\x00") == len(chunk):
+            fh.seek(len(chunk), 1)
+        else:
+            fh.write(chunk)
+
+
+def saveimage(id1, filename):
+    """
+    Save all segments to a sparse file, where each byte is stored
+    at offset `ea - <start of the lowest segment>`.
+    """
+    if not id1.seglist:
+        return
+    base = id1.firstSeg()
+    with open(filename, "wb") as fh:
+        for seg in id1.seglist:
+            fh.seek(seg.startea - base)
+            savesparse(id1, seg.startea, seg.endea, fh)
+        fh.truncate(max(id1.segends) - base)
 
-        if len(buf) == 65536:
-            fh.write(buf)
-            buf = bytes()
 
-    if buf:
-        fh.write(buf)
+def savesegments(id1, dirname):
+    """
+    Save each segment to a separate file named <startea>-<endea>.bin in `dirname`.
+    """
+    if not os.path.isdir(dirname):
+        os.makedirs(dirname)
+    for seg in id1.seglist:
+        with open(os.path.join(dirname, "%08x-%08x.bin" % (seg.startea, seg.endea)), "wb") as fh:
+            saverange(id1, seg.startea, seg.endea, fh)
 
 
 def processid1(args, id1):
     if args.id1:
-        id1.dump()
+        id1.dump(diagnostics)
     elif args.dump or args.dumpraw:
         m = re.match(r'^(\d\w*)-(\d\w*)?$', args.dump or args.dumpraw)
         if not m:
@@ -922,6 +1093,10 @@ def processid1(args, id1):
             saverange(id1, a, b, stdout)
         else:
             hexascdumprange(id1, a, b)
+    elif args.saveimage:
+        saveimage(id1, args.saveimage)
+    elif args.savesegs:
+        savesegments(id1, args.savesegs)
 
 
 def processid2(args, id2):
@@ -942,12 +1117,12 @@ def processseg(args, seg):
 
 def processidb(args, idb):
     if args.verbose > 1:
-        print("magic=%s, filever=%d" % (idb.magic, idb.fileversion))
+        print("magic=%s, filever=%d" % (idb.magic, idb.fileversion), file=diagnostics)
         for i in range(6):
             comp, ofs, size, checksum = idb.getsectioninfo(i)
             if ofs:
                 part = idb.getpart(i)
-                print("%2d: %02x, %08x %8x [%08x]:  %s" % (i, comp, ofs, size, checksum, hexdump(part.read(256))))
+                print("%2d: %02x, %08x %8x [%08x]:  %s" % (i, comp, ofs, size, checksum, hexdump(part.read(256))), file=diagnostics)
 
     nam = idb.getsection(idblib.NAMFile)
     id0 = idb.getsection(idblib.ID0File)
@@ -977,6 +1152,12 @@ def processidb(args, idb):
     if args.segs:
         listsegments(id0)
 
+    if args.verbose > 1 and id0:
+        print("pagecache: %(size)d/%(maxsize)d pages, hits=%(hits)d, misses=%(misses)d, evictions=%(evictions)d" % id0.btree.cache.stats(), file=diagnostics)
+        print("nodecache: %(size)d/%(maxsize)d names, hits=%(hits)d, misses=%(misses)d, evictions=%(evictions)d" % id0.nodecache.stats(), file=diagnostics)
+        print("namecache: %(size)d/%(maxsize)d names, hits=%(hits)d, misses=%(misses)d, evictions=%(evictions)d" % id0.namecache.stats(), file=diagnostics)
+        print("recordcache: %(size)d/%(maxsize)d nodes, hits=%(hits)d, misses=%(misses)d, evictions=%(evictions)d" % id0.recordcache.stats(), file=diagnostics)
+
 
 def processfile(args, filetypehint, fh):
     class DummyIDB:
@@ -994,13 +1175,13 @@ def processfile(args, filetypehint, fh):
         if magic.startswith(b"Va") or magic.startswith(b"VA"):
             idb = DummyIDB(args)
             if filetypehint == 'id1':
-                processid1(args, idblib.ID1File(idb, fh))
+                processid1(args, idblib.ID1File(idb, idblib.mapsection(fh)))
             elif filetypehint == 'nam':
-                processnam(args, idblib.NAMFile(idb, fh))
+                processnam(args, idblib.NAMFile(idb, idblib.mapsection(fh)))
             elif filetypehint == 'seg':
-                processseg(args, idblib.SEGFile(idb, fh))
+                processseg(args, idblib.SEGFile(idb, idblib.mapsection(fh)))
             else:
-                print("unknown VA type file: %s" % hexdump(magic))
+                print("unknown VA type file: %s" % hexdump(magic), file=diagnostics)
         elif magic.startswith(b"IDAS"):
             processid2(args, idblib.ID2File(DummyIDB(args), fh))
         elif magic.startswith(b"IDATIL"):
@@ -1008,12 +1189,105 @@ def processfile(args, filetypehint, fh):
         elif magic.startswith(b"IDA"):
             processidb(args, idblib.IDBFile(fh))
         elif magic.find(b'B-tree v') > 0:
-            processid0(args, idblib.ID0File(DummyIDB(args), fh))
+            processid0(args, idblib.ID0File(DummyIDB(args), idblib.mapsection(fh)))
 
     except Exception as e:
-        print("ERROR %s" % e)
+        print("ERROR %s" % e, file=diagnostics)
         if args.debug:
             raise
+        return str(e)
+
+
+def processpath(args, fn):
+    """
+    Process a single file from the commandline.
+
+    Returns an error message when processing failed.
+    """
+    global cacheentry
+    if not args.dumpraw and args.format == 'text':
+        print("\n==> " + fn + " <==\n", file=diagnostics)
+
+    output.filename = fn
+    try:
+        cacheentry = cache.lookup(fn) if cache else None
+        filetype = args.filetype or filetype_from_name(fn)
+        with open(fn, "rb") as fh:
+            error = processfile(args, filetype, fh)
+        if cacheentry and not error:
+            cacheentry.save()
+    except Exception as e:
+        print("ERROR: %s" % e, file=diagnostics)
+        if args.debug:
+            raise
+        error = str(e)
+    finally:
+        cacheentry = None
+        output.flush()
+    if error and args.format == 'jsonl':
+        output.emit('error', "", error=error)
+        output.flush()
+    return error
+
+
+def processbuffered(job):
+    """
+    Runs processpath in a worker process, with all output captured in a buffer.
+
+    Returns a tuple: (filename, output, errormessage)
+    """
+    global stdout
+    args, fn = job
+    buf = io.BytesIO()
+    savedstdout, savedbuffer = sys.stdout, stdout
+    if args.format == 'text':
+        sys.stdout = io.TextIOWrapper(buf, encoding='utf-8', write_through=True)
+    stdout = buf
+    try:
+        error = processpath(args, fn)
+    except Exception as e:
+        error = str(e)
+    finally:
+        if sys.stdout is not savedstdout:
+            sys.stdout.flush()
+            sys.stdout.detach()
+        sys.stdout, stdout = savedstdout, savedbuffer
+    return fn, buf.getvalue(), error
+
+
+def processparallel(args, filenames):
+    """
+    Distributes the files over `--jobs` worker processes.
+
+    Output is written in commandline order, or with `--unordered` in the
+    order in which files are completed.
+    Errors are summarized at the end.
+    """
+    import multiprocessing
+    pool = multiprocessing.Pool(args.jobs, configure, (args,))
+    jobs = [(args, fn) for fn in filenames]
+    if args.unordered:
+        results = pool.imap_unordered(processbuffered, jobs)
+    else:
+        results = pool.imap(processbuffered, jobs)
+
+    errors = []
+    try:
+        for fn, output, error in results:
+            sys.stdout.flush()
+            stdout.write(output)
+            stdout.flush()
+            if error:
+                errors.append((fn, error))
+    finally:
+        pool.terminate()
+        pool.join()
+
+    if errors:
+        sys.stdout.flush()
+        print("%d file(s) had errors:" % len(errors), file=sys.stderr)
+        for fn, error in errors:
+            print("%s: %s" % (fn, error), file=sys.stderr)
 
 
 def recover_database(args, basepath, dbfiles):
@@ -1038,7 +1312,7 @@ def DirEnumerator(args, path):
                 for f in DirEnumerator(args, d.path):
                     yield f
         except Exception as e:
-            print("EXCEPTION %s accessing %s/%s" % (e, path, d.name))
+            print("EXCEPTION %s accessing %s/%s" % (e, path, d.name), file=diagnostics)
 
 
 def EnumeratePaths(args, paths):
@@ -1059,7 +1333,7 @@ def EnumeratePaths(args, paths):
             elif os.path.isfile(fn):
                 yield fn
         except Exception as e:
-            print("EXCEPTION %s accessing %s" % (e, fn))
+            print("EXCEPTION %s accessing %s" % (e, fn), file=diagnostics)
 
 
 def filetype_from_name(fn):
@@ -1088,6 +1362,51 @@ def xlatv2name(name):
     return oldnames.get(name.lower())
 
 
+def processclient(args, filenames):
+    """
+    Run the `--query` queries through an `idbtool --serve` server, instead of opening the files.
+    """
+    import idbserver
+    with idbserver.Client(args.client) as client:
+        for fn in filenames:
+            if args.format == 'text':
+                print("\n==> " + fn + " <==\n", file=diagnostics)
+            output.filename = fn
+            for query in args.query or ():
+                try:
+                    result = client.request('query', fn, query=query, limit=args.limit, dec=args.dec)
+                except Exception as e:
+                    print("ERROR %s" % e, file=diagnostics)
+                    continue
+                for rec in result['records']:
+                    key, val = binascii.a2b_hex(rec['key']), binascii.a2b_hex(rec['value'])
+                    if args.verbose:
+                        text = "%s = %s" % (rec['pkey'], rec['pval'])
+                    else:
+                        text = "%s = %s" % (rec['key'], rec['value'])
+                    output.emit('record', text, key=key, value=val)
+            output.flush()
+
+
+def configure(args):
+    """ apply global settings, also used to initialize worker processes """
+    global output, cache, diagnostics
+    if args.pagecache is not None:
+        idblib.BTree.cachesize = args.pagecache
+    if args.namecache is not None:
+        idblib.ID0File.namecachesize = args.namecache
+    if args.format == 'jsonl':
+        output = JsonOutput()
+        # keep stdout clean for the json records.
+        diagnostics = sys.stderr
+    if args.cache:
+        import idbcache
+        cache = idbcache.IDBCache(args.cache, checksum=args.cachecrc)
+    if args.sectioncache:
+        import idbcache
+        idblib.IDBFile.sectioncache = idbcache.SectionCache(args.sectioncache, args.sectioncachesize << 20)
+
+
 def main():
     parser = argparse.ArgumentParser(description='idbtool - print info from hex-rays IDA .idb and .i64 files',
                                      formatter_class=argparse.RawDescriptionHelpFormatter,
@@ -1138,12 +1457,27 @@ Examples:
     parser.add_argument('--id1', "-id1", action='store_true', help='dump id1 records')
     parser.add_argument('--dump', type=str, help='hexdump id1 bytes', metavar='FROM-UNTIL')
     parser.add_argument('--dumpraw', type=str, help='output id1 bytes', metavar='FROM-UNTIL')
+    parser.add_argument('--saveimage', type=str, help='save the bytes of all id1 segments to a sparse file, at offset ea-<first segment>', metavar='FILE')
+    parser.add_argument('--savesegs', type=str, help='save the bytes of each id1 segment to a separate file in DIR', metavar='DIR')
     parser.add_argument('--pagedump', "-d", action='store_true', help='dump all btree pages, including any that might have become inaccessible due to datacorruption.')
     parser.add_argument('--classify', action='store_true', help='Classify nodes found in the database.')
 
     parser.add_argument('--query', "-q", type=str, nargs='*', help='search the id0 file for a specific record.')
     parser.add_argument('--limit', '-m', type=int, help='Max nr of records to return for a query.')
 
+    parser.add_argument('--pagecache', type=int, help='Max nr of b-tree pages kept in memory, 0 disables the cache.')
+    parser.add_argument('--namecache', type=int, help='Max nr of name lookups kept in memory, 0 disables the cache.')
+    parser.add_argument('--format', choices=['text', 'jsonl'], default='text', help='Output format for the dumped items: plain text, or one json object per line.')
+    parser.add_argument('--jobs', '-j', type=int, default=1, help='Process files in parallel using N worker processes.')
+    parser.add_argument('--unordered', action='store_true', help='With --jobs: output results as files complete, instead of in commandline order.')
+    parser.add_argument('--cache', type=str, help='Keep derived database facts and --info output in a sqlite cache in DIR, reused for unchanged files.', metavar='DIR')
+    parser.add_argument('--cachecrc', action='store_true', help='With --cache: also compare a crc of the file header, which contains the section checksums.')
+    parser.add_argument('--sectioncache', type=str, help='Keep the decompressed sections of compressed databases in DIR, reused for unchanged files.', metavar='DIR')
+    parser.add_argument('--sectioncachesize', type=int, default=4096, help='Max size in MB of the --sectioncache directory, default: 4096')
+
+    parser.add_argument('--serve', type=str, help='Keep the FILES open, and answer requests on unix socket SOCK, see idbserver.py', metavar='SOCK')
+    parser.add_argument('--client', type=str, help='Answer --query for FILES through the server on unix socket SOCK', metavar='SOCK')
+
     parser.add_argument('--recover', action='store_true', help='recover idb from unpacked files, of v2 database')
     parser.add_argument('--debug', action='store_true')
 
@@ -1151,44 +1485,56 @@ Examples:
 
     args = parser.parse_args()
 
-    if args.FILES:
+    configure(args)
+
+    if args.serve:
+        import idbserver
+        try:
+            idbserver.serve(args.serve, args, args.FILES)
+        except Exception as e:
+            print("ERROR: %s" % e, file=sys.stderr)
+            if args.debug:
+                raise
+            sys.exit(1)
+    elif args.client:
+        processclient(args, list(EnumeratePaths(args, args.FILES)))
+    elif args.FILES:
         dbs = dict()
+        filenames = []
 
         for fn in EnumeratePaths(args, args.FILES):
             basepath, filename = os.path.split(fn)
             if isv2name(filename):
                 d = dbs.setdefault(basepath, dict())
                 d[xlatv2name(filename)] = fn
-                print("%s -> %s : %s" % (xlatv2name(filename), basepath, filename))
+                print("%s -> %s : %s" % (xlatv2name(filename), basepath, filename), file=diagnostics)
             else:
                 basepath, ext = os.path.splitext(fn)
                 if isv3ext(ext):
                     d = dbs.setdefault(basepath, dict())
                     d[ext.lower()] = fn
 
-            if not args.dumpraw:
-                print("\n==> " + fn + " <==\n")
+            if args.jobs > 1:
+                filenames.append(fn)
+            else:
+                processpath(args, fn)
 
-            try:
-                filetype = args.filetype or filetype_from_name(fn)
-                with open(fn, "rb") as fh:
-                    processfile(args, filetype, fh)
-            except Exception as e:
-                print("ERROR: %s" % e)
-                if args.debug:
-                    raise
+        if filenames:
+            processparallel(args, filenames)
 
         if args.recover:
             for basepath, dbfiles in dbs.items():
                 if len(dbfiles) > 1:
                     try:
-                        print("\n==> " + basepath + " <==\n")
+                        print("\n==> " + basepath + " <==\n", file=diagnostics)
                         recover_database(args, basepath, dbfiles)
                     except Exception as e:
-                        print("ERROR: %s" % e)
+                        print("ERROR: %s" % e, file=diagnostics)
     else:
-        print("==> STDIN <==")
+        if args.format == 'text':
+            print("==> STDIN <==", file=diagnostics)
         processfile(args, args.filetype, sys.stdin.buffer)
+        output.flush()
 
 
 if __name__ == '__main__':
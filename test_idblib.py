@@ -1,5 +1,116 @@
 import unittest
-from idblib import FileSection, binary_search, makeStringIO
+import struct
+import tempfile
+import shutil
+import os
+import sys
+import zlib
+import idbcache
+import idbindex
+import threading
+import argparse
+import contextlib
+from idblib import FileSection, MappedSection, InflatedSection, IDBFile, mapfile, binary_search, makeStringIO, LRUCache, BTree, ID0File, ID1File, Struct, Enum, diffbtrees
+
+
+def makebtree(records, maxent=4, pagesize=0x800):
+    """
+    Construct an in memory v2.0 b-tree containing the sorted (key, value) `records`,
+    with at most `maxent` entries per page.
+    """
+    pages = [None]
+
+    def commonprefix(a, b):
+        n = 0
+        while n < min(len(a), len(b)) and a[n] == b[n]:
+            n += 1
+        return n
+
+    def makepage(preceeding, entries):
+        # entries: list of (entryfields, key, value)
+        hdr = struct.pack("<LH", preceeding, len(entries))
+        tblsize = 6 * (len(entries) + 2)
+        recs = b""
+        for fields, key, val in entries:
+            recofs = tblsize + len(recs)
+            hdr += struct.pack("<" + ("LH" if preceeding else "HHH"), *(fields + (recofs,)))
+            recs += struct.pack("<H", len(key)) + key + struct.pack("<H", len(val)) + val
+        hdr += struct.pack("<LH", 0, tblsize + len(recs))
+        data = hdr + recs
+        assert len(data) <= pagesize
+        pages.append(data + b"\x00" * (pagesize - len(data)))
+        return len(pages) - 1
+
+    def build(recs):
+        if len(recs) <= maxent:
+            entries = []
+            prev = b""
+            for key, val in recs:
+                indent = commonprefix(prev, key)
+                entries.append(((indent, 0), key[indent:], val))
+                prev = key
+            return makepage(0, entries)
+        nchild = min(maxent + 1, (len(recs) + maxent) // (maxent + 1) + 1)
+        size, extra = divmod(len(recs) - (nchild - 1), nchild)
+        groups, seps = [], []
+        o = 0
+        for i in range(nchild):
+            n = size + (1 if i < extra else 0)
+            groups.append(recs[o:o + n])
+            o += n
+            if i < nchild - 1:
+                seps.append(recs[o])
+                o += 1
+        preceeding = build(groups[0])
+        entries = []
+        for (key, val), grp in zip(seps, groups[1:]):
+            entries.append(((build(grp),), key, val))
+        return makepage(preceeding, entries)
+
+    root = build(list(records))
+    hdr = struct.pack("<LHLLL", 0, pagesize, root, len(records), len(pages))
+    hdr += b"\x00" + b"B-tree v2"
+    pages[0] = hdr + b"\x00" * (pagesize - len(hdr))
+    return makeStringIO(b"".join(pages))
+
+
+class IDB:
+    """ stands in for the IDBFile of a 32 bit database """
+    magic = 'IDA1'
+
+
+def id0key(node, tag, *ix):
+    """ returns the key of a 32 bit id0 record """
+    return struct.pack(">sLs" + "l" * len(ix), b".", node, tag, *ix)
+
+
+def makerecords(n):
+    return [(b"k%05d" % i, b"v%d" % i) for i in range(n)]
+
+
+def makeidb(sections, comp=2):
+    """ returns a version 4 .idb file, with the `sections` data zlib compressed when `comp` is 2 """
+    body = b""
+    offsets = []
+    for data in sections:
+        offsets.append(0x100 + len(body))
+        if comp == 2:
+            data = zlib.compress(data)
+        body += struct.pack("<BL", comp, len(data)) + data
+    offsets += [0] * (5 - len(offsets))
+    hdr = b"IDA1\0\0" + struct.pack("<5LLH", *(offsets + [0xaabbccdd, 4]))
+    hdr += struct.pack("<6L", *[0x1111 * (i + 1) for i in range(6)])
+    return hdr + b"\0" * (0x100 - len(hdr)) + body
+
+
+def makeidb910(sections, compression=1):
+    """ returns a version 910 .i64 file, with each section zlib compressed when `compression` is set """
+    if compression:
+        sections = [zlib.compress(data) for data in sections]
+    sizes = [len(data) for data in sections]
+    sizes += [0] * (6 - len(sizes))
+    hdr = b"IDA2\0\0" + struct.pack("<3QHB6Q", 0x100, 0x100, 0xaabbccdd << 32, 910, compression, *sizes)
+    return hdr + b"\0" * (0x100 - len(hdr)) + b"".join(sections)
 
 
 class TestFileSection(unittest.TestCase):
@@ -25,6 +136,94 @@ class TestFileSection(unittest.TestCase):
         with self.assertRaises(Exception):
             fh.seek(9)
 
+    def test_readat(self):
+        with tempfile.TemporaryFile() as tmp:
+            tmp.write(b"0123456789abcdef")
+            tmp.flush()
+            a = FileSection(tmp, 3, 11)
+            b = FileSection(tmp, 8, 16)
+            self.assertIsNotNone(a.fd)
+            self.assertEqual(a.read(2), b"34")
+            self.assertEqual(b.readat(2, 3), b"abc")
+            self.assertEqual(a.readat(6, 8), b"9a")
+            self.assertEqual(a.readat(9, 1), b"")
+            # reading through one section does not move the other
+            self.assertEqual(a.read(2), b"56")
+
+    def test_threads(self):
+        from multiprocessing.pool import ThreadPool
+        records = makerecords(2000)
+        with tempfile.TemporaryFile() as tmp:
+            tmp.write(makebtree(records).read())
+            tmp.flush()
+            bt = BTree(FileSection(tmp, 0, tmp.tell()), cachesize=8)
+
+            def lookup(i):
+                return bt.find('eq', records[i][0]).getval()
+
+            pool = ThreadPool(8)
+            try:
+                values = pool.map(lookup, list(range(len(records))) * 4)
+            finally:
+                pool.close()
+            self.assertEqual(values, [v for k, v in records] * 4)
+
+
+class TestInflatedSection(unittest.TestCase):
+    """ unittests for the on demand decompression of compressed sections """
+    def test_read(self):
+        data = b"".join(b"%08d" % i for i in range(100000))
+        fh = InflatedSection(makeStringIO(zlib.compress(data)))
+        self.assertEqual(fh.readat(16, 8), b"00000002")
+        self.assertLess(fh.inflated, len(data))
+        fh.seek(len(data) - 8)
+        self.assertEqual(fh.read(100), b"00099999")
+        self.assertEqual(fh.readat(len(data), 1), b"")
+        fh.seek(-16, 2)
+        self.assertEqual(fh.read(8), b"00099998")
+        fh.seek(0)
+        self.assertEqual(fh.read(), data)
+        fh.close()
+
+    def test_btree(self):
+        records = makerecords(2000)
+        btdata = makebtree(records).read()
+        fh = InflatedSection(makeStringIO(zlib.compress(btdata, 9)))
+        fh.chunksize = 0x100
+        bt = BTree(fh)
+        # only the header page was decompressed
+        self.assertLess(fh.inflated, len(btdata) // 4)
+        self.assertEqual(bt.find('eq', records[0][0]).getval(), records[0][1])
+        self.assertEqual([v for k, v in bt.scan()], [v for k, v in records])
+        fh.close()
+
+
+class TestMappedSection(unittest.TestCase):
+    """ unittest for MappedSection object """
+    def test_file(self):
+        with tempfile.TemporaryFile() as tmp:
+            tmp.write(b"0123456789abcdef")
+            tmp.flush()
+            fh = MappedSection(mapfile(tmp), 3, 11)
+        self.assertEqual(fh.read(3), b"345")
+        self.assertEqual(fh.read(8), b"6789a")
+        self.assertEqual(fh.read(8), b"")
+        self.assertEqual(bytes(fh.readat(2, 3)), b"567")
+
+        fh.seek(-1, 2)
+        self.assertEqual(fh.read(8), b"a")
+        fh.seek(3)
+        self.assertEqual(fh.read(2), b"67")
+        fh.seek(-2, 1)
+        self.assertEqual(fh.read(2), b"67")
+        with self.assertRaises(Exception):
+            fh.seek(9)
+
+    def test_unmappable(self):
+        with tempfile.TemporaryFile() as tmp:
+            self.assertIsNone(mapfile(tmp))
+        self.assertIsNone(mapfile(makeStringIO(b"abc")))
+
 
 class TestBinarySearch(unittest.TestCase):
     """ unittests for binary_search """
@@ -80,3 +279,856 @@ class TestBinarySearch(unittest.TestCase):
             self.assertEqual(binary_search(lst, l), l - 2)
             self.assertEqual(binary_search(lst, l + 1), l - 2)
             self.assertEqual(binary_search(lst, l + 2), l - 2)
+
+
+class TestLRUCache(unittest.TestCase):
+    """ unittests for the LRUCache """
+    def test_evict(self):
+        c = LRUCache(2)
+        c.put(1, "a")
+        c.put(2, "b")
+        self.assertEqual(c.get(1), "a")
+        c.put(3, "c")
+        self.assertEqual(c.get(2), None)
+        self.assertEqual(c.get(1), "a")
+        self.assertEqual(c.get(3), "c")
+        self.assertEqual((c.hits, c.misses, c.evictions), (3, 1, 1))
+
+    def test_pinned(self):
+        c = LRUCache(1)
+        c.pin(0, "root")
+        c.put(1, "a")
+        c.put(2, "b")
+        self.assertEqual(c.get(0), "root")
+        self.assertEqual(len(c), 2)
+
+    def test_fetch(self):
+        calls = []
+
+        def func(key):
+            calls.append(key)
+            return None if key == 2 else key * 10
+        c = LRUCache(4)
+        self.assertEqual(c.fetch(1, func), 10)
+        self.assertEqual(c.fetch(1, func), 10)
+        self.assertEqual(c.fetch(2, func), None)
+        self.assertEqual(c.fetch(2, func), None)
+        self.assertEqual(calls, [1, 2])
+        self.assertEqual((c.hits, c.misses), (2, 2))
+
+    def test_disabled(self):
+        c = LRUCache(0)
+        c.put(1, "a")
+        c.pin(2, "b")
+        self.assertEqual(c.get(1), None)
+        self.assertEqual(c.get(2), None)
+
+
+class TestBTree(unittest.TestCase):
+    """ unittests for BTree lookups, using a generated b-tree """
+    def test_find(self):
+        recs = makerecords(200)
+        bt = BTree(makebtree(recs))
+        for key, val in recs:
+            c = bt.find('eq', key)
+            self.assertEqual(c.getkey(), key)
+            self.assertEqual(c.getval(), val)
+        self.assertIsNone(bt.find('eq', b"k"))
+        self.assertEqual(bt.find('gt', b"k00010").getkey(), b"k00011")
+        self.assertEqual(bt.find('lt', b"k00010").getkey(), b"k00009")
+        self.assertEqual(bt.find('ge', b"k00010x").getkey(), b"k00011")
+        self.assertEqual(bt.find('le', b"k00010x").getkey(), b"k00010")
+
+    def test_cursor(self):
+        recs = makerecords(200)
+        bt = BTree(makebtree(recs))
+        c = bt.find('ge', b"")
+        keys = []
+        while not c.eof():
+            keys.append(c.getkey())
+            c.next()
+        self.assertEqual(keys, [k for k, v in recs])
+
+        c = bt.find('le', b"\xff")
+        keys = []
+        while not c.eof():
+            keys.append(c.getkey())
+            c.prev()
+        self.assertEqual(keys, [k for k, v in reversed(recs)])
+
+    def test_lazykeys(self):
+        recs = [(b".\xff\x00\x00%c%c" % (i // 7, tag) + (b"x" * (i % 5)), b"%d" % i) for i in range(60) for tag in b"ANS"]
+        bt = BTree(makebtree(sorted(recs), maxent=40, pagesize=0x1000))
+        c = bt.find('ge', b"")
+        while not c.eof():
+            page, ix = c.stack[-1]
+            if page.isleaf():
+                # decode keys in reverse order, then compare with the sequentially decoded entries
+                keys = [page.getkey(i) for i in reversed(range(page.count))][::-1]
+                self.assertEqual(keys, [ent.key for ent in page.index])
+                self.assertEqual([page.getval(i) for i in range(page.count)], [ent.val for ent in page.index])
+            c.next()
+
+    def test_scan(self):
+        recs = makerecords(300)
+        keys = [k for k, v in recs]
+        for maxent in (2, 5, 400):
+            bt = BTree(makebtree(recs, maxent=maxent, pagesize=0x2000))
+            self.assertEqual(list(bt.scan()), recs)
+            self.assertEqual(list(bt.scan(reverse=True)), recs[::-1])
+
+        bt = BTree(makebtree(recs))
+        self.assertEqual(list(bt.scan(reverse=True)), recs[::-1])
+        for start, end in ((b"k00010", b"k00150"), (b"k00010x", b"k00150x"), (None, b"k00007"), (b"k00290", None), (b"x", None), (None, b"a")):
+            want = [k for k in keys if (start is None or k >= start) and (end is None or k < end)]
+            self.assertEqual(list(bt.scan(start, end, keysonly=True)), want)
+            self.assertEqual(list(bt.scan(start, end, reverse=True, keysonly=True)), want[::-1])
+
+    def test_slots(self):
+        bt = BTree(makebtree(makerecords(20)))
+        page = bt.readpage(bt.firstindex)
+        self.assertFalse(hasattr(page, '__dict__'))
+        self.assertFalse(hasattr(page.index[0], '__dict__'))
+
+    def test_mapped(self):
+        recs = makerecords(200)
+        with tempfile.TemporaryFile() as tmp:
+            tmp.write(makebtree(recs).getvalue())
+            tmp.flush()
+            mm = mapfile(tmp)
+        bt = BTree(MappedSection(mm, 0, len(mm)))
+        for key, val in recs:
+            self.assertEqual(bt.find('eq', key).getval(), val)
+
+    def test_pagecache(self):
+        bt = BTree(makebtree(makerecords(200)))
+        bt.find('eq', b"k00100")
+        misses = bt.cache.misses
+        bt.find('eq', b"k00100")
+        self.assertEqual(bt.cache.misses, misses)
+        self.assertIn(bt.firstindex, bt.cache.pinned)
+
+        bt = BTree(makebtree(makerecords(200)), cachesize=0)
+        bt.find('eq', b"k00100")
+        self.assertEqual(len(bt.cache), 0)
+
+    def test_walkleaves(self):
+        bt = BTree(makebtree(makerecords(200)))
+        records = []
+        for unit in bt.walkleaves():
+            records.extend([unit] if isinstance(unit, tuple) else unit.leafrecords(0, unit.count))
+        self.assertEqual(records, list(bt.scan()))
+
+    def test_diff(self):
+        a = makerecords(300)
+        b = [(k, b"changed" if k == b"k00150" else v) for k, v in a if k not in (b"k00010", b"k00299")] + [(b"k00150x", b"new"), (b"z", b"last")]
+        bta, btb = BTree(makebtree(a)), BTree(makebtree(sorted(b)))
+        self.assertEqual(list(diffbtrees(bta, btb)), [(b"k00010", b"v10", None), (b"k00150", b"v150", b"changed"), (b"k00150x", None, b"new"), (b"k00299", b"v299", None), (b"z", None, b"last")])
+        self.assertEqual(list(diffbtrees(btb, bta))[0], (b"k00010", None, b"v10"))
+        self.assertEqual(list(diffbtrees(bta, BTree(makebtree(a)))), [])
+        self.assertEqual(len(list(diffbtrees(bta, BTree(makebtree([]))))), 300)
+
+    def test_diff_skips_pages(self):
+        a = makerecords(300)
+        bta = BTree(makebtree(a))
+        leaves = [unit for unit in bta.walkleaves() if not isinstance(unit, tuple)]
+        changed = leaves[1].leafrecords(0, 1)[0][0]
+        btb = BTree(makebtree([(k, b"changed" if k == changed else v) for k, v in a]))
+        # count the leaf pages which are decoded
+        page = type(leaves[0])
+        decoded = []
+        leafrecords = page.leafrecords
+
+        def counting(self, *args, **kwargs):
+            decoded.append(self)
+            return leafrecords(self, *args, **kwargs)
+        page.leafrecords = counting
+        self.addCleanup(setattr, page, 'leafrecords', leafrecords)
+
+        self.assertEqual(list(diffbtrees(bta, BTree(makebtree(a)))), [])
+        self.assertEqual(decoded, [])
+        # only the page with the changed record is decoded, in both trees
+        self.assertEqual(list(diffbtrees(bta, btb)), [(changed, dict(a)[changed], b"changed")])
+        self.assertEqual(len(decoded), 2)
+
+
+class TestID0File(unittest.TestCase):
+    """ unittests for ID0File range queries, using a generated 32 bit id0 """
+    def makeid0(self, records):
+        return ID0File(IDB(), makebtree(sorted(records)))
+
+    def test_range(self):
+        recs = [(struct.pack(">sLsL", b".", 0xFF000010, b"A", i), struct.pack("<L", i * 3)) for i in range(50)]
+        recs += [(struct.pack(">sLs", b".", 0xFF000010, b"N"), b"name")]
+        recs += [(struct.pack(">sLs", b".", 0xFF000010, b"H") + b"abc", b"str")]
+        recs += [(struct.pack(">sLsl", b".", 0xFF000010, b"S", -1), b"last")]
+        id0 = self.makeid0(recs)
+
+        self.assertEqual([(ix, id0.decodeint(v)) for ix, v in id0.range(0xFF000010, 'A', 10, 13)], [(10, 30), (11, 33), (12, 36)])
+        self.assertEqual(len(list(id0.range(0xFF000010, 'A'))), 50)
+        self.assertEqual(list(id0.range(0xFF000010, 'N')), [(None, b"name")])
+        self.assertEqual(list(id0.range(0xFF000010, 'H')), [(b"abc", b"str")])
+        self.assertEqual(list(id0.range(0xFF000010, 'S')), [(0xFFFFFFFF, b"last")])
+        # at the end of the tree
+        self.assertEqual(list(id0.range(0xFF000010, 'Z')), [])
+        self.assertEqual(list(id0.range(0xFF000011, 'A')), [])
+
+    def test_namecache(self):
+        recs = [(b"Nfoo", struct.pack("<L", 0xFF000010)), (struct.pack(">sLs", b".", 0xFF000010, b"N"), b"foo\x00")]
+        id0 = self.makeid0(recs)
+        for _ in range(3):
+            self.assertEqual(id0.nodeByName("foo"), 0xFF000010)
+            self.assertEqual(id0.name(0xFF000010), "foo")
+            self.assertIsNone(id0.nodeByName("bar"))
+        self.assertEqual((id0.nodecache.hits, id0.nodecache.misses), (4, 2))
+        self.assertEqual((id0.namecache.hits, id0.namecache.misses), (2, 1))
+
+    def test_names(self):
+        recs = []
+        for ea in range(0x1000, 0x1100, 0x10):
+            recs.append((struct.pack(">sLsL", b".", ea, b"A", 1), b"x"))
+            if ea % 0x20:
+                recs.append((struct.pack(">sLs", b".", ea, b"N"), b"name%x\x00" % ea))
+        id0 = self.makeid0(recs)
+        eas = [0x0800] + list(range(0x1000, 0x1100, 0x10)) + [0x1010, 0x2000]
+        self.assertEqual(list(id0.names(eas)), [(ea, id0.lookupname(ea)) for ea in eas])
+
+    def test_names_sparse(self):
+        # more records between names than names() steps over before doing a new lookup
+        recs = []
+        for ea in range(0x1000, 0x1100, 0x10):
+            recs.extend((struct.pack(">sLsL", b".", ea, b"D", i), b"x") for i in range(40))
+            if ea % 0x20:
+                recs.append((struct.pack(">sLs", b".", ea, b"N"), b"name%x\x00" % ea))
+        id0 = self.makeid0(recs)
+        eas = list(range(0x1000, 0x1100, 0x10))
+        expected = [(ea, id0.lookupname(ea)) for ea in eas]
+        id0.namecache = LRUCache(100)
+        self.assertEqual(list(id0.names(eas)), expected)
+        self.assertEqual(id0.namecache.misses, len(eas))
+        self.assertEqual(list(id0.names(eas)), expected)
+        self.assertEqual(id0.namecache.hits, len(eas))
+
+    def test_prefix(self):
+        id0 = self.makeid0([(b"Nabc", b"1"), (b"Nabd", b"2"), (b"Nb", b"3"), (b"N\xff", b"4"), (b".", b"5")])
+        self.assertEqual([v for k, v in id0.prefix("Nab")], [b"1", b"2"])
+        self.assertEqual([v for k, v in id0.prefix(b"N")], [b"1", b"2", b"3", b"4"])
+        self.assertEqual([v for k, v in id0.prefix(b"N\xff")], [b"4"])
+        self.assertEqual(list(id0.prefix(b"x")), [])
+
+
+class TestStruct(unittest.TestCase):
+    """ unittests for decoding structs, using a generated 32 bit id0 """
+    def makeid0(self):
+        recs = [(b"NRoot Node", struct.pack("<L", 0xFF000001)), (id0key(0xFF000001, b"A", -1), struct.pack("<L", 700))]
+        # struct 0xFF000010, with members 0xFF000011 .. 0xFF000013, each 4 bytes
+        recs += [(id0key(0xFF000010, b"N"), b"st\x00"), (id0key(0xFF000010, b"M", 0), b"\x00\x03\x11\x00\x04\x00\x00\x12\x00\x04\x00\x00\x13\x00\x04\x00\x00")]
+        for i in range(3):
+            recs += [(id0key(0xFF000011 + i, b"N"), b"st.m%d\x00" % i)]
+        recs += [(id0key(0xFF000011, b"A", 11), struct.pack("<L", 0xFF000021)), (id0key(0xFF000011, b"S", 0x3000), b"\x07")]
+        recs += [(id0key(0xFF000012, b"A", 3), struct.pack("<L", 0xFF000011)), (id0key(0xFF000012, b"S", 9), b"\x02\x00")]
+        recs += [(id0key(0xFF000012, b"D", 0x1000), b"\x01"), (id0key(0xFF000012, b"d", 0x1000), b"\x01")]
+        recs += [(id0key(0xFF000010, b"S", 0), b"regular\x00"), (id0key(0xFF000010, b"S", 1), b"repeatable\x00"), (id0key(0xFF000013, b"S", 1), b"m2\x00")]
+        # enum 0xFF000020, with member 0xFF000021 = 5
+        recs += [(id0key(0xFF000020, b"N"), b"en\x00"), (id0key(0xFF000020, b"A", -1), b"\x01"), (id0key(0xFF000020, b"A", -5), b"\x00"),
+                 (id0key(0xFF000020, b"E", 5), struct.pack("<L", 0xFF000022)), (id0key(0xFF000020, b"S", 0), b"enum\x00")]
+        recs += [(id0key(0xFF000021, b"N"), b"FIVE\x00"), (id0key(0xFF000021, b"A", -3), b"\x05"), (id0key(0xFF000021, b"S", 1), b"five\x00")]
+        return ID0File(IDB(), makebtree(sorted(recs)))
+
+    def members(self, s):
+        return [(m.name, m.enumid, m.stringtype, m.structid, m.ptrinfo, m.typeinfo) for m in s]
+
+    def test_load(self):
+        id0 = self.makeid0()
+        s = Struct.load(id0, 0xFF000010)
+        self.assertEqual(s.name, "st")
+        self.assertEqual([(m.ofs, m.size) for m in s], [(0, 4), (4, 4), (8, 4)])
+        self.assertEqual(self.members(s), [("st.m0", 0xFF000021, None, None, None, b"\x07"),
+                                           ("st.m1", None, None, 0xFF000011, b"\x02\x00", None),
+                                           ("st.m2", None, None, None, None, None)])
+        # prefetched member names are added to the name cache
+        self.assertEqual(id0.name(0xFF000011), "st.m0")
+        self.assertEqual(id0.namecache.hits, 1)
+        self.assertEqual(self.members(s), self.members(Struct.load(id0, 0xFF000010, prefetch=False)))
+
+    def test_scannoderecords(self):
+        id0 = self.makeid0()
+        for nodeid in range(0xFF000010, 0xFF000022):
+            self.assertEqual(id0.scannoderecords(nodeid).records, id0.readnoderecords(nodeid).records)
+        self.assertEqual(sorted(id0.scannoderecords(0xFF000012).records), [('A', 3), ('N', None), ('S', 9)])
+
+    def test_comments(self):
+        id0 = self.makeid0()
+        s = Struct(id0, 0xFF000010)
+        self.assertEqual((s.comment(), s.comment(True)), ("regular", "repeatable"))
+        self.assertEqual([(m.comment(), m.comment(repeatable=True)) for m in s], [(None, None), (None, None), (None, "m2")])
+        e = Enum(id0, 0xFF000020)
+        self.assertEqual((e.name, e.count, e.flags, e.comment(), e.comment(True)), ("en", 1, 0, "enum", None))
+        self.assertEqual([(m.name, m.value, m.comment(), m.comment(True)) for m in e], [("FIVE", 5, None, "five")])
+        # one record map per node
+        self.assertEqual(id0.recordcache.misses, 6)
+        # only the A, N and S records, not the enum members
+        self.assertEqual(len(id0.noderecords(0xFF000020)), 4)
+        self.assertIsNone(id0.noderecords(0xFF000020).bytes('E', 5))
+        self.assertEqual(id0.recordcache.misses, 6)
+        # names are resolved through the name cache
+        self.assertEqual(id0.namecache.misses, 2)
+
+
+class TestClassifyNodes(unittest.TestCase):
+    """ unittests for idbtool.classifynodes, using a generated 32 bit id0 """
+    # the output of the previous implementation, which scanned the id0 four times
+    EXPECTED = """\
+node: ff000000 .. ff0fffff
+ff000001: $ segs
+ff000010: hexrays
+ff000012: fr-type-functionframe
+ff000013: stack-type-functionframe
+ff000014: unknown
+ff000015: fr-type-functionframe
+ff000016: F-type-functionframe
+ff000017: old-stack-type-functionframe
+ff000018: old-xrefs
+ff000020: hexrays
+====== $ segs =====
+    1 - N
+    1 - S addr ()
+====== F-type-functionframe =====
+    1 - N
+====== addr =====
+    2 - A        2
+    1 - N
+    1 - S addr ()
+    1 - A node ()
+    1 - H string ()
+    1 - S        7
+    1 - S       -1
+====== fr-type-functionframe =====
+    1 - A        1
+    2 - N
+    1 - S addr ()
+====== hexrays =====
+    1 - S        0
+    1 - S        1
+    1 - N
+    1 - S        5
+====== old-stack-type-functionframe =====
+    1 - N
+====== old-xrefs =====
+    1 - N
+====== stack-type-functionframe =====
+    1 - A       -1
+    1 - N
+====== unknown =====
+    1 - S        3
+    1 - V
+"""
+
+    def makeid0(self):
+        # one segment: 0x1000 .. 0x2000
+        recs = [(b"N$ segs", struct.pack("<L", 0xFF000001)), (id0key(0xFF000001, b"N"), b"$ segs\x00"),
+                (id0key(0xFF000001, b"S", 0x1000), b"\xff\x00\x00\x10\x00\xff\x00\x00\x10\x00")]
+        # addresses below the node list, with a reference to hex-rays node 0xFF000010
+        recs += [(id0key(0x1000, b"A", 2), struct.pack("<L", 0xFF000011)), (id0key(0x1010, b"N"), b"main\x00"),
+                 (id0key(0x1020, b"S", 0x1100), b"x"), (id0key(0x1030, b"A", 0xFF000012 - (1 << 32)), b"x"),
+                 (id0key(0x3000, b"S", 7), b"x"), (id0key(0x3000, b"H") + b"label", b"x")]
+        # addresses above the node list, with a reference to hex-rays node 0xFF000020
+        recs += [(id0key(0xFF200000, b"A", 2), struct.pack("<L", 0xFF000021)), (id0key(0xFF200000, b"S", -1), b"x")]
+        # nodes, some with records before their name
+        recs += [(id0key(0xFF000010, b"S", 0), b"x"), (id0key(0xFF000010, b"S", 1), b"x")]
+        recs += [(id0key(0xFF000012, b"A", 1), b"x"), (id0key(0xFF000012, b"N"), b"$ fr1234.x\x00"), (id0key(0xFF000012, b"S", 0x1000), b"x")]
+        recs += [(id0key(0xFF000013, b"A", -1), b"x"), (id0key(0xFF000013, b"N"), b"Stack of main\x00")]
+        recs += [(id0key(0xFF000014, b"S", 3), b"x"), (id0key(0xFF000014, b"V"), b"x")]
+        for i, name in enumerate([b"$ fr10. r", b"$ F401000.x", b"Stack[0000007C]", b"xrefs to main"]):
+            recs += [(id0key(0xFF000015 + i, b"N"), name + b"\x00")]
+        recs += [(id0key(0xFF000020, b"N"), b"sub_1000\x00"), (id0key(0xFF000020, b"S", 5), b"x")]
+        return ID0File(IDB(), makebtree(sorted(recs), maxent=4))
+
+    @unittest.skipIf(sys.version_info < (3, 4), "requires python 3.4")
+    def test_classify(self):
+        import io
+        import idbtool
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            idbtool.classifynodes(argparse.Namespace(verbose=1), self.makeid0())
+        self.assertEqual(output.getvalue(), self.EXPECTED)
+
+
+class TestOutput(unittest.TestCase):
+    """ unittests for the idbtool output formats """
+    @unittest.skipIf(sys.version_info < (3, 4), "requires python 3.4")
+    def test_textlines(self):
+        import io
+        import idbtool
+        out = io.StringIO()
+        recorder = idbtool.RecordingOutput(idbtool.TextOutput())
+        with contextlib.redirect_stdout(out):
+            lines = recorder.lines()
+            lines.append("struct st, 0x0")
+            # lines are printed as they are produced, not when the item is complete
+            self.assertEqual(out.getvalue(), "struct st, 0x0\n")
+            lines.append("     00 04 00000000 00: m0")
+            recorder.emit('struct', lines, name="st")
+            recorder.emit('name', "00001000: main", ea=0x1000)
+        self.assertEqual(out.getvalue(), "struct st, 0x0\n     00 04 00000000 00: m0\n00001000: main\n")
+        self.assertEqual(recorder.records, [['struct', "struct st, 0x0\n     00 04 00000000 00: m0", dict(name="st")],
+                                            ['name', "00001000: main", dict(ea=0x1000)]])
+
+
+class TestAsyncID0File(unittest.TestCase):
+    """ unittests for the asyncio wrapper, using a generated 32 bit id0 """
+    @unittest.skipIf(sys.version_info < (3, 7), "requires python 3.7")
+    def test_lookups(self):
+        import asyncio
+        import idbasync
+        recs = [(b"Nfoo", struct.pack("<L", 0xFF000010)), (struct.pack(">sLs", b".", 0xFF000010, b"N"), b"foo\x00")]
+        recs += [(struct.pack(">sLsL", b".", 0xFF000010, b"S", i), struct.pack("<L", i)) for i in range(100)]
+        id0 = ID0File(IDB(), makebtree(sorted(recs)))
+
+        async def run():
+            async with idbasync.AsyncID0File(id0, maxworkers=3) as aid0:
+                self.assertEqual(await aid0.nodeByName("foo"), 0xFF000010)
+                self.assertEqual(await aid0.name(0xFF000010), "foo")
+                self.assertEqual(await aid0.int(0xFF000010, 'S', 7), 7)
+                self.assertEqual(len(await aid0.blob(0xFF000010, 'S')), 400)
+                self.assertEqual(await aid0.range(0xFF000010, 'S', 10, 12), [(10, b"\x0a\0\0\0"), (11, b"\x0b\0\0\0")])
+                keys = [(0xFF000010, 'S', i) for i in range(99, -1, -1)] + [(0xFF000010, 'S', 1000), b"Nfoo"]
+                values = await aid0.fetch(keys)
+                self.assertEqual([id0.decodeint(v) for v in values[:100]], list(range(99, -1, -1)))
+                self.assertEqual(values[100:], [None, struct.pack("<L", 0xFF000010)])
+                counts = await asyncio.gather(*[aid0.fetch([(0xFF000010, 'S', i)]) for i in range(20)])
+                self.assertEqual(len(counts), 20)
+
+        asyncio.run(run())
+
+
+class TestID1File(unittest.TestCase):
+    """ unittests for ID1File flag reads, using a generated 32 bit 'VA*' id1 """
+    def makeid1(self, segs):
+        # segs: list of (startea, flags)
+        hdr = b"VA*\x00" + struct.pack("<LLLL", 3, len(segs), 0x800, 0)
+        data = b""
+        for startea, flags in segs:
+            hdr += struct.pack("<LL", startea, startea + len(flags))
+            data += struct.pack("<%dL" % len(flags), *flags)
+        return ID1File(IDB(), makeStringIO(hdr + b"\x00" * (0x2000 - len(hdr)) + data))
+
+    def test_flagsrange(self):
+        id1 = self.makeid1([(0x1000, range(0x100, 0x120)), (0x1030, [0xFFFFFFFF, 0x12345678])])
+        flags = id1.getFlagsRange(0x0FFE, 0x1034)
+        self.assertEqual(list(flags), [id1.getFlags(ea) for ea in range(0x0FFE, 0x1034)])
+        self.assertEqual(list(flags[:4]), [0, 0, 0x100, 0x101])
+        self.assertEqual(list(flags[-4:]), [0xFFFFFFFF, 0x12345678, 0, 0])
+        self.assertEqual(list(id1.getFlagsRange(0x1010, 0x1010)), [])
+        self.assertEqual(list(id1.getFlagsRange(0x2000, 0x2002)), [0, 0])
+
+    def test_iterbytes(self):
+        id1 = self.makeid1([(0x1030, [0x141, 0x42]), (0x1000, [0x200 + i for i in range(0x20)])])
+        data = b"".join(id1.iterBytes(0x0FFE, 0x1034, chunksize=7))
+        self.assertEqual(data, bytes(bytearray(id1.getFlags(ea) & 0xFF for ea in range(0x0FFE, 0x1034))))
+        self.assertEqual(data[-4:], b"\x41\x42\x00\x00")
+        self.assertEqual([len(chunk) for chunk in id1.iterBytes(0x1000, 0x1010, chunksize=7)], [7, 7, 2])
+
+    def test_segments(self):
+        id1 = self.makeid1([(0x3000, [1] * 0x10), (0x1000, [2] * 0x10), (0x2000, [3] * 0x10)])
+        self.assertEqual([seg.startea for seg in id1.seglist], [0x1000, 0x2000, 0x3000])
+        self.assertEqual(id1.firstSeg(), 0x1000)
+        self.assertEqual(id1.nextSeg(0x1005), 0x2000)
+        self.assertEqual(id1.nextSeg(0x300F), None)
+        self.assertEqual(id1.nextSeg(0x1010), None)
+        self.assertEqual((id1.segStart(0x200F), id1.segEnd(0x200F)), (0x2000, 0x2010))
+        self.assertEqual(id1.segStart(0x0FFF), None)
+        self.assertEqual(id1.segEnd(0x3010), None)
+        self.assertEqual([id1.getFlags(ea) for ea in (0x0FFF, 0x1000, 0x2000, 0x200F, 0x2010, 0x3000, 0x3010)], [0, 2, 3, 3, 0, 1, 0])
+
+    def test_numpy(self):
+        try:
+            import numpy
+        except ImportError:
+            self.skipTest("numpy not available")
+        id1 = self.makeid1([(0x1000, range(0x100, 0x120))])
+        flags = id1.getFlagsRange(0x0FFF, 0x1002, usenumpy=True)
+        self.assertEqual(flags.dtype, numpy.uint32)
+        self.assertEqual(list(flags), [0, 0x100, 0x101])
+
+
+class TestIDBCache(unittest.TestCase):
+    """ unittests for the persistent fact cache """
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.dbname = os.path.join(self.tmpdir, "test.id0")
+        with open(self.dbname, "wb") as fh:
+            fh.write(b"x" * 100)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def makeid0(self):
+        recs = [(b"NRoot Node", struct.pack("<L", 0xFF000001)), (b"N$ structs", struct.pack("<L", 0xFF000002))]
+        recs += [(struct.pack(">sLsl", b".", 0xFF000001, b"S", 1302), b"\x01\x02")]
+        return ID0File(IDB(), makebtree(sorted(recs)))
+
+    def test_roundtrip(self):
+        cache = idbcache.IDBCache(os.path.join(self.tmpdir, "cache"))
+        entry = cache.lookup(self.dbname)
+        self.assertFalse(entry.hit)
+        id0 = self.makeid0()
+        entry.attach(id0)
+        self.assertEqual(id0.root, 0xFF000001)
+        self.assertEqual(id0.originmd5, b"\x01\x02")
+        self.assertEqual(id0.nodeByName("$ structs"), 0xFF000002)
+        self.assertEqual(id0.nodeByName("$ enums"), None)
+        entry.set('output', {'info': [['info', 'text', {'md5': b"\x01\x02"}]]})
+        entry.save()
+        # only facts which attach restores are stored
+        self.assertEqual(sorted(entry.get('id0')), ['originmd5', 'root'])
+
+        entry = cache.lookup(self.dbname)
+        self.assertTrue(entry.hit)
+        self.assertEqual(entry.get('output'), {'info': [['info', 'text', {'md5': b"\x01\x02"}]]})
+        id0 = self.makeid0()
+        entry.attach(id0)
+        self.assertEqual((id0.root, id0.originmd5), (0xFF000001, b"\x01\x02"))
+        self.assertEqual((id0.nodeByName("$ structs"), id0.nodeByName("$ enums")), (0xFF000002, None))
+        self.assertEqual(id0.btree.cache.misses, 0)
+
+        # a changed file invalidates the entry
+        with open(self.dbname, "ab") as fh:
+            fh.write(b"y")
+        self.assertFalse(cache.lookup(self.dbname).hit)
+        cache.close()
+
+    def test_checksum(self):
+        cache = idbcache.IDBCache(os.path.join(self.tmpdir, "cache"), checksum=True)
+        entry = cache.lookup(self.dbname)
+        entry.set('x', 1)
+        entry.save()
+        self.assertTrue(cache.lookup(self.dbname).hit)
+        nocrc = idbcache.IDBCache(os.path.join(self.tmpdir, "nocrc"))
+        entry = nocrc.lookup(self.dbname)
+        entry.set('x', 1)
+        entry.save()
+        # same size and mtime, different contents
+        st = os.stat(self.dbname)
+        with open(self.dbname, "r+b") as fh:
+            fh.write(b"z")
+        os.utime(self.dbname, ns=(st.st_atime_ns, st.st_mtime_ns))
+        self.assertFalse(cache.lookup(self.dbname).hit)
+        self.assertTrue(nocrc.lookup(self.dbname).hit)
+        cache.close()
+        nocrc.close()
+
+
+class TestIDBFile(unittest.TestCase):
+    """ unittests for reading the sections of generated .idb and .i64 files """
+    def check(self, data, comp):
+        records = makerecords(500)
+        with tempfile.TemporaryFile() as tmp:
+            tmp.write(data([makebtree(records).read(), b"id1" * 1000]))
+            tmp.flush()
+            idb = IDBFile(tmp)
+            self.assertEqual(idb.getsectioninfo(0)[0], comp)
+            self.assertEqual(idb.getsectioninfo(1)[0], comp)
+            self.assertEqual([v for k, v in BTree(idb.getpart(0)).scan()], [v for k, v in records])
+            self.assertEqual(idb.getpart(1).read(), b"id1" * 1000)
+
+    def test_compressed(self):
+        self.check(makeidb, 2)
+
+    def test_v910(self):
+        self.check(lambda sections: makeidb910(sections, 0), 0)
+
+    def test_compressed_v910(self):
+        self.check(makeidb910, 2)
+
+    def test_unsupported_v910(self):
+        with tempfile.TemporaryFile() as tmp:
+            tmp.write(makeidb910([b"data"], 7))
+            with self.assertRaisesRegex(Exception, "unsupported v910 compression 7"):
+                IDBFile(tmp)
+
+
+class TestSectionCache(unittest.TestCase):
+    """ unittests for the cache of decompressed sections """
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.cachedir = os.path.join(self.tmpdir, "cache")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def writeidb(self, name, sections):
+        path = os.path.join(self.tmpdir, name)
+        with open(path, "wb") as fh:
+            fh.write(makeidb(sections))
+        return path
+
+    def cachedfiles(self):
+        return sorted(os.listdir(self.cachedir))
+
+    def test_reuse(self):
+        records = makerecords(500)
+        path = self.writeidb("a.idb", [makebtree(records).read(), b"id1" * 1000])
+        cache = idbcache.SectionCache(self.cachedir)
+        for _ in range(2):
+            with open(path, "rb") as fh:
+                idb = IDBFile(fh, sectioncache=cache)
+                part = idb.getpart(0)
+                self.assertIsInstance(part, MappedSection)
+                self.assertEqual([v for k, v in BTree(part).scan()], [v for k, v in records])
+                self.assertEqual(idb.getpart(1).read(), b"id1" * 1000)
+            self.assertEqual(len(self.cachedfiles()), 2)
+
+        # a changed file uses new cache entries
+        with open(path, "ab") as fh:
+            fh.write(b"x")
+        with open(path, "rb") as fh:
+            self.assertEqual(IDBFile(fh, sectioncache=cache).getpart(1).read(), b"id1" * 1000)
+        self.assertEqual(len(self.cachedfiles()), 3)
+
+    def test_evict(self):
+        cache = idbcache.SectionCache(self.cachedir, maxsize=3000)
+        paths = [self.writeidb("%d.idb" % i, [b"%d" % i * 1000]) for i in range(4)]
+        for i, path in enumerate(paths):
+            with open(path, "rb") as fh:
+                idb = IDBFile(fh, sectioncache=cache)
+                idb.getpart(0)
+                # make the lru order independent of the filesystem timestamp resolution
+                os.utime(cache.filename(fh, 0, idb.checksums[0]), (1000 + i, 1000 + i))
+        self.assertEqual(len(self.cachedfiles()), 3)
+        # the oldest entry was removed
+        with open(paths[0], "rb") as fh:
+            self.assertFalse(os.path.exists(cache.filename(fh, 0, idb.checksums[0])))
+
+    def test_failed_decompress(self):
+        path = self.writeidb("a.idb", [b"data"])
+        cache = idbcache.SectionCache(self.cachedir)
+        with open(path, "rb") as fh:
+            with self.assertRaises(zlib.error):
+                cache.getpart(fh, 0, 0, makeStringIO(b"not compressed"), 15)
+        # no temporary file is left behind
+        self.assertEqual(self.cachedfiles(), [])
+
+    def test_removed_before_open(self):
+        class RacingCache(idbcache.SectionCache):
+            # another process removes the section right after it was decompressed
+            removed = 0
+
+            def evict(self, keep=None):
+                if keep and not self.removed:
+                    self.removed += 1
+                    os.unlink(keep)
+        path = self.writeidb("a.idb", [b"data" * 1000])
+        cache = RacingCache(self.cachedir)
+        with open(path, "rb") as fh:
+            self.assertEqual(IDBFile(fh, sectioncache=cache).getpart(0).read(), b"data" * 1000)
+        self.assertEqual(cache.removed, 1)
+        self.assertEqual(len(self.cachedfiles()), 1)
+
+
+class TestServer(unittest.TestCase):
+    """ unittests for the idbserver protocol, serving a generated id0 """
+    class Pool:
+        def __init__(self, db):
+            self.db = db
+            self.paths = []
+
+        @contextlib.contextmanager
+        def get(self, path):
+            self.paths.append(path)
+            yield self.db
+
+    def setUp(self):
+        import idbserver
+        recs = [(b"Nfoo", struct.pack("<L", 0xFF000010)), (struct.pack(">sLs", b".", 0xFF000010, b"N"), b"foo\x00")]
+        recs += [(struct.pack(">sLsL", b".", 0xFF000010, b"A", i), struct.pack("<L", i * 3)) for i in range(10)]
+        db = idbserver.Database.__new__(idbserver.Database)
+        db.id0 = ID0File(IDB(), makebtree(sorted(recs)))
+
+        self.tmpdir = tempfile.mkdtemp()
+        self.sockpath = os.path.join(self.tmpdir, "idb.sock")
+        self.server = idbserver.Server(self.sockpath, argparse.Namespace(verbose=0))
+        self.server.pool = self.Pool(db)
+        threading.Thread(target=self.server.serve_forever).start()
+        self.client = idbserver.Client(self.sockpath)
+
+    def tearDown(self):
+        self.client.close()
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.tmpdir)
+
+    def test_requests(self):
+        self.assertEqual(self.client.request('node', 'x.idb', name='foo'), 0xFF000010)
+        self.assertEqual(self.client.request('name', 'x.idb', ea=0xFF000010), 'foo')
+        self.assertEqual(self.client.request('name', 'x.idb', ea=[0xFF000010, 5]), ['foo', None])
+        self.assertEqual(self.client.request('range', 'x.idb', node='foo', tag='A', lo=2, hi=4), [[2, '06000000'], [3, '09000000']])
+        result = self.client.request('query', 'x.idb', query='foo;A;1', limit=2)
+        self.assertEqual([rec['value'] for rec in result['records']], ['03000000', '06000000'])
+        with self.assertRaises(Exception):
+            self.client.request('struct', 'x.idb', name='bar')
+        with self.assertRaises(Exception):
+            self.client.request('nosuchop', 'x.idb')
+        # the connection is still usable after an error
+        self.assertEqual(self.client.request('node', 'x.idb', name='foo'), 0xFF000010)
+        self.assertEqual(self.server.pool.paths[0], os.path.abspath('x.idb'))
+
+    def test_limit(self):
+        import idbserver
+        self.addCleanup(setattr, idbserver, 'DEFAULTLIMIT', idbserver.DEFAULTLIMIT)
+        self.addCleanup(setattr, idbserver, 'MAXLIMIT', idbserver.MAXLIMIT)
+        idbserver.DEFAULTLIMIT, idbserver.MAXLIMIT = 3, 5
+        self.assertEqual(len(self.client.request('query', 'x.idb', query='foo;A;1')['records']), 1)
+        self.assertEqual(len(self.client.request('query', 'x.idb', query='>=foo;A;1')['records']), 3)
+        self.assertEqual(len(self.client.request('query', 'x.idb', query='>=foo;A;1', limit=1000)['records']), 5)
+        self.assertEqual(len(self.client.request('range', 'x.idb', node='foo', tag='A')), 3)
+        self.assertEqual(len(self.client.request('range', 'x.idb', node='foo', tag='A', limit=1000)), 5)
+
+    def test_notasocket(self):
+        import idbserver
+        path = os.path.join(self.tmpdir, "a.idb")
+        with open(path, "wb") as fh:
+            fh.write(b"IDA1")
+        with self.assertRaises(Exception):
+            idbserver.serve(path, None)
+        self.assertTrue(os.path.exists(path))
+
+
+class TestDatabasePool(unittest.TestCase):
+    """ unittests for opening and closing the databases served by idbserver """
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.paths = []
+        for i in range(3):
+            self.paths.append(os.path.join(self.tmpdir, "%d.idb" % i))
+            self.writeidb(self.paths[-1])
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def writeidb(self, path, extra=b""):
+        with open(path, "wb") as fh:
+            fh.write(makeidb([makebtree(makerecords(10)).read() + extra], comp=0))
+
+    def test_reopen(self):
+        import idbserver
+        pool = idbserver.DatabasePool(maxopen=2)
+        with pool.get(self.paths[0]) as db0:
+            with pool.get(self.paths[0]) as db:
+                self.assertIs(db, db0)
+            # a changed file is reopened, the old one is closed once no longer used
+            self.writeidb(self.paths[0], b"\0" * 0x800)
+            with pool.get(self.paths[0]) as db:
+                self.assertIsNot(db, db0)
+            self.assertFalse(db0.fh.closed)
+        self.assertTrue(db0.fh.closed)
+
+        with pool.get(self.paths[1]) as db1:
+            pass
+        with pool.get(self.paths[2]):
+            pass
+        # the least recently used database was evicted
+        self.assertTrue(db.fh.closed)
+        self.assertFalse(db1.fh.closed)
+        pool.close()
+        self.assertTrue(db1.fh.closed)
+        # no locks are kept for paths which are not being opened
+        self.assertEqual(pool.pathlocks, {})
+
+    def test_threads(self):
+        import idbserver
+        from multiprocessing.pool import ThreadPool
+        pool = idbserver.DatabasePool()
+
+        def get(i):
+            with pool.get(self.paths[0]) as db:
+                return db
+
+        threads = ThreadPool(8)
+        try:
+            dbs = threads.map(get, range(32))
+        finally:
+            threads.close()
+        self.assertEqual(len(set(map(id, dbs))), 1)
+        self.assertEqual(pool.pathlocks, {})
+        pool.close()
+
+
+class TestNameIndex(unittest.TestCase):
+    """ unittests for the idbindex name searches """
+    def setUp(self):
+        self.index = idbindex.NameIndex(":memory:")
+        with self.index.db:
+            for path, names in (("/a.idb", ["sub_401000", "mystruct", "CryptDecrypt"]), ("/b.idb", ["sub_401000", "encrypt"])):
+                fileid = self.index.db.execute("INSERT INTO files (path, size, mtime) VALUES (?, 0, 0)", (path,)).lastrowid
+                for i, name in enumerate(names):
+                    self.index.db.execute("INSERT INTO names (fileid, kind, name, value) VALUES (?, ?, ?, ?)", (fileid, "struct" if name == "mystruct" else "symbol", name, "%x" % i))
+                if self.index.hasfts:
+                    self.index.db.execute("INSERT INTO names_fts (rowid, name) SELECT id, name FROM names WHERE fileid=?", (fileid,))
+
+    def tearDown(self):
+        self.index.close()
+
+    def search(self, name, mode='exact', kind=None):
+        return [(path, name) for path, kind, name, value in self.index.search(name, mode, kind)]
+
+    def test_search(self):
+        self.assertEqual(self.search("sub_401000"), [("/a.idb", "sub_401000"), ("/b.idb", "sub_401000")])
+        self.assertEqual(self.search("sub_40100"), [])
+        self.assertEqual(self.search("my", 'prefix'), [("/a.idb", "mystruct")])
+        self.assertEqual(self.search("my", 'prefix', 'symbol'), [])
+        self.assertEqual(self.search("rypt", 'substring'), [("/a.idb", "CryptDecrypt"), ("/b.idb", "encrypt")])
+        self.assertEqual(self.search("Cr", 'substring'), [("/a.idb", "CryptDecrypt")])
+        self.assertEqual(self.search("crypt", 'substring'), [("/a.idb", "CryptDecrypt"), ("/b.idb", "encrypt")])
+        self.assertEqual(self.search("CRYPT", 'substring'), [])
+
+
+class TestNameIndexUpdate(unittest.TestCase):
+    """ unittests for indexing generated databases with idbindex """
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, "a.idb")
+        self.index = idbindex.NameIndex(os.path.join(self.tmpdir, "index.sqlite"))
+
+    def tearDown(self):
+        self.index.close()
+        shutil.rmtree(self.tmpdir)
+
+    def writeidb(self, names, extra=()):
+        """ an .idb with named nodes, the first one is listed in '$ structs', plus the `extra` records """
+        recs = list(extra) + [(b"N$ structs", struct.pack("<L", 0xFF000001)), (struct.pack(">sLsL", b".", 0xFF000001, b"A", 0), struct.pack("<L", 0xFF000011))]
+        for i, name in enumerate(names):
+            recs.append((b"N" + name.encode('utf-8'), struct.pack("<L", 0xFF000010 + i)))
+        with open(self.path, "wb") as fh:
+            fh.write(makeidb([makebtree(sorted(recs)).read()]))
+
+    def search(self, name, mode='exact'):
+        return [(kind, name, value) for path, kind, name, value in self.index.search(name, mode)]
+
+    def test_update(self):
+        self.writeidb(["mystruct", "CryptEncrypt"])
+        self.assertTrue(self.index.update(self.path))
+        self.assertEqual(self.search("mystruct"), [("struct", "mystruct", 0xFF000010)])
+        self.assertEqual(self.search("Crypt", 'substring'), [("node", "CryptEncrypt", 0xFF000011)])
+        # unchanged files are not indexed again
+        self.assertFalse(self.index.update(self.path))
+
+        self.writeidb(["mystruct", "CryptDecrypt", "other"])
+        self.assertTrue(self.index.update(self.path))
+        self.assertEqual(self.search("Crypt", 'substring'), [("node", "CryptDecrypt", 0xFF000011)])
+        self.assertEqual(self.search("Encrypt", 'substring'), [])
+        self.assertEqual(self.search("oth", 'prefix'), [("node", "other", 0xFF000012)])
+        self.assertEqual(self.index.db.execute("SELECT COUNT(*) FROM names").fetchone()[0], 4)
+
+        os.unlink(self.path)
+        self.index.prune()
+        self.assertEqual(self.search("mystruct"), [])
+        self.assertEqual(self.search("Crypt", 'substring'), [])
+
+    def test_malformed(self):
+        # a name record with a 3 byte value does not stop indexing the other names
+        self.writeidb(["mystruct"], [(b"Nodd", b"\x01\x02\x03")])
+        self.assertTrue(self.index.update(self.path))
+        self.assertEqual(self.search("mystruct"), [("struct", "mystruct", 0xFF000010)])
+        self.assertEqual(self.search("odd"), [])
+        self.assertEqual(self.index.db.execute("SELECT error FROM files").fetchall(), [(None,)])